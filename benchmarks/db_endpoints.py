@@ -0,0 +1,118 @@
+"""
+Benchmark: endpoint latency on a large jobs/history/batch database.
+
+Seeds a throwaway SQLite file with N jobs (plus history rows and batches),
+then times the hot endpoints twice: without the secondary indexes
+(schema before migration 2) and with them.
+
+Usage:
+    python benchmarks/db_endpoints.py [jobs] [repeats]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+SESSIONS = 2000
+BATCH_SIZE = 10
+
+
+def use_database(path):
+    """نحول main على ملف داتابيز مؤقت (الـ connection بتاع الـ thread بيتفتح من جديد)"""
+    main.DB_PATH = path
+    main._db_local.conn = None
+    main.init_db()
+
+
+def seed(n_jobs):
+    now = time.time()
+    sessions = [uuid.uuid4().hex for _ in range(SESSIONS)]
+    statuses = ['complete'] * 8 + ['error', 'processing']
+    jobs, history, batches, items = [], [], [], []
+    for i in range(n_jobs):
+        job_id = uuid.uuid4().hex
+        session = random.choice(sessions)
+        created = now - random.uniform(0, 30 * 86400)
+        status = random.choice(statuses)
+        jobs.append((job_id, status, 100 if status == 'complete' else 40, created, session))
+        if status == 'complete':
+            history.append((job_id, f"Reel {i}", 'reciter', 1, 1, 5, '720', '20', f"reel_{i}.mp4", created, session))
+        if i % BATCH_SIZE == 0:
+            batch_id = uuid.uuid4().hex
+            batches.append((batch_id, 'complete', BATCH_SIZE, created))
+        items.append((batch_id, job_id, i % BATCH_SIZE, 1, 1, 5, status, created))
+
+    with main.db_transaction() as conn:
+        conn.executemany("INSERT INTO jobs (id, status, percent, created_at, session_id) VALUES (?, ?, ?, ?, ?)", jobs)
+        conn.executemany('''INSERT INTO history (job_id, title, reciter, surah, start_ayah, end_ayah, quality, fps,
+                            download_filename, created_at, session_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', history)
+        conn.executemany("INSERT INTO batch_jobs (id, status, total_jobs, created_at) VALUES (?, ?, ?, ?)", batches)
+        conn.executemany('''INSERT INTO batch_items (batch_id, job_id, position, surah, start_ayah, end_ayah, status, created_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', items)
+    return sessions, [b[0] for b in batches]
+
+
+def drop_indexes():
+    conn = main.db_connection()
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall():
+        conn.execute(f"DROP INDEX {name}")
+    conn.execute("ANALYZE")
+
+
+def create_indexes():
+    conn = main.db_connection()
+    for step in dict((v, steps) for v, _, steps in main.MIGRATIONS)[2]:
+        conn.execute(step)
+    conn.execute("ANALYZE")
+
+
+def measure(client, sessions, batches, repeats):
+    cases = {
+        '/api/my-jobs': lambda: client.get(f"/api/my-jobs?sessionId={random.choice(sessions)}"),
+        '/api/history': lambda: client.get(f"/api/history?sessionId={random.choice(sessions)}"),
+        '/api/batch/list': lambda: client.get(f"/api/batch/list?sessionId={random.choice(sessions)}"),
+        '/api/batch/status': lambda: client.get(f"/api/batch/status?batchId={random.choice(batches)}"),
+        '/api/health': lambda: client.get("/api/health"),
+        'db_get_pending_jobs': main.db_get_pending_jobs,
+    }
+    results = {}
+    for name, call in cases.items():
+        call()  # warm-up
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            call()
+        results[name] = (time.perf_counter() - t0) / repeats * 1000
+    return results
+
+
+def main_bench():
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    random.seed(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        use_database(os.path.join(tmp, "bench.db"))
+        t0 = time.perf_counter()
+        sessions, batches = seed(n_jobs)
+        print(f"Seeded {n_jobs:,} jobs in {time.perf_counter() - t0:.1f}s")
+
+        client = main.app.test_client()
+        drop_indexes()
+        before = measure(client, sessions, batches, repeats)
+        create_indexes()
+        after = measure(client, sessions, batches, repeats)
+
+        print(f"{'endpoint':<22}{'no indexes':>14}{'indexed':>12}")
+        for name in before:
+            print(f"{name:<22}{before[name]:>11.2f} ms{after[name]:>9.2f} ms")
+        main._db_local.conn.close()
+        main._db_local.conn = None
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,95 @@
+"""
+Benchmark: bytes copied per frame between the compositor and the encoder pipe.
+
+before: RGB frame -> tobytes() -> pipe   (moviepy write_videofile path)
+after:  float frame -> yuv420p into a ring-buffer slot -> memoryview -> pipe
+
+Usage:
+    python benchmarks/frame_transport.py [frames] [quality]
+"""
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from moviepy.editor import ColorClip
+
+import main
+
+
+def make_compositor(w, h, duration):
+    scale = 1.0 if h >= 1920 else 0.67
+    ac = main.create_text_clip("بسم الله الرحمن الرحيم", duration, w, scale)
+    ec = main.create_english_clip("In the name of Allah, the Merciful", duration, w, scale)
+    bg = ColorClip((w, h), color=(40, 80, 120)).set_duration(duration)
+    overlays = [main.TextOverlay(ac, h * 0.35, w, h), main.TextOverlay(ec, h * 0.35 + ac.h, w, h)]
+    return main.SegmentCompositor(bg, main.build_static_gain(w, h, True), overlays, duration, 20)
+
+
+def open_sink():
+    """pipe بيتفرغ في thread منفصل (بدل ffmpeg)"""
+    r, w = os.pipe()
+
+    def drain():
+        while os.read(r, 1 << 20):
+            pass
+        os.close(r)
+
+    t = threading.Thread(target=drain, daemon=True)
+    t.start()
+    return os.fdopen(w, 'wb'), t
+
+
+def run(label, frames, comp, step):
+    sink, drainer = open_sink()
+    bg = comp.background(0)
+    written = 0
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for i in range(frames):
+        written += step(comp, bg, i / comp.fps, sink)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sink.close()
+    drainer.join()
+    print(f"{label:<8} pipe bytes/frame: {written // frames:>10,}   "
+          f"peak alloc: {peak:>12,}   {elapsed / frames * 1000:7.2f} ms/frame")
+    return written // frames
+
+
+def main_bench():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    quality = sys.argv[2] if len(sys.argv) > 2 else '1080'
+    w, h = (1080, 1920) if quality == '1080' else (720, 1280)
+    comp = make_compositor(w, h, frames / 20)
+
+    def before(comp, bg, t, sink):
+        frame = comp.make_frame(t)
+        data = frame.tobytes()
+        sink.write(data)
+        return len(data)
+
+    scratch = np.empty((h, w, 3), dtype=np.float32)
+    slot = np.empty(main.yuv420p_frame_size(w, h), dtype=np.uint8)
+    converter = main.Yuv420Converter(w, h)
+
+    def after(comp, bg, t, sink):
+        converter.convert(comp.compose_float(bg, t, scratch=scratch), slot)
+        view = memoryview(slot)
+        sink.write(view)
+        return view.nbytes
+
+    print(f"Frame transport benchmark: {w}x{h}, {frames} frames")
+    b = run("before", frames, comp, before)
+    a = run("after", frames, comp, after)
+    # before: نسخة tobytes + كتابة الـ pipe | after: كتابة الـ pipe بس
+    print(f"copied bytes/frame: before {2 * b:,} -> after {a:,} ({a / (2 * b):.0%})")
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -15,15 +15,31 @@ import requests
 import json
 import sqlite3
 import zipfile
+import wave
+import hashlib
+import unicodedata
+import bisect
+import queue
+import atexit
+import subprocess
+import socket
+import signal
+import argparse
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
 from functools import lru_cache  # ✅ Added for caching
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 # مهم لـ OAuth مع HuggingFace (HTTPS خارجي، HTTP داخلي)
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
-from flask import Flask, request, jsonify, send_file, g
+from flask import Flask, request, jsonify, send_file, g, stream_with_context
 from flask_cors import CORS
 from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows - الـ locks بين الـ processes مش متاحة
 
 # Media Processing Imports
 import numpy as np
@@ -34,11 +50,7 @@ import PIL.Image
 if not hasattr(PIL.Image, 'ANTIALIAS'):
     PIL.Image.ANTIALIAS = PIL.Image.LANCZOS
 
-from moviepy.editor import (
-    ImageClip, VideoFileClip, AudioFileClip, 
-    CompositeVideoClip, ColorClip, concatenate_videoclips
-)
-from moviepy.audio.AudioClip import concatenate_audioclips
+from moviepy.editor import ImageClip, VideoFileClip, VideoClip, ColorClip
 from moviepy.config import change_settings
 from proglog import ProgressBarLogger
 from pydub import AudioSegment
@@ -49,13 +61,14 @@ from deep_translator import GoogleTranslator
 # ==========================================
 
 # فلتر تحسين الصوت (بدون extrastereo عشان ميسببش صدى)
-STUDIO_DRY_FILTER = (
+STUDIO_PRE_FILTER = (
     "highpass=f=60, "
     "equalizer=f=200:width_type=h:width=200:g=3, "
     "equalizer=f=8000:width_type=h:width=1000:g=2, "
-    "acompressor=threshold=-21dB:ratio=4:attack=200:release=1000, "
-    "loudnorm=I=-16:TP=-1.5:LRA=11"
+    "acompressor=threshold=-21dB:ratio=4:attack=200:release=1000"
 )
+LOUDNORM_TARGET = "I=-16:TP=-1.5:LRA=11"
+STUDIO_DRY_FILTER = f"{STUDIO_PRE_FILTER}, loudnorm={LOUDNORM_TARGET}"
 
 
 def app_dir():
@@ -72,6 +85,7 @@ LOCAL_BGS_DIR = os.path.join(BUNDLE_DIR, "local_bgs")
 os.makedirs(LOCAL_BGS_DIR, exist_ok=True)
 
 FFMPEG_EXE = "ffmpeg"
+FFPROBE_EXE = "ffprobe"
 os.environ["FFMPEG_BINARY"] = FFMPEG_EXE
 
 try:
@@ -127,23 +141,199 @@ os.makedirs(VISION_DIR, exist_ok=True)
 # 🗄️ Database Setup (SQLite for Persistence)
 # ==========================================
 DB_PATH = os.path.join(EXEC_DIR, "quran_jobs.db")
+DB_BUSY_TIMEOUT = 10.0          # ثواني - SQLite بيستنى الـ lock قبل ما يرمي busy
+DB_RETRY_ATTEMPTS = 5           # إعادة المحاولة لو فضل "database is locked" بعد الـ timeout
+DB_STATEMENT_CACHE = 256        # prepared statements محفوظة لكل connection
+_db_local = threading.local()
+
+def db_connection():
+    """
+    connection واحد لكل thread (بيتفتح مرة ويفضل مفتوح)
+    WAL = القراية مش بتستنى الكتابة، و synchronous=NORMAL كفاية مع WAL
+    autocommit: كل statement لوحده transaction، والعمليات المركبة بتستخدم db_transaction
+    """
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or getattr(_db_local, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, isolation_level=None,
+                               cached_statements=DB_STATEMENT_CACHE)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+        _db_local.conn, _db_local.pid = conn, os.getpid()
+    return conn
+
+def _is_busy(err):
+    msg = str(err).lower()
+    return 'locked' in msg or 'busy' in msg
+
+def _with_retry(fn):
+    for attempt in range(1, DB_RETRY_ATTEMPTS + 1):
+        try:
+            return fn()
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or attempt == DB_RETRY_ATTEMPTS:
+                raise
+            print(f"[WARNING] SQLite busy ({e}), retry {attempt}/{DB_RETRY_ATTEMPTS}")
+            time.sleep(0.05 * (2 ** attempt))
+
+def db_execute(sql, params=(), many=False):
+    """كتابة (INSERT/UPDATE/DELETE) - يرجع عدد الصفوف المتأثرة"""
+    conn = db_connection()
+    if conn.in_transaction:
+        # ✅ جوه db_transaction مفتوحة: جزء منها (من غير BEGIN تاني ولا retry لوحده)
+        return (conn.executemany if many else conn.execute)(sql, params).rowcount
+    if many:
+        return _with_retry(lambda: db_transaction_run(lambda c: c.executemany(sql, params).rowcount))
+    return _with_retry(lambda: conn.execute(sql, params).rowcount)
+
+def db_query(sql, params=(), one=False):
+    """قراية - list of dicts (أو dict واحد / None لو one=True)"""
+    conn = db_connection()
+    def run():
+        cur = conn.execute(sql, params)
+        if one:
+            row = cur.fetchone()
+            return dict(row) if row else None
+        return [dict(row) for row in cur.fetchall()]
+    return _with_retry(run)
+
+class db_transaction:
+    """
+    with db_transaction() as conn: ... - كذا statement في transaction واحدة
+    BEGIN IMMEDIATE بياخد write lock من الأول (مفيش deadlock لما read تتحول write)
+    """
+
+    def __enter__(self):
+        self.conn = db_connection()
+        _with_retry(lambda: self.conn.execute("BEGIN IMMEDIATE"))
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            _with_retry(lambda: self.conn.execute("COMMIT"))
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
+
+def db_transaction_run(fn):
+    with db_transaction() as conn:
+        return fn(conn)
 
 def get_db():
     """Get database connection for current request"""
     if 'db' not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
+        g.db = db_connection()
     return g.db
 
 def close_db(exception):
-    """Close database connection at end of request"""
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    """Release request connection (الـ connection نفسه بيفضل مفتوح للـ thread)"""
+    g.pop('db', None)
+
+# ==========================================
+# 🧬 Schema Migrations - مرقمة بـ PRAGMA user_version
+# ==========================================
+def _add_missing_columns(conn):
+    """الأعمدة اللي اتضافت بعد أول نسخة (الداتابيز القديمة ممكن يكون فيها بعضها)"""
+    added = {
+        'jobs': [('session_id', 'TEXT')],
+        'history': [('session_id', 'TEXT')],
+        'batch_items': [('output_path', 'TEXT'), ('error', 'TEXT'), ('video_started_at', 'REAL')],
+        'batch_jobs': [('avg_video_time', 'REAL')],
+    }
+    for table, columns in added.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, col_type in columns:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+                print(f"✅ Added {name} to {table} table")
+
+# (version, الوصف, الخطوات) - كل migration بتتنفذ مرة واحدة في transaction مع رفع user_version
+# ممنوع تعديل migration قديمة - أي تغيير جديد = migration جديدة برقم أكبر
+MIGRATIONS = [
+    (1, "legacy columns", [_add_missing_columns]),
+    (2, "indexes for hot access paths", [
+        # /api/my-jobs و /api/history (session + أحدث الأول)
+        "CREATE INDEX IF NOT EXISTS idx_jobs_session_created ON jobs(session_id, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_history_session_created ON history(session_id, created_at DESC)",
+        # recovery / cleanup / health
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_history_created ON history(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_history_job ON history(job_id)",
+        # batch status + join الـ /api/batch/list (jobs → batch_items → batch_jobs)
+        "CREATE INDEX IF NOT EXISTS idx_batch_items_batch_position ON batch_items(batch_id, position)",
+        "CREATE INDEX IF NOT EXISTS idx_batch_items_job ON batch_items(job_id)",
+        "CREATE INDEX IF NOT EXISTS idx_batch_jobs_status ON batch_jobs(status)",
+        "CREATE INDEX IF NOT EXISTS idx_batch_jobs_created ON batch_jobs(created_at DESC)",
+    ]),
+    (3, "batch versions for ETag / since", [
+        # version الباتش بيزيد مع أي تغيير فيه أو في items بتاعته أو في progress الـ jobs بتاعتها
+        # وكل item بياخد version الباتش وقت آخر تغيير (للـ ?since=)
+        "ALTER TABLE batch_jobs ADD COLUMN version INTEGER DEFAULT 0",
+        "ALTER TABLE batch_items ADD COLUMN version INTEGER DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_batch_items_batch_version ON batch_items(batch_id, version)",
+        '''CREATE TRIGGER IF NOT EXISTS trg_batch_jobs_version AFTER UPDATE ON batch_jobs
+           WHEN NEW.version = OLD.version
+           BEGIN
+               UPDATE batch_jobs SET version = version + 1 WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_batch_items_version AFTER UPDATE OF status, output_path, error, video_started_at ON batch_items
+           BEGIN
+               UPDATE batch_jobs SET version = version + 1 WHERE id = NEW.batch_id;
+               UPDATE batch_items SET version = (SELECT version FROM batch_jobs WHERE id = NEW.batch_id) WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_jobs_batch_version AFTER UPDATE OF percent, status, output_path ON jobs
+           BEGIN
+               UPDATE batch_jobs SET version = version + 1 WHERE id IN (SELECT batch_id FROM batch_items WHERE job_id = NEW.id);
+               UPDATE batch_items SET version = (SELECT version FROM batch_jobs b WHERE b.id = batch_items.batch_id) WHERE job_id = NEW.id;
+           END''',
+    ]),
+    (4, "shared state for multiple workers", [
+        # الـ YouTube tokens كانت dict في الذاكرة - كل worker كان شايف tokens مختلفة
+        '''CREATE TABLE IF NOT EXISTS youtube_tokens (
+            session_id TEXT PRIMARY KEY,
+            data_json TEXT NOT NULL,
+            updated_at REAL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_batch_jobs_status_created ON batch_jobs(status, created_at)",
+    ]),
+    (5, "render worker leases", [
+        # الـ job اللي في RENDER_MODE=queue بيستنى worker (python main.py worker) ياخده بـ lease
+        "ALTER TABLE jobs ADD COLUMN lease_owner TEXT",
+        "ALTER TABLE jobs ADD COLUMN lease_expires REAL",
+        "ALTER TABLE jobs ADD COLUMN attempts INTEGER DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_lease ON jobs(lease_expires) WHERE lease_owner IS NOT NULL",
+    ]),
+    (6, "preview backgrounds", [
+        # خلفيات المعاينة - الرندر الكامل ممكن يشتغل في process تانية فمش هيلاقيها في الـ RAM
+        "ALTER TABLE jobs ADD COLUMN bg_pool_json TEXT",
+    ]),
+    (7, "inline job runner", [
+        # الـ process اللي بترندر الـ job (host:pid) - لو الـ leader مات الـ leader الجديد يعرف jobs مين اتيتمت
+        "ALTER TABLE jobs ADD COLUMN runner TEXT",
+    ]),
+]
+
+def run_migrations(conn):
+    """تنفيذ الـ migrations الناقصة بالترتيب (آمن لو أكتر من process بيشغله مع بعض)"""
+    for version, description, steps in MIGRATIONS:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+            continue
+        with db_transaction() as tx:
+            # نقرا الـ version تاني جوه الـ write lock - ممكن process تانية تكون سبقتنا
+            if tx.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            for step in steps:
+                if callable(step): step(tx)
+                else: tx.execute(step)
+            tx.execute(f"PRAGMA user_version = {version}")
+        print(f"✅ Migration {version} applied: {description}")
 
 def init_db():
     """Initialize database tables with session support"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connection()
     c = conn.cursor()
     
     # Jobs table - for persistence across restarts (مع دعم session_id)
@@ -211,157 +401,174 @@ def init_db():
         FOREIGN KEY (job_id) REFERENCES jobs(id)
     )''')
     
-    # Migration: إضافة session_id للجداول القديمة لو مش موجودة
-    try:
-        c.execute("SELECT session_id FROM jobs LIMIT 1")
-    except sqlite3.OperationalError:
-        c.execute("ALTER TABLE jobs ADD COLUMN session_id TEXT")
-        print("✅ Added session_id to jobs table")
-    
-    try:
-        c.execute("SELECT session_id FROM history LIMIT 1")
-    except sqlite3.OperationalError:
-        c.execute("ALTER TABLE history ADD COLUMN session_id TEXT")
-        print("✅ Added session_id to history table")
-    
-    # Migration: إضافة output_path و error لـ batch_items
-    try:
-        c.execute("SELECT output_path FROM batch_items LIMIT 1")
-    except sqlite3.OperationalError:
-        c.execute("ALTER TABLE batch_items ADD COLUMN output_path TEXT")
-        print("✅ Added output_path to batch_items table")
-    
-    try:
-        c.execute("SELECT error FROM batch_items LIMIT 1")
-    except sqlite3.OperationalError:
-        c.execute("ALTER TABLE batch_items ADD COLUMN error TEXT")
-        print("✅ Added error to batch_items table")
-    
-    # Migration: إضافة video_started_at لـ batch_items
-    try:
-        c.execute("SELECT video_started_at FROM batch_items LIMIT 1")
-    except sqlite3.OperationalError:
-        c.execute("ALTER TABLE batch_items ADD COLUMN video_started_at REAL")
-        print("✅ Added video_started_at to batch_items table")
+    # Translations table - كاش ترجمة بحث الخلفيات (+ قرار الـ whitelist)
+    c.execute('''CREATE TABLE IF NOT EXISTS translations (
+        query_key TEXT PRIMARY KEY,
+        source_text TEXT,
+        translated TEXT,
+        is_safe INTEGER,
+        whitelist_version TEXT,
+        created_at REAL,
+        hits INTEGER DEFAULT 0
+    )''')
     
-    # Migration: إضافة avg_video_time لـ batch_jobs
-    try:
-        c.execute("SELECT avg_video_time FROM batch_jobs LIMIT 1")
-    except sqlite3.OperationalError:
-        c.execute("ALTER TABLE batch_jobs ADD COLUMN avg_video_time REAL")
-        print("✅ Added avg_video_time to batch_jobs table")
+    # Local backgrounds table - فهرس مكتبة الخلفيات المحلية (بيانات ffprobe)
+    c.execute('''CREATE TABLE IF NOT EXISTS local_backgrounds (
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime REAL,
+        width INTEGER,
+        height INTEGER,
+        duration REAL,
+        fps REAL,
+        codec TEXT,
+        tags TEXT,
+        probed_at REAL
+    )''')
     
-    conn.commit()
-    conn.close()
+    run_migrations(conn)
     print("✅ Database initialized successfully!")
 
 def db_create_job(job_id, workspace, config=None, session_id=None):
     """Create a new job in database with session support"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''INSERT INTO jobs (id, status, percent, created_at, workspace, config_json, session_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?)''', 
-              (job_id, 'pending', 0, time.time(), workspace, json.dumps(config) if config else None, session_id))
-    conn.commit()
-    conn.close()
+    db_execute('''INSERT INTO jobs (id, status, percent, created_at, workspace, config_json, session_id)
+                  VALUES (?, ?, ?, ?, ?, ?, ?)''',
+               (job_id, 'pending', 0, time.time(), workspace, json.dumps(config) if config else None, session_id))
 
 def db_update_job(job_id, **kwargs):
     """Update job in database"""
     if not kwargs:
         return
-    
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    set_clause = ', '.join([f"{k} = ?" for k in kwargs.keys()])
-    values = list(kwargs.values()) + [job_id]
-    
-    c.execute(f"UPDATE jobs SET {set_clause} WHERE id = ?", values)
-    conn.commit()
-    conn.close()
+    # ترتيب ثابت للأعمدة = نفس نص الـ SQL = نفس الـ prepared statement من الكاش
+    keys = sorted(kwargs)
+    set_clause = ', '.join([f"{k} = ?" for k in keys])
+    values = [kwargs[k] for k in keys] + [job_id]
+    sql = f"UPDATE jobs SET {set_clause} WHERE id = ?"
+    owner = JOB_LEASES.get(job_id)
+    if owner:
+        # ✅ الـ lease راح لـ worker تاني: مانكتبش فوق شغله (status / error / output)
+        sql += " AND lease_owner = ?"
+        values.append(owner)
+    if not db_execute(sql, values):
+        return
+    if 'status' in kwargs:
+        publish_job(job_id)
 
 def db_get_job(job_id):
     """Get job from database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
-    row = c.fetchone()
-    conn.close()
-    
-    if row:
-        return dict(row)
-    return None
+    return db_query("SELECT * FROM jobs WHERE id = ?", (job_id,), one=True)
 
 def db_get_all_jobs(status=None, limit=50):
     """Get all jobs, optionally filtered by status"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
     if status:
-        c.execute("SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?", (status, limit))
-    else:
-        c.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
-    
-    rows = c.fetchall()
-    conn.close()
-    
-    return [dict(row) for row in rows]
+        return db_query("SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?", (status, limit))
+    return db_query("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
 
 def db_get_pending_jobs():
-    """Get all pending/processing jobs for recovery"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM jobs WHERE status IN ('pending', 'processing')")
-    rows = c.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    """Get all pending/processing jobs for recovery (مش اللي مع render worker)"""
+    return db_query("SELECT * FROM jobs WHERE status IN ('pending', 'processing') AND lease_owner IS NULL")
+
+# ==========================================
+# 🏭 Render Queue - jobs بتستنى render worker (claim / lease / heartbeat)
+# ==========================================
+# inline = الـ API بيرندر في threads (زي الأول) | queue = الـ API بيحط الـ job في الـ queue بس
+RENDER_MODE = os.environ.get('RENDER_MODE', 'inline')
+JOB_LEASE_SECONDS = 60          # الـ worker لازم يجدد قبل كده وإلا الـ job يرجع للـ queue
+JOB_HEARTBEAT_INTERVAL = 15
+JOB_MAX_ATTEMPTS = 3            # بعدها الـ job بيبقى error (مايفضلش يوقع workers)
+JOB_QUEUE_TIMEOUT = int(os.environ.get('JOB_QUEUE_TIMEOUT', 600))  # job الباتش في الـ queue ومفيش worker أخده
+JOB_LEASES = {}                 # job_id -> owner: الـ render worker بيكتب على الـ job بس طول ما الـ lease معاه
+
+def runner_id(pid=None):
+    """اسم الـ process في الـ jobs (runner / lease_owner) - host:pid"""
+    return f"{socket.gethostname()}:{pid or os.getpid()}"
+
+def db_get_orphaned_jobs(runner):
+    """jobs فردية (مش باتش ومش مع render worker) كانت شغالة في process ماتت (runner بالظبط أو pattern بـ LIKE)"""
+    return db_query('''SELECT * FROM jobs WHERE runner LIKE ? AND status IN ('pending', 'processing', 'cancelling')
+                       AND lease_owner IS NULL
+                       AND NOT EXISTS (SELECT 1 FROM batch_items bi WHERE bi.job_id = jobs.id)''', (runner,))
+
+def pid_alive(pid):
+    """الـ process لسه عايشة على الجهاز ده؟"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # عايشة بس مش بتاعتنا
+    return True
+
+def db_queue_job(job_id, **kwargs):
+    """الـ job جاهز لأي render worker"""
+    db_update_job(job_id, status='queued', lease_owner=None, lease_expires=None, **kwargs)
+
+def db_claim_job(owner):
+    """أقدم job في الـ queue -> processing بـ lease (BEGIN IMMEDIATE = worker واحد بس ياخده)"""
+    with db_transaction() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+        if not row:
+            return None
+        conn.execute('''UPDATE jobs SET status = 'processing', lease_owner = ?, lease_expires = ?,
+                        attempts = COALESCE(attempts, 0) + 1 WHERE id = ?''',
+                     (owner, time.time() + JOB_LEASE_SECONDS, row['id']))
+        return dict(row)
+
+def db_renew_lease(job_id, owner):
+    """heartbeat - False لو الـ lease راح لحد تاني (انتهى واتاخد)"""
+    return db_execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ?",
+                      (time.time() + JOB_LEASE_SECONDS, job_id, owner)) > 0
+
+def db_release_lease(job_id, owner):
+    db_execute("UPDATE jobs SET lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ?", (job_id, owner))
+
+def db_release_expired_leases():
+    """workers ماتت أو وقفت: الـ job يرجع للـ queue (أو error بعد JOB_MAX_ATTEMPTS، أو cancelled لو اتلغى)"""
+    now = time.time()
+    with db_transaction() as conn:
+        failed = conn.execute('''UPDATE jobs SET status = 'error', error = 'Render worker lost (lease expired)',
+                                 lease_owner = NULL, lease_expires = NULL
+                                 WHERE lease_owner IS NOT NULL AND lease_expires < ?
+                                 AND status NOT IN ('complete', 'error', 'cancelled') AND attempts >= ?''',
+                              (now, JOB_MAX_ATTEMPTS)).rowcount
+        requeued = conn.execute('''UPDATE jobs SET status = CASE WHEN should_stop THEN 'cancelled' ELSE 'queued' END,
+                                   percent = 0, lease_owner = NULL, lease_expires = NULL
+                                   WHERE lease_owner IS NOT NULL AND lease_expires < ?
+                                   AND status NOT IN ('complete', 'error', 'cancelled')''',
+                                (now,)).rowcount
+    return requeued, failed
+
+def db_expire_leases(owner):
+    """الـ worker بيقفل: الـ leases بتاعته تنتهي دلوقتي عشان ترجع للـ queue على طول"""
+    db_execute("UPDATE jobs SET lease_expires = 0 WHERE lease_owner = ?", (owner,))
 
 def db_add_history(job_id, title, reciter, surah, start_ayah, end_ayah, quality, fps, filename, session_id=None):
     """Add entry to history with session support"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''INSERT INTO history (job_id, title, reciter, surah, start_ayah, end_ayah, quality, fps, download_filename, created_at, session_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-              (job_id, title, reciter, surah, start_ayah, end_ayah, quality, fps, filename, time.time(), session_id))
-    conn.commit()
-    conn.close()
+    db_execute('''INSERT INTO history (job_id, title, reciter, surah, start_ayah, end_ayah, quality, fps, download_filename, created_at, session_id)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+               (job_id, title, reciter, surah, start_ayah, end_ayah, quality, fps, filename, time.time(), session_id))
 
 def db_get_history(limit=20, session_id=None):
     """Get history entries filtered by session"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
     if session_id:
         # فلترة حسب session_id
-        c.execute('''SELECT h.*, j.output_path, j.status 
-                     FROM history h 
-                     LEFT JOIN jobs j ON h.job_id = j.id 
-                     WHERE h.session_id = ?
-                     ORDER BY h.created_at DESC LIMIT ?''', (session_id, limit))
-    else:
-        # بدون فلترة (للتوافق مع الإصدارات القديمة)
-        c.execute('''SELECT h.*, j.output_path, j.status 
-                     FROM history h 
-                     LEFT JOIN jobs j ON h.job_id = j.id 
-                     ORDER BY h.created_at DESC LIMIT ?''', (limit,))
-    
-    rows = c.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+        return db_query('''SELECT h.*, j.output_path, j.status 
+                           FROM history h 
+                           LEFT JOIN jobs j ON h.job_id = j.id 
+                           WHERE h.session_id = ?
+                           ORDER BY h.created_at DESC LIMIT ?''', (session_id, limit))
+    # بدون فلترة (للتوافق مع الإصدارات القديمة)
+    return db_query('''SELECT h.*, j.output_path, j.status 
+                       FROM history h 
+                       LEFT JOIN jobs j ON h.job_id = j.id 
+                       ORDER BY h.created_at DESC LIMIT ?''', (limit,))
 
 def db_cleanup_old_jobs(hours=24):
     """Clean up jobs older than specified hours"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     threshold = time.time() - (hours * 3600)
     
     # Get old completed jobs
-    c.execute("SELECT id, workspace, output_path FROM jobs WHERE created_at < ? AND status IN ('complete', 'error', 'cancelled')", (threshold,))
-    old_jobs = c.fetchall()
+    old_jobs = db_query("SELECT id, workspace, output_path FROM jobs WHERE created_at < ? AND status IN ('complete', 'error', 'cancelled')", (threshold,))
     
     # Clean up files
     for job in old_jobs:
@@ -380,90 +587,128 @@ def db_cleanup_old_jobs(hours=24):
                 pass
     
     # Delete from database
-    c.execute("DELETE FROM jobs WHERE created_at < ? AND status IN ('complete', 'error', 'cancelled')", (threshold,))
-    c.execute("DELETE FROM history WHERE created_at < ?", (threshold,))
-    
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM jobs WHERE created_at < ? AND status IN ('complete', 'error', 'cancelled')", (threshold,))
+        conn.execute("DELETE FROM history WHERE created_at < ?", (threshold,))
     print(f"🧹 Cleaned up {len(old_jobs)} old jobs and their video files")
 
 # ==========================================
 # 📦 Batch Job Management Functions
 # ==========================================
 
-def db_create_batch(batch_id, total_jobs, config):
+def db_create_batch(batch_id, total_jobs, config, status='pending'):
     """Create a new batch job in database"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''INSERT INTO batch_jobs (id, status, total_jobs, completed_jobs, failed_jobs, config_json, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)''', 
-              (batch_id, 'pending', total_jobs, 0, 0, json.dumps(config), time.time()))
-    conn.commit()
-    conn.close()
+    db_execute('''INSERT INTO batch_jobs (id, status, total_jobs, completed_jobs, failed_jobs, config_json, created_at)
+                  VALUES (?, ?, ?, ?, ?, ?, ?)''',
+               (batch_id, status, total_jobs, 0, 0, json.dumps(config), time.time()))
 
 def db_update_batch(batch_id, **kwargs):
     """Update batch job in database"""
     if not kwargs:
         return
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    set_clause = ', '.join([f"{k} = ?" for k in kwargs.keys()])
-    values = list(kwargs.values()) + [batch_id]
-    c.execute(f"UPDATE batch_jobs SET {set_clause} WHERE id = ?", values)
-    conn.commit()
-    conn.close()
+    keys = sorted(kwargs)
+    set_clause = ', '.join([f"{k} = ?" for k in keys])
+    values = [kwargs[k] for k in keys] + [batch_id]
+    db_execute(f"UPDATE batch_jobs SET {set_clause} WHERE id = ?", values)
+    publish_batch(batch_id)
 
 def db_get_batch(batch_id):
     """Get batch job from database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM batch_jobs WHERE id = ?", (batch_id,))
-    row = c.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    return db_query("SELECT * FROM batch_jobs WHERE id = ?", (batch_id,), one=True)
 
 def db_add_batch_item(batch_id, job_id, position, surah, start_ayah, end_ayah):
     """Add an item to batch"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''INSERT INTO batch_items (batch_id, job_id, position, surah, start_ayah, end_ayah, status, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-              (batch_id, job_id, position, surah, start_ayah, end_ayah, 'pending', time.time()))
-    conn.commit()
-    conn.close()
+    db_execute('''INSERT INTO batch_items (batch_id, job_id, position, surah, start_ayah, end_ayah, status, created_at)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+               (batch_id, job_id, position, surah, start_ayah, end_ayah, 'pending', time.time()))
 
 def db_update_batch_item(batch_id, job_id, **kwargs):
     """Update batch item"""
     if not kwargs:
         return
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    set_clause = ', '.join([f"{k} = ?" for k in kwargs.keys()])
-    values = list(kwargs.values()) + [batch_id, job_id]
-    c.execute(f"UPDATE batch_items SET {set_clause} WHERE batch_id = ? AND job_id = ?", values)
-    conn.commit()
-    conn.close()
+    keys = sorted(kwargs)
+    set_clause = ', '.join([f"{k} = ?" for k in keys])
+    values = [kwargs[k] for k in keys] + [batch_id, job_id]
+    db_execute(f"UPDATE batch_items SET {set_clause} WHERE batch_id = ? AND job_id = ?", values)
+    publish_batch(batch_id)
 
 def db_get_batch_items(batch_id):
     """Get all items in a batch"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM batch_items WHERE batch_id = ? ORDER BY position", (batch_id,))
-    rows = c.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return db_query("SELECT * FROM batch_items WHERE batch_id = ? ORDER BY position", (batch_id,))
+
+def db_get_batch_items_with_jobs(batch_id, since=None):
+    """Batch items + job progress في query واحدة (اختياري: اللي اتغير بعد version معين بس)"""
+    sql = '''SELECT bi.*, j.percent AS job_percent, j.output_path AS job_output_path
+             FROM batch_items bi
+             LEFT JOIN jobs j ON j.id = bi.job_id
+             WHERE bi.batch_id = ?'''
+    params = [batch_id]
+    if since is not None:
+        sql += " AND bi.version > ?"
+        params.append(since)
+    return db_query(sql + " ORDER BY bi.position", params)
+
+def db_get_processing_batch_item(batch_id):
+    """الـ item اللي شغال دلوقتي في الباتش (صف واحد - من غير ما نجيب كل الـ items)"""
+    return db_query('''SELECT position, surah, start_ayah, video_started_at FROM batch_items
+                       WHERE batch_id = ? AND status = 'processing' ORDER BY position LIMIT 1''',
+                    (batch_id,), one=True)
 
 def db_get_pending_batches():
     """Get all pending/running batches"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM batch_jobs WHERE status IN ('pending', 'running')")
-    rows = c.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return db_query("SELECT * FROM batch_jobs WHERE status IN ('pending', 'running')")
+
+def db_get_queued_batches(limit):
+    """قائمة انتظار الباتشات = الـ pending في SQLite بترتيب الإنشاء (مشتركة بين الـ workers)"""
+    return db_query("SELECT id FROM batch_jobs WHERE status = 'pending' ORDER BY created_at LIMIT ?", (limit,))
+
+def db_claim_batch(batch_id):
+    """pending -> running بشكل atomic - بيرجع False لو حد تاني أخده أو اتلغى"""
+    claimed = db_execute("UPDATE batch_jobs SET status = 'running', started_at = ? WHERE id = ? AND status = 'pending'",
+                         (time.time(), batch_id))
+    if claimed:
+        publish_batch(batch_id)
+    return claimed > 0
+
+def db_get_youtube_token(session_id):
+    row = db_query("SELECT data_json FROM youtube_tokens WHERE session_id = ?", (session_id,), one=True)
+    return json.loads(row['data_json']) if row else None
+
+def db_save_youtube_token(session_id, data):
+    db_execute('''INSERT INTO youtube_tokens (session_id, data_json, updated_at) VALUES (?, ?, ?)
+                  ON CONFLICT(session_id) DO UPDATE SET data_json = excluded.data_json, updated_at = excluded.updated_at''',
+               (session_id, json.dumps(data), time.time()))
+
+def db_delete_youtube_token(session_id):
+    db_execute("DELETE FROM youtube_tokens WHERE session_id = ?", (session_id,))
+
+def db_get_translation(query_key):
+    """Get cached translation (+ whitelist decision) for a normalized query"""
+    row = db_query("SELECT * FROM translations WHERE query_key = ?", (query_key,), one=True)
+    if row:
+        db_execute("UPDATE translations SET hits = hits + 1 WHERE query_key = ?", (query_key,))
+    return row
+
+def db_save_translation(query_key, source_text, translated, is_safe, whitelist_version):
+    """Store a query translation with its whitelist decision"""
+    db_execute('''INSERT OR REPLACE INTO translations (query_key, source_text, translated, is_safe, whitelist_version, created_at, hits)
+                  VALUES (?, ?, ?, ?, ?, ?, COALESCE((SELECT hits FROM translations WHERE query_key = ?), 0))''',
+               (query_key, source_text, translated, int(is_safe), whitelist_version, time.time(), query_key))
+
+def db_get_local_backgrounds():
+    """All indexed local backgrounds"""
+    return db_query("SELECT * FROM local_backgrounds")
+
+def db_save_local_background(info):
+    """Insert or update a probed local background"""
+    db_execute('''INSERT OR REPLACE INTO local_backgrounds (path, size, mtime, width, height, duration, fps, codec, tags, probed_at)
+                  VALUES (:path, :size, :mtime, :width, :height, :duration, :fps, :codec, :tags, :probed_at)''', info)
+
+def db_delete_local_backgrounds(paths):
+    """Remove index rows for files that no longer exist"""
+    if not paths:
+        return
+    db_execute("DELETE FROM local_backgrounds WHERE path = ?", [(p,) for p in paths], many=True)
 
 # Data Constants
 VERSE_COUNTS = {1: 7, 2: 286, 3: 200, 4: 176, 5: 120, 6: 165, 7: 206, 8: 75, 9: 129, 10: 109, 11: 123, 12: 111, 13: 43, 14: 52, 15: 99, 16: 128, 17: 111, 18: 110, 19: 98, 20: 135, 21: 112, 22: 78, 23: 118, 24: 64, 25: 77, 26: 227, 27: 93, 28: 88, 29: 69, 30: 60, 31: 34, 32: 30, 33: 73, 34: 54, 35: 45, 36: 83, 37: 182, 38: 88, 39: 75, 40: 85, 41: 54, 42: 53, 43: 89, 44: 59, 45: 37, 46: 35, 47: 38, 48: 29, 49: 18, 50: 45, 51: 60, 52: 49, 53: 62, 54: 55, 55: 78, 56: 96, 57: 29, 58: 22, 59: 24, 60: 13, 61: 14, 62: 11, 63: 11, 64: 18, 65: 12, 66: 12, 67: 30, 68: 52, 69: 52, 70: 44, 71: 28, 72: 28, 73: 20, 74: 56, 75: 40, 76: 31, 77: 50, 78: 40, 79: 46, 80: 42, 81: 29, 82: 19, 83: 36, 84: 25, 85: 22, 86: 17, 87: 19, 88: 26, 89: 30, 90: 20, 91: 15, 92: 21, 93: 11, 94: 8, 95: 8, 96: 19, 97: 5, 98: 8, 99: 8, 100: 11, 101: 11, 102: 8, 103: 3, 104: 9, 105: 5, 106: 4, 107: 7, 108: 3, 109: 6, 110: 3, 111: 5, 112: 4, 113: 5, 114: 6}
@@ -554,6 +799,10 @@ MP3QURAN_IDS = {
 # 📁 مجلد تخزين التوقيتات
 TIMINGS_CACHE_DIR = os.path.join(EXEC_DIR, "cache_timings")
 
+# 📁 كاش سور mp3quran (الصوت + التوقيتات + قياس الـ loudness)
+MP3QURAN_CACHE_DIR = os.path.join(EXEC_DIR, "cache_mp3quran")
+MP3QURAN_CACHE_MAX_AGE = 24 * 3600  # الملفات اللي ماتستخدمتش من 24 ساعة بتتحذف
+
 # خريطة عكسية لتحويل الـ ID للاسم العربي
 RECITER_ID_TO_NAME = {v: k for k, v in OLD_RECITERS_MAP.items()}
 # إضافة أسماء القراء الجدد (الاسم العربي = الاسم العربي)
@@ -672,11 +921,17 @@ app = Flask(__name__, static_folder=EXEC_DIR)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
 # 🛡️ Rate Limiter - حماية من الإفراط في الطلبات
+# memory:// = عدادات لكل worker لوحده - مع أكتر من worker استخدم storage مشترك (مثلاً redis://)
+RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI', 'memory://')
+if RATELIMIT_STORAGE_URI.startswith('memory://') and int(os.environ.get('WEB_CONCURRENCY', '1') or 1) > 1:
+    print(f"⚠️ Rate limits use memory:// with {os.environ['WEB_CONCURRENCY']} workers - every limit is per worker "
+          f"(set RATELIMIT_STORAGE_URI to a shared storage, e.g. redis://)")
+
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://",  # تخزين في الذاكرة
+    storage_uri=RATELIMIT_STORAGE_URI,
 )
 
 app.teardown_appcontext(close_db)
@@ -684,80 +939,420 @@ app.teardown_appcontext(close_db)
 # ==========================================
 # 🧠 Job Management (RAM + SQLite for Persistence)
 # ==========================================
-JOBS = {}  # RAM cache for fast access
-JOBS_LOCK = threading.Lock()
+JOB_REGISTRY_MAX = 500        # أقصى عدد jobs منتهية في الـ RAM
+JOB_REGISTRY_TTL = 3600       # الـ job المنتهي بيفضل ساعة (المعاينة بتعيد استخدام bg_pool بتاعها)
+
+class JobRegistry:
+    """
+    RAM cache للـ jobs - SQLite هو المصدر الأساسي (get_job بيرجعله لو الـ job اتشال)
+    الـ jobs الشغالة مابتتشالش، والمنتهية بتتشال بعد JOB_REGISTRY_TTL أو لو العدد عدى JOB_REGISTRY_MAX
+    """
+
+    def __init__(self, max_finished=JOB_REGISTRY_MAX, ttl=JOB_REGISTRY_TTL):
+        self.max_finished = max_finished
+        self.ttl = ttl
+        self.jobs = {}
+        self.finished = OrderedDict()   # job_id -> وقت الانتهاء (الأقدم الأول)
+        self.active = 0                 # ✅ بيتحدث مع كل انتقال - /api/health مش بيلف على الـ jobs
+        self.lock = threading.Lock()
+
+    def _track(self, job_id, was_running, is_running, created=False):
+        # ✅ entry جديد منتهي من الأول (مثلاً الـ job خلص بعد cleanup_job) لازم يدخل finished برضه وإلا مابيتشالش
+        if (was_running or created) and not is_running:
+            if was_running:
+                self.active -= 1
+            self.finished[job_id] = time.time()
+            self.finished.move_to_end(job_id)
+        elif is_running and not was_running:
+            self.active += 1
+            self.finished.pop(job_id, None)
+
+    def add(self, job_id, job):
+        with self.lock:
+            old = self.jobs.get(job_id)
+            self.jobs[job_id] = job
+            self._track(job_id, bool(old and old.get('is_running')), bool(job.get('is_running')), created=old is None)
+            self._evict()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def update(self, job_id, create=False, **fields):
+        """تحديث الـ job لو موجود (أو إنشاؤه لو create) - بيرجع الـ dict أو None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            created = job is None
+            if created:
+                if not create:
+                    return None
+                job = self.jobs[job_id] = {'id': job_id}
+            was_running = bool(job.get('is_running'))
+            job.update(fields)
+            self._track(job_id, was_running, bool(job.get('is_running')), created=created)
+            self._evict()
+            return job
+
+    def pop(self, job_id):
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            if job is not None:
+                self._track(job_id, bool(job.get('is_running')), False)
+                self.finished.pop(job_id, None)
+            return job
+
+    def clear(self):
+        with self.lock:
+            self.jobs.clear()
+            self.finished.clear()
+            self.active = 0
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        while self.finished:
+            job_id, finished_at = next(iter(self.finished.items()))
+            if finished_at >= cutoff and len(self.finished) <= self.max_finished:
+                break
+            self.finished.popitem(last=False)
+            self.jobs.pop(job_id, None)
+            PROGRESS_WRITER.forget(job_id)
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            return {'active': self.active, 'cached': len(self.jobs)}
+
+    def __len__(self):
+        return len(self.jobs)
+
+JOBS = JobRegistry()
 
 # ==========================================
-def create_job(config=None, session_id=None):
-    """Create a new job - stores in RAM and SQLite with session support"""
+def create_job(config=None, session_id=None, track=True):
+    """
+    Create a new job - stores in RAM and SQLite with session support
+    track=False: الـ job هيشتغل في process تانية (الباتش عند الـ leader) - SQLite بس
+    """
     job_id = str(uuid.uuid4())
     job_dir = os.path.join(BASE_TEMP_DIR, job_id)
     os.makedirs(job_dir, exist_ok=True)
     
-    # Store in RAM for fast access
-    with JOBS_LOCK:
-        JOBS[job_id] = {
-            'id': job_id, 
-            'percent': 0, 
-            'status': 'pending', 
-            'eta': '--:--', 
-            'is_running': True, 
-            'is_complete': False, 
-            'output_path': None, 
-            'error': None, 
-            'should_stop': False, 
-            'created_at': time.time(), 
-            'workspace': job_dir,
-            'session_id': session_id
-        }
-    
     # Store in SQLite for persistence
     db_create_job(job_id, job_dir, config, session_id)
+    if not track:
+        return job_id
+    
+    # Store in RAM for fast access
+    JOBS.add(job_id, {
+        'id': job_id, 
+        'percent': 0, 
+        'status': 'pending', 
+        'eta': '--:--', 
+        'is_running': True, 
+        'is_complete': False, 
+        'output_path': None, 
+        'error': None, 
+        'should_stop': False, 
+        'created_at': time.time(), 
+        'workspace': job_dir,
+        'session_id': session_id
+    })
     
     return job_id
 
+# ==========================================
+# ✍️ Progress Writer - كتابة الـ progress في SQLite بالتجميع (write-behind)
+# ==========================================
+PROGRESS_FLUSH_INTERVAL = 1.0   # أقصى معدل كتابة لكل الـ jobs مع بعض
+# الحالات النهائية بتتكتب مباشرة (db_update_job) - الـ progress المتأخر مايرجعهاش
+TERMINAL_STATUSES = ('complete', 'error', 'cancelled', 'cancelling')
+# + queued: render worker قفل والـ job رجع للـ queue - progress قديم من الـ render اللي وقف مايرجعهوش processing
+PROGRESS_FROZEN_STATUSES = TERMINAL_STATUSES + ('queued',)
+
+class ProgressWriter:
+    """
+    آخر progress لكل job بيتحفظ في الذاكرة، و thread واحد بيكتب كل الـ jobs
+    في transaction واحدة كل PROGRESS_FLUSH_INTERVAL - ولو المرحلة اتغيرت بيكتب فوراً
+    """
+
+    def __init__(self, interval=PROGRESS_FLUSH_INTERVAL):
+        self.interval = interval
+        self.pending = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def stage_of(status):
+        """المرحلة = الـ status من غير أرقام ("Processing Ayah 3..." و "4..." نفس المرحلة)"""
+        return re.sub(r'[\d٠-٩]+', '', status or '').strip()
+
+    def submit(self, job_id, percent, status, eta=None):
+        stage = self.stage_of(status)
+        with self.lock:
+            urgent = self.stages.get(job_id) != stage or percent >= 100
+            self.stages[job_id] = stage
+            prev_eta = self.pending.get(job_id, {}).get('eta')
+            self.pending[job_id] = {'percent': percent, 'status': status, 'eta': eta or prev_eta}
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name="progress-writer")
+                self.thread.start()
+        if urgent:
+            self.wake.set()
+
+    def forget(self, job_id):
+        """الـ job خلص - من غير كده stages بتكبر مع كل job"""
+        with self.lock:
+            self.pending.pop(job_id, None)
+            self.stages.pop(job_id, None)
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        rows = [(d['percent'], d['status'], d['eta'], job_id) for job_id, d in batch.items()]
+        placeholders = ', '.join('?' * len(PROGRESS_FROZEN_STATUSES))
+        try:
+            with db_transaction() as conn:
+                conn.executemany(
+                    f"UPDATE jobs SET percent = ?, status = ?, eta = COALESCE(?, eta) "
+                    f"WHERE id = ? AND status NOT IN ({placeholders})",
+                    [row + PROGRESS_FROZEN_STATUSES for row in rows]
+                )
+        except sqlite3.Error as e:
+            print(f"[WARNING] Progress flush failed: {e}")
+            with self.lock:
+                # نرجعهم من غير ما نغطي على أحدث قيم وصلت
+                for job_id, d in batch.items():
+                    self.pending.setdefault(job_id, d)
+            return 0
+        return len(rows)
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+PROGRESS_WRITER = ProgressWriter()
+atexit.register(PROGRESS_WRITER.flush)
+
+# ==========================================
+# 📡 Event Bus - push للـ progress (SSE) بدل الـ polling
+# ==========================================
+SSE_KEEPALIVE = 15          # ثواني - comment فاضي عشان الـ proxies ونعرف إن العميل قفل
+SSE_BATCH_INTERVAL = 1.0    # أقل فترة بين snapshots الباتش وقت progress الـ jobs
+SSE_REMOTE_POLL = 1.0       # الـ job/الباتش شغال في worker تاني: الـ stream بيقرا SQLite بالمعدل ده
+# كل stream ماسك thread من الـ worker طول ما هو مفتوح - الباقي للـ requests العادية
+# (start.sh بيظبطه على نص الـ threads)
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 8))
+SSE_STREAMS = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+JOB_FINAL_STATUSES = ('complete', 'error', 'cancelled')
+BATCH_FINAL_STATUSES = ('complete', 'error', 'cancelled')
+
+class EventSubscription:
+    """مشترك واحد - آخر قيمة لكل (topic, event) بس (العميل البطيء مايكدسش events)"""
+
+    def __init__(self, bus, topics):
+        self.bus = bus
+        self.topics = topics
+        self.pending = {}
+        self.cond = threading.Condition()
+
+    def push(self, topic, event, data):
+        with self.cond:
+            self.pending[(topic, event)] = data
+            self.cond.notify()
+
+    def get(self, timeout):
+        """[(topic, event, data), ...] - أو [] لو الـ timeout خلص من غير جديد"""
+        with self.cond:
+            if not self.pending:
+                self.cond.wait(timeout)
+            events, self.pending = self.pending, {}
+        return [(topic, event, data) for (topic, event), data in events.items()]
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+class EventBus:
+    """pub/sub جوه الـ process - topics زي job:<id> و batch:<id>"""
+
+    def __init__(self):
+        self.topics = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, *topics):
+        sub = EventSubscription(self, topics)
+        with self.lock:
+            for topic in topics:
+                self.topics.setdefault(topic, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            for topic in sub.topics:
+                subs = self.topics.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self.topics[topic]
+
+    def watching(self, topic):
+        """⚡ check رخيص قبل ما نبني الـ payload - مفيش مشتركين = مفيش شغل"""
+        return topic in self.topics
+
+    def publish(self, topic, event, data=None):
+        with self.lock:
+            subs = list(self.topics.get(topic, ()))
+        for sub in subs:
+            sub.push(topic, event, data)
+
+EVENT_BUS = EventBus()
+
+def job_payload(job):
+    """نفس شكل /api/progress"""
+    job = dict(job)
+    if job.get('status') == 'complete' and job.get('output_path'):
+        job['download_url'] = f"/api/download?jobId={job['id']}"
+        job['preview_url'] = f"/api/preview?jobId={job['id']}"
+    return job
+
+def publish_job(job_id):
+    """يبعت snapshot الـ job للي متابعينه (لو فيه)"""
+    if not EVENT_BUS.watching(f"job:{job_id}"):
+        return
+    job = get_job(job_id)
+    if job:
+        EVENT_BUS.publish(f"job:{job_id}", 'progress', job_payload(job))
+
+def publish_batch(batch_id):
+    """الباتش اتغير - الـ stream بيبني snapshot جديد من SQLite"""
+    if EVENT_BUS.watching(f"batch:{batch_id}"):
+        EVENT_BUS.publish(f"batch:{batch_id}", 'batch')
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str, ensure_ascii=False)}\n\n"
+
+def sse_response(events):
+    """
+    response الـ SSE - أو 503 لو الـ streams المفتوحة وصلت SSE_MAX_STREAMS
+    (الـ EventSource بيقفل على 503 والواجهة بترجع للـ polling)
+    """
+    if not SSE_STREAMS.acquire(blocking=False):
+        return jsonify({'error': 'Too many open streams'}), 503, {'Retry-After': '30'}
+    response = app.response_class(stream_with_context(events()), mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # ✅ call_on_close بيتنادى حتى لو العميل قفل قبل أول event (الـ finally بتاع الـ generator لأ)
+    response.call_on_close(SSE_STREAMS.release)
+    return response
+
 def update_job_status(job_id, percent, status, eta=None):
-    """Update job status - RAM + SQLite"""
-    with JOBS_LOCK:
-        if job_id in JOBS:
-            JOBS[job_id]['percent'] = percent
-            JOBS[job_id]['status'] = status
-            if eta: JOBS[job_id]['eta'] = eta
-    
-    # Update in SQLite ( throttled - every 5% or on completion)
-    if percent % 5 == 0 or percent >= 100 or 'complete' in status.lower() or 'error' in status.lower():
-        db_data = {'percent': percent, 'status': status}
-        if eta:
-            db_data['eta'] = eta
-        db_update_job(job_id, **db_data)
+    """Update job status - RAM فوراً، و SQLite عن طريق PROGRESS_WRITER"""
+    if eta:
+        JOBS.update(job_id, percent=percent, status=status, eta=eta)
+    else:
+        JOBS.update(job_id, percent=percent, status=status)
+    
+    PROGRESS_WRITER.submit(job_id, percent, status, eta)
+    publish_job(job_id)
 
 def get_job(job_id):
     """Get job - try RAM first, then SQLite"""
-    with JOBS_LOCK:
-        if job_id in JOBS:
-            return JOBS[job_id]
+    job = JOBS.get(job_id)
+    if job is not None:
+        return job
     
     # Not in RAM, try SQLite
     db_job = db_get_job(job_id)
-    if db_job:
-        # Reconstruct job dict for compatibility
-        return {
-            'id': db_job['id'],
-            'percent': db_job['percent'],
-            'status': db_job['status'],
-            'eta': db_job['eta'],
-            'is_running': db_job['status'] in ('pending', 'processing'),
-            'is_complete': db_job['status'] == 'complete',
-            'output_path': db_job['output_path'],
-            'error': db_job['error'],
-            'should_stop': bool(db_job['should_stop']),
-            'created_at': db_job['created_at'],
-            'workspace': db_job['workspace']
-        }
-    return None
+    return job_from_row(db_job) if db_job else None
+
+def job_from_row(db_job):
+    """Reconstruct job dict for compatibility"""
+    return {
+        'id': db_job['id'],
+        'percent': db_job['percent'],
+        'status': db_job['status'],
+        'eta': db_job['eta'],
+        'is_running': db_job['status'] in ('pending', 'processing'),
+        'is_complete': db_job['status'] == 'complete',
+        'output_path': db_job['output_path'],
+        'error': db_job['error'],
+        'should_stop': bool(db_job['should_stop']),
+        'created_at': db_job['created_at'],
+        'workspace': db_job['workspace'],
+        'bg_pool': json.loads(db_job['bg_pool_json']) if db_job['bg_pool_json'] else None
+    }
+
+# ==========================================
+# 🛑 Cancellation Tokens - إيقاف الـ job من غير lock أو I/O في الـ hot loops
+# ==========================================
+CANCEL_TOKENS = {}  # job_id -> CancelToken (بيتسجل أول ما الـ job يبدأ)
+CANCEL_POLL_INTERVAL = 1.0  # الإلغاء ممكن ييجي من worker تاني - بنشوف should_stop في SQLite بالمعدل ده بس
+
+class CancelToken(threading.Event):
+    """Event + آخر مرة بصينا فيها على SQLite"""
+
+    def __init__(self):
+        super().__init__()
+        self.polled_at = time.monotonic()
+
+class JobStopped(Exception):
+    """الـ job اتلغى (أو خلص والشغل اللي في الخلفية لازم يقف)"""
+
+def check_token(token):
+    """زي check_stop بس على token متمسك (بيفضل شغال بعد ما الـ job يشيل الـ token بتاعه)"""
+    if token is not None and token.is_set():
+        raise JobStopped("Stopped by user")
+
+def cancel_token(job_id, stopped=False):
+    """token الـ job (بيتعمل لو مش موجود) - setdefault atomic فمش محتاجين lock"""
+    token = CANCEL_TOKENS.setdefault(job_id, CancelToken())
+    if stopped:
+        token.set()
+    return token
+
+def cancel_job(job_id):
+    """يعلّم الـ job للإيقاف - الـ token فوراً و SQLite للـ recovery"""
+    # لسه في الـ render queue ومحدش أخده: بيتلغى على طول (atomic مع db_claim_job)
+    if db_execute("UPDATE jobs SET status = 'cancelled', should_stop = 1 WHERE id = ? AND status = 'queued'", (job_id,)):
+        JOBS.update(job_id, status='cancelled', should_stop=True, is_running=False)
+        publish_job(job_id)
+        return
+    job = JOBS.update(job_id, should_stop=True, status='cancelling')
+    token = CANCEL_TOKENS.get(job_id)
+    if token is not None:
+        token.set()
+    elif job is not None:
+        # اتلغى قبل ما يبدأ - build_video_task هيلاقيه set
+        cancel_token(job_id, stopped=True)
+    db_update_job(job_id, should_stop=1, status='cancelling')
+
+def release_cancel_token(job_id):
+    CANCEL_TOKENS.pop(job_id, None)
 
 def check_stop(job_id):
     """Check if job should stop"""
+    if job_id is None:
+        return  # شغل خلفية مش تابع لـ job (زي تكملة ملف السورة)
+    # ⚡ الـ job مسجل: قراءة flag بس (بيتنادى مع كل فريم)
+    token = CANCEL_TOKENS.get(job_id)
+    if token is not None:
+        if not token.is_set() and time.monotonic() - token.polled_at >= CANCEL_POLL_INTERVAL:
+            # /api/cancel ممكن يكون وصل لـ worker تاني - query واحدة بالـ primary key كل CANCEL_POLL_INTERVAL
+            token.polled_at = time.monotonic()
+            row = db_query("SELECT should_stop FROM jobs WHERE id = ?", (job_id,), one=True)
+            if row and row['should_stop']:
+                token.set()
+        if token.is_set():
+            raise JobStopped("Stopped by user")
+        return
+    
     job = get_job(job_id)
     if not job:
         # Job not found in RAM or SQLite - might have been cleaned up
@@ -765,35 +1360,90 @@ def check_stop(job_id):
         print(f"[WARNING] Job {job_id} not found in check_stop - assuming completed or cleaned up")
         return
     if job.get('should_stop', False):
-        raise Exception("Stopped by user")
+        raise JobStopped("Stopped by user")
 
 def cleanup_job(job_id):
     """Remove job from RAM (keep in SQLite for history)"""
-    with JOBS_LOCK:
-        job = JOBS.pop(job_id, None)
+    JOBS.pop(job_id)
+    PROGRESS_WRITER.forget(job_id)
+    release_cancel_token(job_id)
     # Don't delete files - keep them for download
     # Files will be cleaned up by background_cleanup after 12h
 
+# ==========================================
+# ⏱️ Progress Reporter - نسبة واحدة لكل المراحل + ETA بمتوسط أُسّي
+# ==========================================
+PROGRESS_MIN_INTERVAL = 0.5   # ثواني بين التحديثات (غير تغيير المرحلة)
+PROGRESS_MIN_STEP = 1         # أقل تغيير في النسبة يستاهل تحديث
+PROGRESS_EMA_ALPHA = 0.3      # وزن آخر قياس في متوسط السرعة
+# (بداية، نهاية) كل مرحلة من الـ 100% - الرندر هو أطول مرحلة
+PROGRESS_STAGES = {
+    'ayahs': (0, 35),
+    'merge': (35, 37),
+    'mastering': (37, 40),
+    'render': (40, 100),
+}
+
+def format_eta(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))[2:] if seconds > 0 else "00:00"
+
+class ProgressReporter:
+    """
+    بيحوّل تقدم كل مرحلة لنسبة كلية، وبيبعت لـ update_job_status بس لما يعدي
+    PROGRESS_MIN_INTERVAL والنسبة تتغير PROGRESS_MIN_STEP (أو المرحلة/الحالة تتغير)
+    """
+
+    def __init__(self, job_id, stages=PROGRESS_STAGES):
+        self.job_id = job_id
+        self.stages = stages
+        self.lo, self.hi = next(iter(stages.values()))
+        self.status = None
+        self.percent = 0.0        # آخر نسبة اتبعتت
+        self.reported_at = None
+        self.rate = None          # EMA للنسبة في الثانية
+        self.sampled = None       # (وقت، نسبة) آخر قياس للسرعة
+
+    def stage(self, name, status):
+        """بداية مرحلة جديدة - بتتبعت فوراً"""
+        self.lo, self.hi = self.stages[name]
+        self.update(0, 1, status)
+
+    def update(self, done, total, status):
+        """status ممكن يكون فيه {percent} = نسبة المرحلة الحالية"""
+        now = time.time()
+        fraction = min(1.0, done / total) if total > 0 else 0.0
+        overall = max(self.percent, self.lo + (self.hi - self.lo) * fraction)
+        urgent = status != self.status or self.reported_at is None
+        if not urgent and (now - self.reported_at < PROGRESS_MIN_INTERVAL or overall - self.percent < PROGRESS_MIN_STEP):
+            return
+        
+        # السرعة بتتقاس على فترات >= PROGRESS_MIN_INTERVAL بس (تغيير مراحل ورا بعض مايعملش spike)
+        if self.sampled is None:
+            self.sampled = (now, overall)
+        elif now - self.sampled[0] >= PROGRESS_MIN_INTERVAL:
+            sample = (overall - self.sampled[1]) / (now - self.sampled[0])
+            self.rate = sample if self.rate is None else PROGRESS_EMA_ALPHA * sample + (1 - PROGRESS_EMA_ALPHA) * self.rate
+            self.sampled = (now, overall)
+        eta = format_eta((100 - overall) / self.rate) if self.rate else None
+        
+        self.status = status
+        self.percent = overall
+        self.reported_at = now
+        update_job_status(self.job_id, int(overall), status.format(percent=int(fraction * 100)), eta=eta)
+
 class ScopedQuranLogger(ProgressBarLogger):
-    def __init__(self, job_id):
+    def __init__(self, job_id, reporter=None):
         super().__init__()
         self.job_id = job_id
-        self.start_time = None
+        # لوحده (من غير build_video_task): الرندر = الـ 100% كلها
+        self.reporter = reporter or ProgressReporter(job_id, stages={'render': (0, 100)})
 
     def bars_callback(self, bar, attr, value, old_value=None):
         if bar == 't':
             check_stop(self.job_id)
             total = self.bars[bar]['total']
             if total > 0:
-                percent = int((value / total) * 100)
-                if self.start_time is None: self.start_time = time.time()
-                elapsed = time.time() - self.start_time
-                rem_str = "00:00"
-                if elapsed > 0 and value > 0:
-                    rate = value / elapsed
-                    remaining = (total - value) / rate
-                    rem_str = str(datetime.timedelta(seconds=int(remaining)))[2:] if remaining > 0 else "00:00"
-                update_job_status(self.job_id, percent, f"جاري التصدير... {percent}%", eta=rem_str)
+                self.reporter.update(value, total, "جاري التصدير... {percent}%")
 
 # ==========================================
 # 🛠️ Helper Functions & Optimization
@@ -809,26 +1459,217 @@ def detect_silence(sound, thresh):
     while t < len(sound) and sound[t:t+10].dBFS < thresh: t += 10
     return t
 
-def smart_download(url, dest_path, job_id):
+def touch_cache_file(path):
+    """تحديث وقت آخر استخدام لملف في الكاش (عشان prune_cache_dir ميحذفوش)"""
+    try: os.utime(path, None)
+    except OSError: pass
+
+def prune_cache_dir(cache_dir, max_age):
+    """حذف ملفات الكاش اللي ماتستخدمتش من أكتر من max_age ثانية"""
+    if not os.path.exists(cache_dir):
+        return
+    now = time.time()
+    removed = 0
+    for root, _, files in os.walk(cache_dir):
+        for f in files:
+            fpath = os.path.join(root, f)
+            try:
+                if (now - os.path.getmtime(fpath)) > max_age:
+                    os.remove(fpath)
+                    removed += 1
+            except OSError: pass
+    if removed:
+        print(f"🧹 Pruned {removed} stale files from {os.path.basename(cache_dir)}")
+
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_MIN_CHUNK = 64 * 1024
+DOWNLOAD_MAX_CHUNK = 1024 * 1024
+PATH_LOCKS = {}
+PATH_LOCKS_GUARD = threading.Lock()
+
+class PathLock:
+    """
+    RLock للـ threads + flock على path.lock للـ processes التانية (gunicorn workers / render workers)
+    الـ flock بيتاخد مرة واحدة مع أول دخول وبيتفك مع آخر خروج
+    """
+
+    def __init__(self, path):
+        self.lock_path = path + '.lock'
+        self.rlock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+    def __enter__(self):
+        self.rlock.acquire()
+        self.depth += 1
+        if self.depth == 1 and fcntl is not None:
+            try:
+                self.fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                # ✅ عشان prune_cache_dir ميحذفش الـ lockfile وهو مستخدم
+                os.utime(self.lock_path, None)
+            except OSError:
+                self.depth -= 1
+                if self.fd is not None: os.close(self.fd)
+                self.fd = None
+                self.rlock.release()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0 and self.fd is not None:
+            try: fcntl.flock(self.fd, fcntl.LOCK_UN)
+            finally:
+                os.close(self.fd)
+                self.fd = None
+        self.rlock.release()
+
+def path_lock(path):
+    """lock لكل ملف في الكاش (عشان jobs متوازية - في نفس الـ process أو غيرها - متكتبش نفس الملف مع بعض)"""
+    path = os.path.abspath(path)
+    with PATH_LOCKS_GUARD:
+        lock = PATH_LOCKS.get(path)
+        if lock is None:
+            lock = PATH_LOCKS[path] = PathLock(path)
+        return lock
+
+class IncompleteDownload(Exception):
+    pass
+
+def download_validator(response):
+    """ETag (strong بس) أو Last-Modified - بيتبعت في If-Range عشان منكملش على نسخة قديمة من الملف"""
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+def _download_attempt(url, temp_path, job_id, token=None):
+    """محاولة واحدة - بتكمل من آخر byte في temp_path (Range) وبتتأكد من الحجم"""
+    validator_path = temp_path + '.validator'
+    offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+    validator = None
+    if offset and os.path.exists(validator_path):
+        with open(validator_path, 'r') as f:
+            validator = f.read().strip() or None
+    # ✅ identity: الـ Content-Length لازم يبقى حجم الملف نفسه مش الـ gzip بتاعه
+    headers = {'Accept-Encoding': 'identity'}
+    if offset and validator:
+        # لو الملف اتغير على السيرفر، If-Range بيخليه يرجع 200 بالملف كله بدل 206
+        headers.update({'Range': f'bytes={offset}-', 'If-Range': validator})
+    else:
+        offset = 0  # من غير validator مش ضامنين إن الـ temp من نفس النسخة
+    with requests.get(url, stream=True, timeout=30, headers=headers) as r:
+        if r.status_code == 416:
+            # الـ temp أكبر من الملف أو بايظ - نبدأ من الأول
+            os.remove(temp_path)
+            raise IncompleteDownload(f"Invalid resume offset {offset}")
+        r.raise_for_status()
+        if offset and r.status_code != 206:
+            offset = 0  # السيرفر تجاهل الـ Range أو الملف اتغير - نبدأ من الأول
+        if not offset:
+            validator = download_validator(r)
+            if validator:
+                with open(validator_path, 'w') as f: f.write(validator)
+            elif os.path.exists(validator_path):
+                os.remove(validator_path)
+        length = int(r.headers.get('Content-Length', 0) or 0)
+        expected = offset + length if length else None
+        # ⚡ chunk أكبر للملفات الكبيرة (فيديوهات Pexels) = syscalls أقل
+        chunk_size = min(DOWNLOAD_MAX_CHUNK, max(DOWNLOAD_MIN_CHUNK, length // 64))
+        last_check = time.time()
+        with open(temp_path, 'ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    if time.time() - last_check > 0.5:
+                        check_token(token)
+                        check_stop(job_id)
+                        last_check = time.time()
+    size = os.path.getsize(temp_path)
+    if size == 0 or (expected is not None and size != expected):
+        raise IncompleteDownload(f"Got {size} of {expected} bytes")
+
+def smart_download(url, dest_path, job_id, token=None):
+    """
+    تنزيل لملف مؤقت + rename ذري في الآخر (مفيش ملف ناقص في الكاش أبداً)
+    لو النت قطع بيكمل بالـ Range من مكان ما وقف بدل ما يبدأ من الأول
+    token: الـ cancel token بتاع الـ job - لو اتعمله set بيقف وبيمسح الجزء اللي اتنزل
+    """
+    check_token(token)
     check_stop(job_id)
-    try:
-        with requests.get(url, stream=True, timeout=30) as r:
-            r.raise_for_status()
-            with open(dest_path, 'wb') as f:
-                counter = 0
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk: 
-                        f.write(chunk)
-                        counter += 1
-                        if counter % 100 == 0: 
-                            check_stop(job_id)
-        # Verify file was downloaded
-        if not os.path.exists(dest_path) or os.path.getsize(dest_path) == 0:
-            raise Exception(f"Downloaded file is empty or missing: {dest_path}")
-    except requests.exceptions.RequestException as e:
-        print(f"[ERROR] Failed to download {url}: {e}")
+    temp_path = dest_path + '.download'
+    with path_lock(dest_path):
+        if os.path.exists(dest_path):
+            return  # job تانية نزلته واحنا مستنيين
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            try:
+                _download_attempt(url, temp_path, job_id, token)
+                os.replace(temp_path, dest_path)
+                if os.path.exists(temp_path + '.validator'):
+                    os.remove(temp_path + '.validator')
+                return
+            except (requests.exceptions.RequestException, IncompleteDownload) as e:
+                print(f"[WARNING] Download attempt {attempt}/{DOWNLOAD_RETRIES} failed for {url}: {e}")
+                if isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code < 500:
+                    break  # 404 وأمثاله مش هيتصلحوا بالإعادة
+                if attempt < DOWNLOAD_RETRIES:
+                    check_token(token)
+                    check_stop(job_id)
+                    time.sleep(attempt)
+            except JobStopped:
+                # الـ job اتلغى أو خلص - مفيش حد هيكمل الملف ده
+                for leftover in (temp_path, temp_path + '.validator'):
+                    if os.path.exists(leftover): os.remove(leftover)
+                raise
+        # الـ temp بيفضل موجود عشان المرة الجاية تكمل منه
+        print(f"[ERROR] Failed to download {url}")
         raise Exception(f"Failed to download: {url}")
 
+# ==========================================
+# 🎧 Audio Assembly - تجميع صوت الريلز كله في الذاكرة
+# ==========================================
+AUDIO_SAMPLE_RATE = 44100
+AUDIO_CHANNELS = 2
+
+def segment_to_pcm(seg):
+    """تحويل AudioSegment لمصفوفة PCM (samples, channels) int16 بالـ rate الموحد"""
+    seg = seg.set_frame_rate(AUDIO_SAMPLE_RATE).set_channels(AUDIO_CHANNELS).set_sample_width(2)
+    return np.frombuffer(seg.raw_data, dtype=np.int16).reshape(-1, AUDIO_CHANNELS)
+
+def seconds_to_samples(seconds):
+    return int(round(seconds * AUDIO_SAMPLE_RATE))
+
+class AudioTrack:
+    """
+    صوت الريلز كله كقطع PCM متتالية - حدود كل قطعة نص عبارة عن indices في الـ track
+    بيتكتب مرة واحدة كملف WAV واحد للـ encoder
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.total_samples = 0
+
+    def append(self, pcm):
+        """إضافة PCM للـ track - يرجع (أول sample، آخر sample)"""
+        start = self.total_samples
+        self.parts.append(pcm)
+        self.total_samples += len(pcm)
+        return start, self.total_samples
+
+    @property
+    def duration(self):
+        return self.total_samples / AUDIO_SAMPLE_RATE
+
+    def write_wav(self, path):
+        with wave.open(path, 'wb') as wf:
+            wf.setnchannels(AUDIO_CHANNELS)
+            wf.setsampwidth(2)
+            wf.setframerate(AUDIO_SAMPLE_RATE)
+            for pcm in self.parts:
+                wf.writeframes(memoryview(np.ascontiguousarray(pcm)).cast('B'))
+        return path
+
 def detect_leading_silence(sound, silence_threshold=-50.0, chunk_size=10):
     trim_ms = 0
     assert chunk_size > 0
@@ -836,37 +1677,461 @@ def detect_leading_silence(sound, silence_threshold=-50.0, chunk_size=10):
         trim_ms += chunk_size
     return trim_ms
 
-def process_mp3quran_audio(reciter_name, surah, ayah, idx, workspace_dir, job_id):
-    reciter_id, server_url = NEW_RECITERS_CONFIG[reciter_name]
-    cache_dir = os.path.join(EXEC_DIR, "cache_mp3quran", str(reciter_id))
+def mp3quran_cache_path(reciter_id, surah, ext):
+    """مسار ملف في كاش السورة (mp3 / json للتوقيتات / loudness.json للقياس)"""
+    cache_dir = os.path.join(MP3QURAN_CACHE_DIR, str(reciter_id))
     os.makedirs(cache_dir, exist_ok=True)
-    full_audio_path = os.path.join(cache_dir, f"{surah:03d}.mp3")
-    timings_path = os.path.join(cache_dir, f"{surah:03d}.json")
+    return os.path.join(cache_dir, f"{surah:03d}.{ext}")
 
-    if not os.path.exists(full_audio_path) or not os.path.exists(timings_path):
-        smart_download(f"{server_url}{surah:03d}.mp3", full_audio_path, job_id)
+MP3QURAN_CACHE_EXTS = ("mp3", "json", "loudness.json", "idx.npz")
+
+def touch_surah_cache(reciter_id, surah):
+    """
+    تحديث وقت استخدام ملف السورة وكل الـ sidecars بتاعته مع بعض
+    (عشان prune_cache_dir ميحذفش التوقيتات أو القياس والـ mp3 لسه مستخدم)
+    """
+    for ext in MP3QURAN_CACHE_EXTS:
+        touch_cache_file(mp3quran_cache_path(reciter_id, surah, ext))
+
+# ==========================================
+# 🎵 MP3 Frame Index - قراءة آية من ملف السورة بدون فك الملف كله
+# ==========================================
+# Layer III بس (ده اللي mp3quran بيستخدمه)
+_MP3_BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],    # MPEG1
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],        # MPEG2
+}
+_MP3_BITRATES[0] = _MP3_BITRATES[2]                                           # MPEG2.5
+_MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+MP3_PREROLL_FRAMES = 4   # فريمات قبل النافذة: bit reservoir (main_data_begin ≤ 511 byte) + MDCT overlap
+MP3_INDEX_VERSION = 1
+
+def parse_mp3_header(h):
+    """فك header فريم MP3 (4 bytes) - يرجع (frame_len, sample_rate, samples_per_frame, bitrate) أو None"""
+    if len(h) < 4 or h[0] != 0xFF or (h[1] & 0xE0) != 0xE0:
+        return None
+    version = (h[1] >> 3) & 3
+    layer = (h[1] >> 1) & 3
+    br_idx, sr_idx, padding = h[2] >> 4, (h[2] >> 2) & 3, (h[2] >> 1) & 1
+    if version == 1 or layer != 1 or br_idx in (0, 15) or sr_idx == 3:
+        return None
+    bitrate = _MP3_BITRATES[version][br_idx] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sr_idx]
+    if version == 3:
+        return 144 * bitrate // sample_rate + padding, sample_rate, 1152, bitrate
+    return 72 * bitrate // sample_rate + padding, sample_rate, 576, bitrate
+
+def id3v2_size(data):
+    """حجم tag الـ ID3v2 في أول الملف (0 لو مفيش)"""
+    if len(data) >= 10 and data[:3] == b'ID3':
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        return 10 + size + (10 if data[5] & 0x10 else 0)
+    return 0
+
+def find_mp3_sync(data, pos=0, confirm=3):
+    """أول مكان فيه فريمات MP3 متتالية صحيحة (confirm فريمات ورا بعض)"""
+    n = len(data)
+    while True:
+        pos = data.find(b'\xff', pos)
+        if pos < 0 or pos + 4 > n:
+            return -1
+        p, ok = pos, 0
+        while ok < confirm:
+            info = parse_mp3_header(data[p:p + 4])
+            if not info: break
+            ok += 1
+            p += info[0]
+            if p + 4 > n: break
+        if ok >= confirm or (ok and p + 4 > n):
+            return pos
+        pos += 1
+
+def lame_skip_samples(frame):
+    """
+    لو الفريم ده Xing/Info header: عدد الـ samples اللي ffmpeg بيتخطاها في أول الملف
+    (encoder delay من LAME tag + 529 decoder delay). None لو ده فريم صوت عادي
+    """
+    p = max(frame.find(b'Xing'), frame.find(b'Info'))
+    if p < 0:
+        return None
+    flags = int.from_bytes(frame[p + 4:p + 8], 'big')
+    # frames(4) / bytes(4) / toc(100) / quality(4) - كل واحد موجود حسب الـ flags
+    lame = p + 8 + (4 if flags & 1 else 0) + (4 if flags & 2 else 0) + (100 if flags & 4 else 0) + (4 if flags & 8 else 0)
+    # encoder string (9) + ... + delay/padding (3 bytes) عند offset 21
+    d = frame[lame + 21:lame + 24]
+    if len(d) < 3 or not frame[lame:lame + 4].strip(b'\x00'):
+        return 0
+    return ((d[0] << 4) | (d[1] >> 4)) + 529
+
+class Mp3DecodeError(Exception):
+    """ffmpeg مقدرش يفك الفريمات (نافذة بايظة مثلاً) - الـ partial fetch بيرجع للتنزيل الكامل"""
+
+def decode_mp3_bytes(data):
+    """فك bytes MP3 في الذاكرة لـ AudioSegment (ffmpeg pipe مباشرة بدون ملف أو ffprobe)"""
+    proc = subprocess.run(
+        [FFMPEG_EXE, '-v', 'error', '-f', 'mp3', '-i', 'pipe:0',
+         '-f', 's16le', '-ac', str(AUDIO_CHANNELS), '-ar', str(AUDIO_SAMPLE_RATE), 'pipe:1'],
+        input=data, capture_output=True
+    )
+    if proc.returncode != 0 or not proc.stdout:
+        raise Mp3DecodeError(f"MP3 decode failed: {proc.stderr.decode(errors='ignore')[-300:]}")
+    return AudioSegment(data=proc.stdout, sample_width=2, frame_rate=AUDIO_SAMPLE_RATE, channels=AUDIO_CHANNELS)
+
+def decode_mp3_window(data, window_ms, start_ms, end_ms):
+    """فك فريمات نافذة (أولها عند window_ms بتوقيت الملف) وقص [start_ms, end_ms] منها"""
+    seg = decode_mp3_bytes(data)
+    # القص بالـ samples (window_ms كسري - القص بالـ ms كان هيزحزح الصوت)
+    window_start = int(round(window_ms * seg.frame_rate / 1000.0))
+    to_sample = lambda ms: max(0, int(ms * seg.frame_rate / 1000.0) - window_start)
+    return seg.get_sample_slice(to_sample(start_ms), min(to_sample(end_ms), int(seg.frame_count())))
+
+class Mp3FrameIndex:
+    """
+    فهرس byte offset لكل فريم في ملف MP3 (CBR أو VBR)
+    بيتبني مرة واحدة لكل سورة في الكاش، وبعدها أي آية = seek + فك نافذة صغيرة
+    """
+
+    def __init__(self, offsets, sample_rate, samples_per_frame, skip_samples, file_size):
+        self.offsets = offsets
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        self.skip_samples = skip_samples
+        self.file_size = file_size
+
+    @property
+    def frame_ms(self):
+        return 1000.0 * self.samples_per_frame / self.sample_rate
+
+    @classmethod
+    def build(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        pos = find_mp3_sync(data, id3v2_size(data))
+        if pos < 0:
+            raise ValueError(f"No MP3 frames found in {path}")
+        offsets = []
+        sample_rate = spf = None
+        skip = 0
+        n = len(data)
+        while pos + 4 <= n:
+            info = parse_mp3_header(data[pos:pos + 4])
+            if not info:
+                # بيانات بايظة أو tag في النص - ندور على الفريم اللي بعده
+                pos = find_mp3_sync(data, pos + 1)
+                if pos < 0: break
+                continue
+            frame_len, sr, frame_spf, _ = info
+            if sample_rate is None:
+                sample_rate, spf = sr, frame_spf
+                # فريم Xing/Info مش صوت - ffmpeg بيقراه كـ metadata
+                tag_skip = lame_skip_samples(data[pos:pos + frame_len])
+                if tag_skip is not None:
+                    skip = tag_skip
+                    pos += frame_len
+                    continue
+            offsets.append(pos)
+            pos += frame_len
+        return cls(np.asarray(offsets, dtype=np.int64), sample_rate, spf, skip, n)
+
+    def save(self, path):
+        np.savez(path, offsets=self.offsets,
+                 meta=np.array([MP3_INDEX_VERSION, self.sample_rate, self.samples_per_frame, self.skip_samples, self.file_size], dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            version, sr, spf, skip, size = (int(v) for v in z['meta'])
+            if version != MP3_INDEX_VERSION:
+                raise ValueError("Stale MP3 index")
+            return cls(z['offsets'], sr, spf, skip, size)
+
+    @classmethod
+    def for_file(cls, mp3_path, index_path):
+        """تحميل الفهرس من الكاش، أو بناؤه لو مش موجود / الملف اتغير"""
+        size = os.path.getsize(mp3_path)
+        if os.path.exists(index_path):
+            try:
+                index = cls.load(index_path)
+                if index.file_size == size:
+                    touch_cache_file(index_path)
+                    return index
+            except Exception as e:
+                print(f"⚠️ MP3 index reload failed ({e}), rebuilding")
+        index = cls.build(mp3_path)
+        try: index.save(index_path)
+        except OSError as e: print(f"⚠️ MP3 index save failed: {e}")
+        return index
+
+    def frame_at(self, ms):
+        """رقم الفريم اللي فيه اللحظة ms (بتوقيت الملف بعد فك كامل)"""
+        sample = ms * self.sample_rate / 1000.0 + self.skip_samples
+        return int(min(max(sample // self.samples_per_frame, 0), len(self.offsets) - 1))
+
+    def window(self, start_ms, end_ms):
+        """(byte_start, byte_end, window_start_ms) للفريمات اللي بتغطي [start_ms, end_ms]"""
+        first = max(0, self.frame_at(start_ms) - MP3_PREROLL_FRAMES)
+        last = self.frame_at(end_ms) + 2
+        byte_end = int(self.offsets[last]) if last < len(self.offsets) else self.file_size
+        window_ms = (first * self.samples_per_frame - self.skip_samples) * 1000.0 / self.sample_rate
+        return int(self.offsets[first]), byte_end, window_ms
+
+    def read_segment(self, mp3_path, start_ms, end_ms):
+        """فك [start_ms, end_ms] بس من الملف - AudioSegment بنفس توقيت الفك الكامل"""
+        byte_start, byte_end, window_ms = self.window(start_ms, end_ms)
+        with open(mp3_path, 'rb') as f:
+            f.seek(byte_start)
+            data = f.read(byte_end - byte_start)
+        return decode_mp3_window(data, window_ms, start_ms, end_ms)
+
+# ==========================================
+# 📡 Partial Fetch - تنزيل فريمات الآية بس من السيرفر (HTTP Range)
+# ==========================================
+SPARSE_HEAD_BYTES = 64 * 1024     # أول الملف: ID3 + أول فريمات (bitrate / LAME tag)
+SPARSE_MARGIN_FRAMES = 3          # هامش حوالين النافذة المحسوبة بالـ bitrate
+
+class PartialFetchError(Exception):
+    """السيرفر مش بيدعم Range أو الملف مش CBR - نرجع للتنزيل الكامل"""
+
+class SparseRangeCache:
+    """
+    ملف كاش متفرق: حجمه = حجم الملف الأصلي، بس فيه الأجزاء اللي اتنزلت بالـ Range
+    والـ ranges المتنزلة محفوظة في sidecar JSON - أي طلب بعد كده بينزل الناقص بس
+    لما الملف يكمل بيتنقل لمساره النهائي كملف عادي
+    """
+
+    def __init__(self, url, final_path):
+        self.url = url
+        self.final_path = final_path
+        self.path = final_path + '.part'
+        self.meta_path = final_path + '.ranges.json'
+        self.size = None
+        self.ranges = []
+        if os.path.exists(self.path) and os.path.exists(self.meta_path):
+            try:
+                with open(self.meta_path, 'r') as f:
+                    meta = json.load(f)
+                self.size, self.ranges = meta['size'], [tuple(r) for r in meta['ranges']]
+            except Exception:
+                self.size, self.ranges = None, []
+
+    @property
+    def complete(self):
+        return self.size is not None and self.ranges == [(0, self.size)]
+
+    def missing(self, start, end):
+        """الأجزاء الناقصة من [start, end)"""
+        gaps, pos = [], start
+        for a, b in self.ranges:
+            if b <= pos: continue
+            if a >= end: break
+            if a > pos: gaps.append((pos, a))
+            pos = max(pos, b)
+        if pos < end: gaps.append((pos, end))
+        return gaps
+
+    def _add_range(self, start, end):
+        merged = []
+        for a, b in sorted(self.ranges + [(start, end)]):
+            if merged and a <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+            else:
+                merged.append((a, b))
+        self.ranges = merged
+
+    def _fetch(self, start, end, job_id):
+        check_stop(job_id)
+        headers = {'Range': f'bytes={start}-{end - 1}'}
+        with requests.get(self.url, headers=headers, stream=True, timeout=30) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise PartialFetchError(f"Range not supported by {self.url}")
+            content_range = r.headers.get('Content-Range', '')
+            total = int(content_range.rsplit('/', 1)[-1]) if '/' in content_range else None
+            if self.size is None:
+                if not total:
+                    raise PartialFetchError(f"Unknown size for {self.url}")
+                self.size = total
+                with open(self.path, 'wb') as f:
+                    f.truncate(total)   # sparse على أغلب الـ filesystems
+            data = r.content
+        with open(self.path, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+        self._add_range(start, start + len(data))
+        # ✅ temp + rename: process تانية عمرها ما تقرا sidecar نصه مكتوب
+        temp_meta = f"{self.meta_path}.{os.getpid()}.tmp"
+        with open(temp_meta, 'w') as f:
+            json.dump({'size': self.size, 'ranges': self.ranges}, f)
+        os.replace(temp_meta, self.meta_path)
+
+    def read(self, start, end, job_id):
+        """bytes [start, end) - بينزل الناقص بس"""
+        if self.size is None:
+            self._fetch(0, max(end, SPARSE_HEAD_BYTES), job_id)
+        end = min(end, self.size)
+        for a, b in self.missing(start, end):
+            self._fetch(a, b, job_id)
+        touch_cache_file(self.meta_path)
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        if self.complete:
+            os.replace(self.path, self.final_path)
+            try: os.remove(self.meta_path)
+            except OSError: pass
+            print(f"✅ Sparse cache complete: {os.path.basename(self.final_path)}")
+        return data
+
+def parse_mp3_stream_info(head):
+    """معلومات الـ stream من أول الملف: (audio_start, sample_rate, samples_per_frame, bitrate, skip_samples)"""
+    pos = find_mp3_sync(head, id3v2_size(head))
+    if pos < 0:
+        raise PartialFetchError("No MP3 frames in head")
+    frame_len, sample_rate, spf, bitrate = parse_mp3_header(head[pos:pos + 4])
+    skip = lame_skip_samples(head[pos:pos + frame_len])
+    if skip is not None:
+        # Xing = VBR (الـ bitrate مش ثابت ومينفعش نحسب مكان الفريم)
+        if b'Xing' in head[pos:pos + frame_len]:
+            raise PartialFetchError("VBR stream")
+        pos += frame_len
+        bitrate = parse_mp3_header(head[pos:pos + 4])[3]
+    else:
+        skip = 0
+    # من غير Info tag: نتأكد إن أول فريمات كلها بنفس الـ bitrate
+    p = pos
+    while p + 4 <= len(head):
+        info = parse_mp3_header(head[p:p + 4])
+        if not info: break
+        if info[3] != bitrate:
+            raise PartialFetchError("VBR stream")
+        p += info[0]
+    return pos, sample_rate, spf, bitrate, skip
+
+def fetch_remote_mp3_window(url, final_path, start_ms, end_ms, job_id):
+    """
+    فك [start_ms, end_ms] من ملف MP3 على السيرفر بتنزيل الفريمات اللي بتغطيها بس
+    (CBR: مكان الفريم k = audio_start + k * bytes_per_frame)
+    """
+    with path_lock(final_path):
+        if os.path.exists(final_path):
+            raise PartialFetchError("Full file cached meanwhile")
+        cache = SparseRangeCache(url, final_path)
+        head = cache.read(0, SPARSE_HEAD_BYTES, job_id)
+        if id3v2_size(head) + 4096 > len(head):
+            head = cache.read(0, id3v2_size(head) + SPARSE_HEAD_BYTES, job_id)
+        audio_start, sample_rate, spf, bitrate, skip = parse_mp3_stream_info(head)
+        bytes_per_frame = spf / 8.0 * bitrate / sample_rate
+
+        frame_of = lambda ms: max(0, int((ms * sample_rate / 1000.0 + skip) // spf))
+        first = max(0, frame_of(start_ms) - MP3_PREROLL_FRAMES)
+        last = frame_of(end_ms) + 2
+        byte_start = max(0, audio_start + int((first - SPARSE_MARGIN_FRAMES) * bytes_per_frame))
+        byte_end = audio_start + int((last + SPARSE_MARGIN_FRAMES) * bytes_per_frame)
+        data = cache.read(byte_start, byte_end, job_id)
+
+    # رقم أول فريم كامل في الـ chunk من مكانه، وبعدين نمشي فريم فريم لحد first
+    pos = find_mp3_sync(data, max(0, audio_start - byte_start))
+    if pos < 0:
+        raise PartialFetchError("No MP3 frames in fetched range")
+    k = int(round((byte_start + pos - audio_start) / bytes_per_frame))
+    window_begin = window_end = None
+    while pos + 4 <= len(data) and k <= last:
+        if k == first: window_begin = pos
+        info = parse_mp3_header(data[pos:pos + 4])
+        if not info: break
+        pos += info[0]
+        k += 1
+        window_end = pos
+    if window_begin is None or window_end is None:
+        raise PartialFetchError("Fetched range misses the requested frames")
+    window_ms = (first * spf - skip) * 1000.0 / sample_rate
+    return decode_mp3_window(data[window_begin:window_end], window_ms, start_ms, end_ms)
+
+# ⚖️ الـ partial fetch بينزل فريمات الآيات بس - بس قياس الـ loudness والـ frame index محتاجين ملف السورة كامل
+# فبعد أول partial fetch بنكمل باقي الملف في الخلفية (قطعة قطعة عشان منمسكش الـ lock وقت طويل)
+# أول رندر للسورة بياخد loudnorm العادي، واللي بعده بياخد القياس المحفوظ والـ seek بالـ index
+SPARSE_COMPLETE_CHUNK = 1024 * 1024
+SPARSE_COMPLETE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SurahPrefetch")
+SPARSE_COMPLETE_LOCK = threading.Lock()
+SPARSE_COMPLETE_PENDING = set()
+
+def complete_sparse_cache(url, final_path):
+    """تنزيل الأجزاء الناقصة من الـ sparse cache لحد ما يبقى ملف كامل"""
+    try:
+        while True:
+            with path_lock(final_path):
+                if os.path.exists(final_path):
+                    return
+                cache = SparseRangeCache(url, final_path)
+                if cache.size is None:
+                    return
+                gaps = cache.missing(0, cache.size)
+                start, end = gaps[0] if gaps else (0, 0)
+                cache.read(start, min(end, start + SPARSE_COMPLETE_CHUNK), None)
+    except Exception as e:
+        print(f"⚠️ Background surah download failed ({os.path.basename(final_path)}): {e}")
+    finally:
+        with SPARSE_COMPLETE_LOCK:
+            SPARSE_COMPLETE_PENDING.discard(final_path)
+
+def request_sparse_completion(url, final_path):
+    """تكملة ملف السورة في الخلفية (مرة واحدة لكل ملف)"""
+    with SPARSE_COMPLETE_LOCK:
+        if final_path in SPARSE_COMPLETE_PENDING:
+            return
+        SPARSE_COMPLETE_PENDING.add(final_path)
+    SPARSE_COMPLETE_EXECUTOR.submit(complete_sparse_cache, url, final_path)
+
+def load_mp3quran_timings(reciter_id, surah, job_id):
+    timings_path = mp3quran_cache_path(reciter_id, surah, "json")
+    if not os.path.exists(timings_path):
         check_stop(job_id)
         t_data = requests.get(f"https://mp3quran.net/api/v3/ayat_timing?surah={surah}&read={reciter_id}").json()
         timings = {item['ayah']: {'start': item['start_time'], 'end': item['end_time']} for item in t_data}
         with open(timings_path, 'w') as f: json.dump(timings, f)
-
+    touch_cache_file(timings_path)
     with open(timings_path, 'r') as f:
-        t = json.load(f)[str(ayah)]
+        return json.load(f)
+
+def process_mp3quran_audio(reciter_name, surah, ayah, idx, workspace_dir, job_id):
+    reciter_id, server_url = NEW_RECITERS_CONFIG[reciter_name]
+    full_audio_path = mp3quran_cache_path(reciter_id, surah, "mp3")
+    audio_url = f"{server_url}{surah:03d}.mp3"
+    t = load_mp3quran_timings(reciter_id, surah, job_id)[str(ayah)]
+
+    if not os.path.exists(full_audio_path):
+        try:
+            # 📡 كاش بارد: ننزل فريمات الآية بس (KBs بدل ملف السورة كله)
+            seg = fetch_remote_mp3_window(audio_url, full_audio_path, t['start'], t['end'], job_id)
+            request_sparse_completion(audio_url, full_audio_path)
+            return segment_to_pcm(seg)
+        except (PartialFetchError, Mp3DecodeError, requests.exceptions.RequestException, ValueError, OSError) as e:
+            print(f"⚠️ Partial fetch failed ({e}), downloading full surah")
+        if not os.path.exists(full_audio_path):
+            smart_download(audio_url, full_audio_path, job_id)
+            for leftover in (full_audio_path + '.part', full_audio_path + '.ranges.json'):
+                if os.path.exists(leftover): os.remove(leftover)
+
+    touch_surah_cache(reciter_id, surah)
     
     check_stop(job_id)
-    seg = AudioSegment.from_file(full_audio_path)[t['start']:t['end']]
-    
-    # ✅ حفظ بصيغة WAV لتجنب MP3 padding
-    out = os.path.join(workspace_dir, f'part{idx}.wav')
-    seg.export(out, format="wav")
+    try:
+        # ⚡ seek مباشر لفريمات الآية بدل فك السورة كلها
+        index = Mp3FrameIndex.for_file(full_audio_path, mp3quran_cache_path(reciter_id, surah, "idx.npz"))
+        seg = index.read_segment(full_audio_path, t['start'], t['end'])
+    except Exception as e:
+        print(f"⚠️ MP3 frame index failed ({e}), decoding full surah")
+        seg = AudioSegment.from_file(full_audio_path)[t['start']:t['end']]
     
-    return out
+    # ✅ PCM في الذاكرة مباشرة (بدون WAV وسيط)
+    return segment_to_pcm(seg)
 
 def download_audio(reciter_key, surah, ayah, idx, workspace_dir, job_id):
+    """تحميل صوت الآية ورجوعه كـ PCM (int16, stereo, AUDIO_SAMPLE_RATE)"""
     if reciter_key in NEW_RECITERS_CONFIG:
         return process_mp3quran_audio(reciter_key, surah, ayah, idx, workspace_dir, job_id)
     
-    # للقراء القدام (everyayah.com) - ننزل MP3 ونحوله لـ WAV
+    # للقراء القدام (everyayah.com) - ننزل MP3 ونفكه لـ PCM
     url = f'https://everyayah.com/data/{reciter_key}/{surah:03d}{ayah:03d}.mp3'
     temp_mp3 = os.path.join(workspace_dir, f'part{idx}_temp.mp3')
     smart_download(url, temp_mp3, job_id)
@@ -875,14 +2140,11 @@ def download_audio(reciter_key, surah, ayah, idx, workspace_dir, job_id):
     start, end = detect_silence(snd, snd.dBFS-20), detect_silence(snd.reverse(), snd.dBFS-20)
     trimmed = snd[max(0, start-30):len(snd)-max(0, end-30)]
     
-    # ✅ حفظ بصيغة WAV بدون fade أو silence
-    out = os.path.join(workspace_dir, f'part{idx}.wav')
-    trimmed.export(out, format="wav")
-    
     # نحذف الـ temp MP3
     if os.path.exists(temp_mp3): os.remove(temp_mp3)
     
-    return out
+    # ✅ PCM بدون fade أو silence
+    return segment_to_pcm(trimmed)
 
 def get_text(surah, ayah):
     try:
@@ -909,12 +2171,11 @@ def to_arabic_numeral(num):
     arabic_digits = '٠١٢٣٤٥٦٧٨٩'
     return ''.join(arabic_digits[int(d)] for d in str(num))
 
-def create_vignette_mask(w, h):
+def create_vignette_alpha(w, h):
+    """قناع الـ vignette (alpha من 0 لـ 1) - طبقة سوداء على الأطراف"""
     Y, X = np.ogrid[:h, :w]
     mask = np.clip((np.sqrt((X - w/2)**2 + (Y - h/2)**2) / np.sqrt((w/2)**2 + (h/2)**2)) * 1.16, 0, 1) ** 3 
-    mask_img = np.zeros((h, w, 4), dtype=np.uint8)
-    mask_img[:, :, 3] = (mask * 255).astype(np.uint8)
-    return ImageClip(mask_img, ismask=False)
+    return mask.astype(np.float32)
 
 # ==========================================
 # 🎨 Visual Elements
@@ -1044,20 +2305,770 @@ def create_english_clip(text, duration, target_w, scale_factor=1.0, glow=False,
     clip = ImageClip(np.array(img)).set_duration(duration)
     return clip
 
-def fetch_video_pool(user_key, custom_query, count=1, job_id=None, aspect_ratio='9:16'):
-    pool =[]
-    active_key = user_key if user_key and len(user_key) > 10 else random.choice(PEXELS_API_KEYS) if PEXELS_API_KEYS else ""
+# ==========================================
+# 🎞️ Fast Compositing - منحنيات Fade محسوبة مسبقاً
+# ==========================================
+# بدل crossfadein/fadeout في moviepy (اللي بتبني mask clips وتضرب كل بكسل في كل فريم)
+# بنحسب جدول alpha لكل فريم مرة واحدة، والنصوص بتتحفظ premultiplied جاهزة للدمج
+
+TEXT_FADE = 0.35  # مدة crossfade النص
+BG_FADE = 0.5     # مدة fade الخلفية بين الآيات
+BG_DIM_OPACITY = 0.45  # ✅ طبقة التعتيم (زودناها عشان الخلفيات الفاتحة)
+
+def build_fade_curve(duration, fps, fade_in=0.0, fade_out=0.0):
+    """جدول alpha لكل فريم - نفس معادلة fadein/fadeout في moviepy"""
+    n_frames = int(duration * fps) + 1
+    t = np.arange(n_frames, dtype=np.float32) / fps
+    curve = np.ones(n_frames, dtype=np.float32)
+    if fade_in > 0:
+        curve = np.minimum(curve, t / fade_in)
+    if fade_out > 0:
+        curve = np.minimum(curve, (duration - t) / fade_out)
+    return np.clip(curve, 0.0, 1.0)
+
+def build_static_gain(target_w, target_h, use_vignette=False):
+    """
+    دمج طبقة التعتيم والـ vignette في مصفوفة ضرب واحدة
+    (الطبقتين لونهم أسود، فالدمج = ضرب الخلفية في (1 - alpha))
+    """
+    gain = np.full((target_h, target_w, 1), 1.0 - BG_DIM_OPACITY, dtype=np.float32)
+    if use_vignette:
+        gain *= (1.0 - create_vignette_alpha(target_w, target_h))[:, :, None]
+    return gain
+
+class TextOverlay:
+    """طبقة نص جاهزة للدمج: RGB premultiplied + (1 - alpha) مقصوصة على الصفوف اللي فيها نص"""
+
+    def __init__(self, clip, y, frame_w, frame_h):
+        rgb = clip.get_frame(0).astype(np.float32)
+        if clip.mask is not None:
+            alpha = clip.mask.get_frame(0).astype(np.float32)
+        else:
+            alpha = np.ones(rgb.shape[:2], dtype=np.float32)
+
+        h, w = alpha.shape
+        x = (frame_w - w) // 2  # ✅ النص دايماً في المنتصف
+        y = int(y)
+
+        # قص الجزء اللي خارج الفريم
+        src_top, src_left = max(0, -y), max(0, -x)
+        src_bottom, src_right = min(h, frame_h - y), min(w, frame_w - x)
+
+        # قص الصفوف الفاضية (شفافة بالكامل) عشان نقلل الحساب
+        rows = np.nonzero(alpha[src_top:src_bottom, src_left:src_right].max(axis=1) > 0)[0]
+        if len(rows) == 0:
+            self.empty = True
+            return
+        self.empty = False
+        src_top, src_bottom = src_top + rows[0], src_top + rows[-1] + 1
+
+        alpha = alpha[src_top:src_bottom, src_left:src_right, None]
+        self.alpha = alpha
+        self.inv_alpha = 1.0 - alpha
+        self.premult = rgb[src_top:src_bottom, src_left:src_right] * alpha
+        self.top, self.bottom = y + src_top, y + src_bottom
+        self.left, self.right = x + src_left, x + src_right
+
+    def blend(self, frame, k=1.0):
+        """دمج النص على الفريم (in-place) - k هو alpha الـ fade الحالي"""
+        region = frame[self.top:self.bottom, self.left:self.right]
+        if k >= 1.0:
+            # ⚡ Fast path: مفيش fade - الجداول جاهزة
+            region *= self.inv_alpha
+            region += self.premult
+        else:
+            region *= 1.0 - k * self.alpha
+            region += k * self.premult
+
+class SegmentCompositor:
+    """تركيب فريمات القطعة (خلفية + تعتيم + نصوص) باستخدام الجداول المحسوبة مسبقاً"""
+
+    def __init__(self, bg_clip, static_gain, overlays, duration, fps, bg_curve=None, static_bg=False):
+        self.bg_clip = bg_clip
+        self.static_gain = static_gain
+        self.overlays = [o for o in overlays if not o.empty]
+        self.duration = duration
+        self.fps = fps
+        self.text_curve = build_fade_curve(duration, fps, TEXT_FADE, TEXT_FADE)
+        self.bg_curve = bg_curve
+        self.last_frame = len(self.text_curve) - 1
+        # ✅ خلفية ثابتة (ColorClip) ومفيش fade للخلفية = كل الفريمات واحدة ما عدا fade النص
+        self.is_static = static_bg and bg_curve is None
+        self._static_frames = None
+
+    def frame_index(self, t):
+        return min(max(int(t * self.fps + 1e-6), 0), self.last_frame)
+
+    def background(self, t):
+        """قراءة فريم الخلفية (لازم تكون تسلسلية - الـ readers مش thread-safe)"""
+        return self.bg_clip.get_frame(t)
+
+    def compose_float(self, bg_frame, t, scratch=None, k_text=None):
+        """تركيب الفريم كـ float32 (قيم 0-255) - آمنة للتشغيل من أكتر من thread"""
+        i = self.frame_index(t)
+        frame = scratch if scratch is not None else np.empty(bg_frame.shape, dtype=np.float32)
+
+        k_bg = self.bg_curve[i] if self.bg_curve is not None else 1.0
+        if k_bg >= 1.0:
+            np.multiply(bg_frame, self.static_gain, out=frame)
+        else:
+            np.multiply(bg_frame, self.static_gain * k_bg, out=frame)
+
+        if k_text is None:
+            k_text = self.text_curve[i]
+        if k_text > 0:
+            for overlay in self.overlays:
+                overlay.blend(frame, k_text)
+
+        return frame
+
+    def prepare_static(self, converter):
+        """
+        للخلفية الثابتة: نركّب الفريم مرتين بس (من غير نص / بالنص كامل) في yuv420p
+        الدمج خطي في alpha، فأي فريم fade = base + k * (full - base)
+        """
+        if self._static_frames is not None:
+            return
+        bg_frame = self.background(0)
+        size = yuv420p_frame_size(bg_frame.shape[1], bg_frame.shape[0])
+        base = converter.convert(self.compose_float(bg_frame, 0, k_text=0.0), np.empty(size, dtype=np.uint8))
+        full = converter.convert(self.compose_float(bg_frame, 0, k_text=1.0), np.empty(size, dtype=np.uint8))
+        base_f = base.astype(np.float32) + 0.5
+        self._static_frames = (full, base_f, full.astype(np.float32) - base.astype(np.float32))
+
+    def static_frame(self, t, out, scratch):
+        """فريم yuv420p للخلفية الثابتة - الفريم الكامل بيرجع من الكاش بدون أي حساب"""
+        full, base_f, delta = self._static_frames
+        k_text = self.text_curve[self.frame_index(t)]
+        if k_text >= 1.0:
+            return full
+        np.multiply(delta, k_text, out=scratch)
+        np.add(scratch, base_f, out=scratch)
+        np.copyto(out, scratch, casting='unsafe')
+        return out
+
+    def compose(self, bg_frame, t, out, scratch=None):
+        """تركيب الفريم في out (uint8 RGB)"""
+        np.copyto(out, self.compose_float(bg_frame, t, scratch), casting='unsafe')
+        return out
+
+    def make_frame(self, t):
+        bg_frame = self.background(t)
+        return self.compose(bg_frame, t, np.empty(bg_frame.shape, dtype=np.uint8))
+
+    def to_clip(self):
+        return VideoClip(self.make_frame, duration=self.duration)
+
+# ==========================================
+# 🏭 Frame Pipeline - تركيب الفريمات بالتوازي مع الـ Encoder
+# ==========================================
+# moviepy بيبني كل فريم على thread واحد وبعدين يستنى ffmpeg يكتبه
+# هنا: thread بيقرا الخلفيات بالترتيب → pool بيركّب الفريمات في ring buffer → الكاتب بيبعتها للـ encoder بالترتيب
+
+def yuv420p_frame_size(width, height):
+    """حجم فريم yuv420p بالبايت (Y كامل + U و V ربع الحجم)"""
+    return width * height * 3 // 2
+
+# معاملات BT.601 limited range (نفس الافتراضي بتاع ffmpeg لتحويل rgb24 → yuv420p)
+_YUV_Y = np.array([[0.2568], [0.5041], [0.0979]], dtype=np.float32)
+_YUV_UV = np.array([[-0.1482, 0.4392], [-0.2910, -0.3678], [0.4392, -0.0714]], dtype=np.float32) / 4
+# ✅ كل صف في الفريم بيتقري كأزواج بكسلات (6 قيم) → ضرب واحد بيجمع الزوج الأفقي ويحسب U و V
+_YUV_UV_PAIRS = np.vstack([_YUV_UV, _YUV_UV])
+
+class Yuv420Converter:
+    """تحويل RGB → yuv420p بمصفوفات محجوزة مسبقاً (واحد لكل worker)"""
+
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.luma = np.empty((height * width, 1), dtype=np.float32)
+        self.chroma_rows = np.empty((height * (width // 2), 2), dtype=np.float32)
+        self.chroma = np.empty((height // 2, width // 2, 2), dtype=np.float32)
+
+    def convert(self, rgb, out):
+        """rgb: فريم (h, w, 3) float32 أو uint8 - out: buffer مسطح بحجم yuv420p_frame_size"""
+        h, w = self.height, self.width
+        y_size = w * h
+        c_size = y_size // 4
+        rgb = rgb if rgb.dtype == np.float32 else rgb.astype(np.float32)
+
+        np.matmul(rgb.reshape(-1, 3), _YUV_Y, out=self.luma)
+        np.add(self.luma, 16.5, out=self.luma)
+        np.copyto(out[:y_size], self.luma[:, 0], casting='unsafe')
+
+        # الـ chroma: متوسط كل 2x2 بكسل (أفقي في الضرب، رأسي بجمع كل صفين)
+        np.matmul(rgb.reshape(-1, 6), _YUV_UV_PAIRS, out=self.chroma_rows)
+        rows = self.chroma_rows.reshape(h // 2, 2, w // 2, 2)
+        np.add(rows[:, 0], rows[:, 1], out=self.chroma)
+        np.add(self.chroma, 128.5, out=self.chroma)
+        np.copyto(out[y_size:y_size + c_size].reshape(h // 2, w // 2), self.chroma[..., 0], casting='unsafe')
+        np.copyto(out[y_size + c_size:y_size + 2 * c_size].reshape(h // 2, w // 2), self.chroma[..., 1], casting='unsafe')
+        return out
+
+def rgb_to_yuv420p(rgb, out):
+    """تحويل فريم واحد لـ yuv420p (للاستخدام العابر - الـ pipeline بيستخدم Yuv420Converter)"""
+    h, w = rgb.shape[:2]
+    return Yuv420Converter(w, h).convert(rgb, out)
+
+class FrameTimeline:
+    """ربط رقم الفريم العام بالقطعة (SegmentCompositor) والوقت المحلي جواها"""
+
+    def __init__(self, compositors, fps):
+        self.compositors = compositors
+        self.fps = fps
+        self.starts = []
+        total = 0.0
+        for comp in compositors:
+            self.starts.append(total)
+            total += comp.duration
+        self.duration = total
+        self.n_frames = int(np.ceil(total * fps - 1e-6))
+
+    def locate(self, frame_idx):
+        t = frame_idx / self.fps
+        seg = max(0, bisect.bisect_right(self.starts, t) - 1)
+        return self.compositors[seg], min(t - self.starts[seg], self.compositors[seg].duration)
+
+class FramePipeline:
+    """
+    Pipeline من 3 مراحل:
+    1. source thread: يقرا فريم الخلفية (تسلسلي) ويحجز slot فاضي في الـ ring buffer
+    2. workers: يركّبوا الفريم في الـ slot (numpy بيسيب الـ GIL في العمليات الكبيرة)
+    3. writer (الـ thread الحالي): ياخد الفريمات بالترتيب ويكتبها للـ encoder
+    """
+
+    def __init__(self, timeline, size, workers=None, buffer_frames=None, pix_fmt='yuv420p'):
+        self.timeline = timeline
+        self.width, self.height = size
+        self.workers = workers or min(4, os.cpu_count() or 2)
+        self.buffer_frames = buffer_frames or self.workers * 3
+        self.pix_fmt = pix_fmt
+        # ✅ ring buffer محجوز مرة واحدة - yuv420p = نص حجم RGB والـ workers بيحولوه بنفسهم
+        if pix_fmt == 'yuv420p':
+            frame_shape = (yuv420p_frame_size(self.width, self.height),)
+        else:
+            frame_shape = (self.height, self.width, 3)
+        self.buffers = [np.empty(frame_shape, dtype=np.uint8) for _ in range(self.buffer_frames)]
+        self._scratch = threading.local()
+
+    def _worker_scratch(self):
+        scratch = getattr(self._scratch, 'frame', None)
+        if scratch is None:
+            scratch = np.empty((self.height, self.width, 3), dtype=np.float32)
+            self._scratch.frame = scratch
+            self._scratch.yuv = Yuv420Converter(self.width, self.height)
+        return scratch
+
+    def _compose(self, comp, bg_frame, t, slot):
+        if self.pix_fmt == 'yuv420p' and comp.is_static:
+            # ⚡ خلفية ثابتة: الفريم محسوب مسبقاً، والـ fade مجرد خلط بين فريمين
+            scratch = self._worker_scratch().reshape(-1)[:self.buffers[slot].size]
+            return comp.static_frame(t, self.buffers[slot], scratch)
+        if self.pix_fmt == 'yuv420p':
+            frame = comp.compose_float(bg_frame, t, scratch=self._worker_scratch())
+            return self._scratch.yuv.convert(frame, self.buffers[slot])
+        return comp.compose(bg_frame, t, self.buffers[slot], scratch=self._worker_scratch())
+
+    def _produce(self, executor, free_slots, ordered, stop_event):
+        static_converter = None
+        try:
+            for i in range(self.timeline.n_frames):
+                slot = None
+                while slot is None:
+                    if stop_event.is_set():
+                        return
+                    try:
+                        slot = free_slots.get(timeout=0.5)
+                    except queue.Empty:
+                        pass
+                comp, t = self.timeline.locate(i)
+                if self.pix_fmt == 'yuv420p' and comp.is_static:
+                    # الفريمين الثابتين بيتحسبوا هنا مرة واحدة (الـ source thread تسلسلي)
+                    if static_converter is None:
+                        static_converter = Yuv420Converter(self.width, self.height)
+                    comp.prepare_static(static_converter)
+                    bg_frame = None
+                else:
+                    bg_frame = comp.background(t)
+                ordered.put((slot, executor.submit(self._compose, comp, bg_frame, t, slot)))
+        except Exception as e:
+            ordered.put((None, e))
+
+    def run(self, write_frame, logger=None):
+        """تشغيل الـ pipeline - write_frame بتستقبل كل فريم (buffer من الـ ring) بالترتيب"""
+        free_slots = queue.Queue()
+        for slot in range(self.buffer_frames):
+            free_slots.put(slot)
+        ordered = queue.Queue(maxsize=self.buffer_frames)
+        stop_event = threading.Event()
+
+        frames = range(self.timeline.n_frames)
+        if logger is not None:
+            frames = logger.iter_bar(t=frames)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="FrameWorker") as executor:
+            producer = threading.Thread(
+                target=self._produce,
+                args=(executor, free_slots, ordered, stop_event),
+                daemon=True,
+                name="FrameSource"
+            )
+            producer.start()
+            try:
+                for _ in frames:
+                    slot, result = ordered.get()
+                    if slot is None:
+                        raise result
+                    write_frame(result.result())
+                    free_slots.put(slot)
+            finally:
+                stop_event.set()
+                # تفريغ الطابور عشان الـ producer ميفضلش مستني
+                while producer.is_alive():
+                    try:
+                        ordered.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                producer.join()
+
+def start_video_encoder(output_path, size, fps, audio_path=None, crf=24, preset='medium', threads=None, pix_fmt='yuv420p', tune=None):
+    """تشغيل ffmpeg بيستقبل فريمات خام من stdin (yuv420p جاهز = مفيش تحويل ألوان جوه ffmpeg)"""
+    cmd = [
+        FFMPEG_EXE, '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-vcodec', 'rawvideo',
+        '-s', f'{size[0]}x{size[1]}',
+        '-pix_fmt', pix_fmt,
+        '-r', f'{fps:.02f}',
+        '-i', '-',
+    ]
+    if audio_path:
+        cmd += ['-i', audio_path, '-c:a', 'aac', '-b:a', '128k']
+    cmd += ['-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p']
+    if tune:
+        cmd += ['-tune', tune]
+    if threads:
+        cmd += ['-threads', str(threads)]
+    cmd += [output_path]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+def encode_timeline(timeline, size, output_path, audio_path=None, crf=24, preset='medium', logger=None, pix_fmt='yuv420p', tune=None):
+    """رندر الـ timeline كلها عن طريق FramePipeline → ffmpeg"""
+    proc = start_video_encoder(output_path, size, timeline.fps, audio_path, crf, preset, threads=os.cpu_count() or 4, pix_fmt=pix_fmt, tune=tune)
+
+    def write_frame(frame):
+        try:
+            # ✅ memoryview = بنكتب من الـ ring buffer مباشرة من غير نسخة bytes
+            proc.stdin.write(memoryview(frame))
+        except (BrokenPipeError, OSError):
+            proc.kill()
+            _, err = proc.communicate()
+            raise Exception(f"FFMPEG encoder failed: {err.decode(errors='ignore').strip()}")
+
+    try:
+        FramePipeline(timeline, size, pix_fmt=pix_fmt).run(write_frame, logger=logger)
+    except Exception:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        raise
+
+    proc.stdin.close()
+    err = proc.stderr.read()
+    if proc.wait() != 0:
+        raise Exception(f"FFMPEG encoder failed: {err.decode(errors='ignore').strip()}")
 
-    # ✅ تحديد اتجاه الفيديو حسب الأبعاد
+# ==========================================
+# 🌐 Query Translation - ترجمة بحث الخلفية مرة واحدة لكل query
+# ==========================================
+_ARABIC_MARKS = re.compile(r'[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]')  # تشكيل + تطويل
+
+def normalize_query(text):
+    """مفتاح موحد للـ query: بدون تشكيل/تطويل، مسافات موحدة، lowercase"""
+    text = unicodedata.normalize('NFKC', text or '')
+    text = _ARABIC_MARKS.sub('', text)
+    return ' '.join(text.split()).casefold()
+
+def translate_bg_query(custom_query, whitelist):
+    """
+    (الترجمة الإنجليزية، آمن ولا لأ) - من كاش SQLite لو الـ query اتترجمت قبل كده
+    قرار الأمان بيتحسب تاني من الترجمة المحفوظة لو الـ whitelist اتغيرت
+    """
+    key = normalize_query(custom_query)
+    whitelist_version = hashlib.sha1(' '.join(sorted(whitelist)).encode()).hexdigest()[:12]
+    cached = db_get_translation(key)
+    if cached:
+        q_trans = cached['translated']
+        if cached['whitelist_version'] == whitelist_version:
+            return q_trans, bool(cached['is_safe'])
+    else:
+        q_trans = GoogleTranslator(source='auto', target='en').translate(custom_query.strip()).lower()
+    is_safe = any(safe_word in q_trans for safe_word in whitelist)
+    try: db_save_translation(key, custom_query.strip(), q_trans, is_safe, whitelist_version)
+    except sqlite3.Error as e: print(f"⚠️ Translation cache write failed: {e}")
+    return q_trans, is_safe
+
+# ==========================================
+# 🔑 Pexels Search - كاش للنتايج + توزيع الطلبات على الـ API keys
+# ==========================================
+PEXELS_SEARCH_TTL = 6 * 3600        # نتايج البحث بتفضل صالحة 6 ساعات
+PEXELS_SEARCH_CACHE_MAX = 500
+PEXELS_SEARCH_PER_PAGE = 80         # أقصى حجم صفحة - ثابت عشان نفس الكاش ينفع أي count
+PEXELS_SEARCH_PAGES = 10            # الصفحة بتتختار عشوائي (بعد الكاش) عشان الخلفيات متتكررش
+PEXELS_KEY_COOLDOWN = 60            # لو الـ key اتعمله 429 من غير reset header
+PEXELS_SLOW_KEY_COOLDOWN = 30       # لو الطلب عمل timeout
+PEXELS_SEARCH_CACHE = {}
+PEXELS_SEARCH_LOCK = threading.Lock()
+
+class PexelsRateLimited(Exception):
+    pass
+
+class PexelsKeyScheduler:
+    """
+    بيختار الـ key اللي فاضله أكتر طلبات (من X-Ratelimit-Remaining)
+    والـ key اللي خلص أو عمل 429 بيتركن لحد وقت الـ reset
+    """
+
+    def __init__(self, keys):
+        self.lock = threading.Lock()
+        self.state = {k: {'remaining': None, 'sidelined_until': 0.0, 'last_used': 0.0} for k in keys}
+        # ✅ في الـ logs والـ health بنعرض رقم الـ key بس - ولا حرف من الـ key نفسه
+        self.labels = {k: f"key#{i}" for i, k in enumerate(keys, 1)}
+
+    def label(self, key):
+        return self.labels.get(key, 'user key')
+
+    def acquire(self, exclude=()):
+        """أحسن key متاح دلوقتي - None لو كلهم متركنين"""
+        now = time.time()
+        with self.lock:
+            available = [k for k, st in self.state.items() if k not in exclude and st['sidelined_until'] <= now]
+            if not available:
+                return None
+            # المجهول (لسه ماتجربش) بيتعامل كأنه مليان - والتعادل بيروح للأقل استخداماً مؤخراً
+            key = max(available, key=lambda k: (
+                self.state[k]['remaining'] if self.state[k]['remaining'] is not None else float('inf'),
+                -self.state[k]['last_used']
+            ))
+            self.state[key]['last_used'] = now
+            return key
+
+    def report(self, key, response=None, slow=False):
+        """تحديث حالة الـ key من headers الرد"""
+        st = self.state.get(key)
+        if st is None:
+            return
+        now = time.time()
+        with self.lock:
+            if slow:
+                st['sidelined_until'] = now + PEXELS_SLOW_KEY_COOLDOWN
+                return
+            headers = response.headers
+            try: st['remaining'] = int(headers.get('X-Ratelimit-Remaining'))
+            except (TypeError, ValueError): pass
+            try: reset_at = float(headers.get('X-Ratelimit-Reset'))
+            except (TypeError, ValueError): reset_at = now + PEXELS_KEY_COOLDOWN
+            if response.status_code == 429 or st['remaining'] == 0:
+                st['sidelined_until'] = max(reset_at, now + 1)
+                print(f"🔑 Pexels {self.label(key)} sidelined for {int(st['sidelined_until'] - now)}s")
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return {self.label(k): {'remaining': st['remaining'], 'sidelined': st['sidelined_until'] > now} for k, st in self.state.items()}
+
+PEXELS_KEYS = PexelsKeyScheduler(PEXELS_API_KEYS)
+
+def _pexels_request(key, params):
+    try:
+        r = requests.get("https://api.pexels.com/videos/search", params=params, headers={'Authorization': key}, timeout=10)
+    except requests.exceptions.Timeout:
+        PEXELS_KEYS.report(key, slow=True)
+        raise
+    PEXELS_KEYS.report(key, r)
+    if r.status_code == 429:
+        raise PexelsRateLimited(f"Pexels {PEXELS_KEYS.label(key)} rate limited")
+    r.raise_for_status()
+    return r.json().get('videos', [])
+
+def pexels_search(query, orientation, user_key=None, job_id=None, extra_words=()):
+    """
+    بحث Pexels بكاش (query, orientation) - الطلب بيروح لمفتاح المستخدم الأول
+    وبعدين لأحسن key في الـ scheduler، ولو key عمل 429 بنجرب اللي بعده فوراً
+    الصفحة العشوائية والكلمة الإضافية (extra_words) بيتختاروا بعد الكاش بس - مش جزء من المفتاح
+    """
+    cache_key = (normalize_query(query), orientation)
+    now = time.time()
+    with PEXELS_SEARCH_LOCK:
+        cached = PEXELS_SEARCH_CACHE.get(cache_key)
+        if cached and now - cached[0] < PEXELS_SEARCH_TTL:
+            return cached[1]
+
+    search_query = f"{query} {random.choice(extra_words)}" if extra_words else query
+    params = {'query': search_query, 'per_page': PEXELS_SEARCH_PER_PAGE, 'page': random.randint(1, PEXELS_SEARCH_PAGES), 'orientation': orientation}
+    tried = set()
+    key = user_key
+    while True:
+        if not key:
+            key = PEXELS_KEYS.acquire(exclude=tried)
+            if not key:
+                raise PexelsRateLimited("No Pexels API key available")
+        check_stop(job_id)
+        tried.add(key)
+        try:
+            videos = _pexels_request(key, params)
+            break
+        except (PexelsRateLimited, requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            print(f"⚠️ Pexels search failed: {e}")
+            key = None
+
+    if not videos:
+        return videos  # صفحة فاضية مش بتتكاش (المرة الجاية صفحة تانية)
+    with PEXELS_SEARCH_LOCK:
+        if len(PEXELS_SEARCH_CACHE) >= PEXELS_SEARCH_CACHE_MAX:
+            # نشيل الأقدم
+            for k in sorted(PEXELS_SEARCH_CACHE, key=lambda k: PEXELS_SEARCH_CACHE[k][0])[:PEXELS_SEARCH_CACHE_MAX // 10]:
+                PEXELS_SEARCH_CACHE.pop(k, None)
+        PEXELS_SEARCH_CACHE[cache_key] = (now, videos)
+    return videos
+
+# ==========================================
+# 🌄 Background Pool - تنزيل الخلفيات بالتوازي
+# ==========================================
+BG_DOWNLOAD_WORKERS = 4
+BG_DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=BG_DOWNLOAD_WORKERS, thread_name_prefix="bg-download")
+
+def ready_future(value):
+    f = Future()
+    f.set_result(value)
+    return f
+
+class VideoPool:
+    """
+    خلفيات الـ job بالترتيب - كل خانة Future بتتنزل في الخلفية
+    الـ render بيبدأ أول ما الخلفية الأولى تجهز، وكل آية بتستنى خلفيتها هي بس
+    """
+
+    def __init__(self, paths=()):
+        self.slots = [ready_future(p) for p in paths]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __getitem__(self, i):
+        """مسار الخلفية (بيستنى لو لسه بتتنزل) - None لو التنزيل فشل"""
+        try: return self.slots[i].result()
+        except Exception as e:
+            print(f"⚠️ Background {i} unavailable: {e}")
+            return None
+
+    def extend(self, other):
+        self.slots.extend(other.slots)
+        return self
+
+    def ready_paths(self):
+        return [f.result() for f in self.slots if f.done() and not f.cancelled() and not f.exception() and f.result()]
+
+    def cancel(self):
+        for f in self.slots: f.cancel()
+
+def rendition_covers(aspect_ratio, min_size):
+    """دالة بتقول الفيديو ({'width', 'height'}) بيغطي الأبعاد المطلوبة من غير تكبير ولا لأ"""
+    target_w, target_h = min_size
+    if aspect_ratio == '16:9':
+        # أفقي: بنعمل resize للعرض
+        return lambda vf: vf['width'] >= target_w
+    if aspect_ratio == '1:1':
+        return lambda vf: vf['height'] >= target_h and vf['width'] * target_h / vf['height'] >= target_w
+    # عمودي: بنعمل resize للارتفاع
+    return lambda vf: vf['height'] >= target_h
+
+def pick_rendition(video_files, aspect_ratio, min_size):
+    """
+    أصغر نسخة من الفيديو بتغطي الأبعاد المطلوبة من غير تكبير (أقل حجم تنزيل وأقل resize)
+    لو مفيش نسخة كفاية: أكبر نسخة متاحة
+    """
+    if aspect_ratio == '16:9':
+        orientation_ok = lambda vf: vf['width'] >= vf['height']
+    elif aspect_ratio == '1:1':
+        orientation_ok = lambda vf: True
+    else:
+        orientation_ok = lambda vf: vf['height'] > vf['width']
+    covers = rendition_covers(aspect_ratio, min_size)
+    files = [vf for vf in video_files if vf.get('link') and vf.get('width') and vf.get('height') and vf.get('file_type', 'video/mp4') == 'video/mp4']
+    matching = [vf for vf in files if orientation_ok(vf)] or files
+    if not matching:
+        return video_files[0] if video_files else None
+    covering = [vf for vf in matching if covers(vf)]
+    if covering:
+        return min(covering, key=lambda vf: vf['width'] * vf['height'])
+    return max(matching, key=lambda vf: vf['width'] * vf['height'])
+
+def download_background(candidates, lock, job_id, dest_dir=VISION_DIR, token=None):
+    """
+    تنزيل خلفية واحدة - لو فشلت بناخد المرشح اللي بعده من القائمة المشتركة
+    token: بيتعمله set في آخر build_video_task - التنزيلات اللي لسه شغالة بتقف مع الـ cleanup
+    """
+    while True:
+        check_token(token)
+        check_stop(job_id)
+        with lock:
+            if not candidates:
+                return None
+            name, link = candidates.pop(0)
+        path = os.path.join(dest_dir, name)
+        try:
+            if not os.path.exists(path): smart_download(link, path, job_id, token)
+            return path
+        except JobStopped:
+            raise
+        except Exception as e:
+            print(f"⚠️ Background download failed ({name}): {e}")
+
+# ==========================================
+# 🗂️ Local Background Library - فهرس الخلفيات المحلية
+# ==========================================
+LOCAL_BG_EXTENSIONS = ('.mp4', '.mov', '.mkv')
+LOCAL_BG_SYNC_INTERVAL = 60      # أقصى معدل لإعادة فحص المجلد
+LOCAL_BG_MIN_DURATION = 5.0      # أقل مدة مفضلة (أقصر من كده = loop كتير)
+LOCAL_BG_LOCK = threading.Lock()
+LOCAL_BG_LAST_SYNC = 0.0
+
+def probe_video(path):
+    """بيانات الفيديو من ffprobe: الأبعاد (بعد الـ rotation) والمدة والـ fps والـ codec والـ tags"""
+    proc = subprocess.run(
+        [FFPROBE_EXE, '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'stream=width,height,codec_name,avg_frame_rate,r_frame_rate:stream_tags=rotate:stream_side_data=rotation:format=duration:format_tags',
+         '-of', 'json', path],
+        capture_output=True, text=True, timeout=30
+    )
+    if proc.returncode != 0:
+        raise Exception(f"ffprobe failed for {path}: {proc.stderr.strip()[-200:]}")
+    data = json.loads(proc.stdout or '{}')
+    stream = (data.get('streams') or [{}])[0]
+    fmt = data.get('format') or {}
+    width, height = int(stream.get('width') or 0), int(stream.get('height') or 0)
+    rotation = stream.get('tags', {}).get('rotate') or next((sd.get('rotation') for sd in stream.get('side_data_list', []) if 'rotation' in sd), 0)
+    if abs(int(float(rotation or 0))) % 180 == 90:
+        width, height = height, width
+
+    def parse_rate(rate):
+        try:
+            num, den = (rate or '0/1').split('/')
+            return float(num) / float(den) if float(den) else 0.0
+        except ValueError:
+            return 0.0
+
+    # tags: كلمات اسم الملف + title/comment/keywords من الـ metadata
+    words = re.split(r'[^a-z\u0600-\u06ff]+', os.path.splitext(os.path.basename(path))[0].lower())
+    fmt_tags = fmt.get('tags', {})
+    for field in ('title', 'comment', 'keywords', 'description'):
+        words += re.split(r'[^a-z\u0600-\u06ff]+', str(fmt_tags.get(field, fmt_tags.get(field.upper(), ''))).lower())
+    tags = ' '.join(sorted({w for w in words if len(w) > 1}))
+    return {
+        'width': width, 'height': height,
+        'duration': float(fmt.get('duration') or 0.0),
+        'fps': parse_rate(stream.get('avg_frame_rate')) or parse_rate(stream.get('r_frame_rate')),
+        'codec': stream.get('codec_name'),
+        'tags': tags,
+    }
+
+def sync_local_backgrounds(force=False):
+    """
+    تحديث الفهرس تدريجياً: probe للملفات الجديدة أو اللي اتغير حجمها/وقتها بس
+    والملفات المحذوفة بتتشال من الفهرس
+    """
+    global LOCAL_BG_LAST_SYNC
+    with LOCAL_BG_LOCK:
+        if not force and time.time() - LOCAL_BG_LAST_SYNC < LOCAL_BG_SYNC_INTERVAL:
+            return
+        LOCAL_BG_LAST_SYNC = time.time()
+        indexed = {row['path']: row for row in db_get_local_backgrounds()}
+        seen = set()
+        probed = 0
+        try: entries = list(os.scandir(LOCAL_BGS_DIR))
+        except OSError: entries = []
+        for entry in entries:
+            if not entry.is_file() or not entry.name.lower().endswith(LOCAL_BG_EXTENSIONS):
+                continue
+            seen.add(entry.path)
+            st = entry.stat()
+            row = indexed.get(entry.path)
+            if row and row['size'] == st.st_size and row['mtime'] == st.st_mtime:
+                continue
+            try:
+                info = probe_video(entry.path)
+            except Exception as e:
+                print(f"⚠️ Local background probe failed ({entry.name}): {e}")
+                continue
+            info.update({'path': entry.path, 'size': st.st_size, 'mtime': st.st_mtime, 'probed_at': time.time()})
+            db_save_local_background(info)
+            probed += 1
+        db_delete_local_backgrounds([p for p in indexed if p not in seen])
+        if probed:
+            print(f"🗂️ Indexed {probed} local backgrounds")
+
+def select_local_backgrounds(count, aspect_ratio, min_size, min_duration=0.0, tags=()):
+    """
+    اختيار count خلفية محلية: نفس الاتجاه ومدة كافية، والأولوية للي مش محتاج scaling خالص
+    بعدها اللي محتاج تصغير بس، وبعدها الباقي - والـ tags المطابقة للبحث بتتقدم جوه كل مستوى
+    """
+    sync_local_backgrounds()
+    rows = [r for r in db_get_local_backgrounds() if r['width'] and r['height'] and os.path.exists(r['path'])]
+    if not rows:
+        return []
+    target_w, target_h = min_size
     if aspect_ratio == '16:9':
-        orientation = 'landscape'  # أفقي
-        video_filter = lambda vf: vf['width'] > vf['height']  # فيديو أفقي
+        orientation_ok = lambda r: r['width'] > r['height']
     elif aspect_ratio == '1:1':
-        orientation = 'square'  # مربع
-        video_filter = lambda vf: True  # أي فيديو
+        orientation_ok = lambda r: abs(r['width'] - r['height']) <= 0.1 * max(r['width'], r['height'])
     else:
-        orientation = 'portrait'  # عمودي (الافتراضي)
-        video_filter = lambda vf: vf['height'] > vf['width']  # فيديو عمودي
+        orientation_ok = lambda r: r['height'] > r['width']
+
+    def scale_tier(r):
+        if (r['width'], r['height']) == (target_w, target_h):
+            return 0   # بدون resize ولا crop
+        if r['width'] >= target_w and r['height'] >= target_h:
+            return 1   # تصغير بس
+        return 2       # تكبير
+
+    wanted = {t.lower() for t in tags if len(t) > 1}
+    def rank(r):
+        tag_hits = len(wanted & set((r['tags'] or '').split()))
+        return (scale_tier(r), -tag_hits, random.random())
+
+    # لو مفيش حاجة مطابقة: نخفف الشروط (المدة الأول وبعدين الاتجاه)
+    for candidates in (
+        [r for r in rows if orientation_ok(r) and (r['duration'] or 0) >= min_duration],
+        [r for r in rows if orientation_ok(r)],
+        rows,
+    ):
+        if candidates:
+            break
+    ranked = [r['path'] for r in sorted(candidates, key=rank)]
+    # لو الخلفيات أقل من المطلوب بنكرر بنفس الترتيب
+    return [ranked[i % len(ranked)] for i in range(count)]
+
+def fit_background(clip, aspect_ratio, target_w, target_h):
+    """resize + crop للوسط - ولو الفيديو بالأبعاد المطلوبة بالظبط بيرجع زي ما هو"""
+    if tuple(clip.size) == (target_w, target_h):
+        return clip
+    if aspect_ratio == '16:9':
+        # أفقي: نعمل resize للعرض
+        clip = clip.resize(width=target_w)
+    else:
+        # عمودي أو مربع: نعمل resize للارتفاع
+        clip = clip.resize(height=target_h)
+    # crop للوسط
+    return clip.crop(width=target_w, height=target_h, x_center=clip.w/2, y_center=clip.h/2)
+
+def fetch_video_pool(user_key, custom_query, count=1, job_id=None, aspect_ratio='9:16', min_size=None, dest_dir=VISION_DIR):
+    """
+    يرجع VideoPool فيه count خلفية - التنزيل بيحصل بالتوازي (BG_DOWNLOAD_WORKERS) بالترتيب
+    dest_dir: مكان التنزيل (المعاينة بتنزل في الـ workspace بتاعها)
+    """
+    pool = VideoPool()
+    min_size = min_size or get_target_size(aspect_ratio, '1080')[:2]
+    user_key = user_key if user_key and len(user_key) > 10 else None
+    has_key = bool(user_key or PEXELS_API_KEYS)
     
     # ✅ الكلمات الآمنة المسموح بها
     SAFE_WHITELIST =[
@@ -1094,138 +3105,282 @@ def fetch_video_pool(user_key, custom_query, count=1, job_id=None, aspect_ratio=
                 return False
         return True
 
+    extra_words = ()
     if custom_query and len(custom_query) > 2:
         try: 
-            q_trans = GoogleTranslator(source='auto', target='en').translate(custom_query.strip()).lower()
-            is_safe = any(safe_word in q_trans for safe_word in SAFE_WHITELIST)
-            # ✅ نضيف كلمات إيجابية بدل السلبية
-            positive = random.choice(POSITIVE_WORDS)
-            q = f"{q_trans} landscape scenery {positive}" if is_safe else random.choice(safe_topics)
+            q_trans, is_safe = translate_bg_query(custom_query, SAFE_WHITELIST)
+            # ✅ نضيف كلمات إيجابية بدل السلبية (بتتضاف للطلب بس لو مفيش كاش للـ query)
+            q = f"{q_trans} landscape scenery" if is_safe else random.choice(safe_topics)
+            extra_words = POSITIVE_WORDS if is_safe else ()
         except: 
             q = random.choice(safe_topics)
     else:
         q = random.choice(safe_topics)
 
-    if active_key:
+    if has_key:
         try:
             check_stop(job_id)
             # ✅ استخدام الـ orientation المناسب حسب الأبعاد
             pexels_orientation = 'landscape' if aspect_ratio == '16:9' else ('square' if aspect_ratio == '1:1' else 'portrait')
-            url = f"https://api.pexels.com/videos/search?query={q}&per_page={count+10}&page={random.randint(1, 10)}&orientation={pexels_orientation}"
-            r = requests.get(url, headers={'Authorization': active_key}, timeout=10)
-            if r.status_code == 200:
-                vids = r.json().get('videos',[])
+            vids = list(pexels_search(q, pexels_orientation, user_key=user_key, job_id=job_id, extra_words=extra_words))
+            if vids:
                 random.shuffle(vids)
+                candidates = []
                 for vid in vids:
-                    if len(pool) >= count: break
-                    check_stop(job_id)
-                    
                     # 🚫 فلترة: نتأكد إن الفيديو آمن
                     if not is_video_safe(vid):
                         continue  # نتخطى الفيديو ده
                     
-                    # ✅ اختيار الفيديو المناسب حسب الأبعاد
-                    if aspect_ratio == '16:9':
-                        # أفقي: نختار فيديو عرضه أكبر من ارتفاعه
-                        f = next((vf for vf in vid['video_files'] if vf['width'] <= 1920 and vf['width'] >= vf['height']), None)
-                    elif aspect_ratio == '1:1':
-                        # مربع: أي فيديو
-                        f = next((vf for vf in vid['video_files'] if vf['width'] <= 1080), None)
-                    else:
-                        # عمودي (الافتراضي): نختار فيديو ارتفاعه أكبر من عرضه
-                        f = next((vf for vf in vid['video_files'] if vf['width'] <= 1080 and vf['height'] > vf['width']), None)
-                    if not f and vid['video_files']: f = vid['video_files'][0]
+                    # ✅ أصغر نسخة بتغطي الأبعاد المطلوبة
+                    f = pick_rendition(vid.get('video_files', []), aspect_ratio, min_size)
                     if f:
-                        path = os.path.join(VISION_DIR, f"bg_{vid['id']}.mp4")
-                        if not os.path.exists(path): smart_download(f['link'], path, job_id)
-                        pool.append(path)
+                        candidates.append((f"bg_{vid['id']}_{f.get('width')}x{f.get('height')}.mp4", f['link']))
+
+                # ⚡ count تنزيلة متوازية بالترتيب - والمرشحين الزيادة احتياطي لو واحدة فشلت
+                lock = threading.Lock()
+                token = CANCEL_TOKENS.get(job_id)
+                for _ in range(min(count, len(candidates))):
+                    pool.slots.append(BG_DOWNLOAD_EXECUTOR.submit(download_background, candidates, lock, job_id, dest_dir, token))
         except: pass
 
-    if not pool:
+    if not pool:
+        try:
+            local_files = select_local_backgrounds(count, aspect_ratio, min_size, min_duration=LOCAL_BG_MIN_DURATION, tags=q.split())
+            if local_files: pool = VideoPool(local_files)
+        except Exception as e:
+            print(f"⚠️ Local backgrounds unavailable: {e}")
+            
+    return pool
+
+# ==========================================
+# 🔊 Loudness Analysis - قياس مرة واحدة لكل (قارئ، سورة)
+# ==========================================
+# loudnorm العادي (single-pass) بطيء وبيدي نتايج مختلفة لكل مقطع قصير
+# هنا: بنقيس السورة كلها مرة واحدة (بعد الـ EQ والـ compressor) ونحفظ القياس جنب الصوت
+# وكل رندر بعد كده بيستخدم loudnorm linear بالقيم المحفوظة = نفس الـ gain لكل ريلز من نفس السورة
+
+LOUDNESS_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Loudness")
+LOUDNESS_LOCK = threading.Lock()
+LOUDNESS_PENDING = {}  # مسار ملف القياس -> Future (عشان مفيش قياسين لنفس السورة في نفس الوقت)
+LOUDNESS_WAIT_TIMEOUT = 120  # ثانية - بعدها نرجع للـ loudnorm العادي
+
+def measure_loudness(source_path, cache_path):
+    """قياس loudness لملف صوت كامل (pass أول) وحفظ النتيجة في cache_path"""
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+
+    cmd = [
+        FFMPEG_EXE, '-hide_banner', '-nostats',
+        '-i', source_path,
+        '-af', f"{STUDIO_PRE_FILTER}, loudnorm={LOUDNORM_TARGET}:print_format=json",
+        '-f', 'null', '-'
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"Loudness measurement failed: {result.stderr.decode(errors='ignore')[-500:]}")
+
+    # loudnorm بيطبع JSON في آخر الـ stderr
+    stderr = result.stderr.decode(errors='ignore')
+    stats = json.loads(stderr[stderr.rindex('{'):stderr.rindex('}') + 1])
+    loudness = {
+        'measured_I': stats['input_i'],
+        'measured_TP': stats['input_tp'],
+        'measured_LRA': stats['input_lra'],
+        'measured_thresh': stats['input_thresh'],
+        'offset': stats['target_offset'],
+    }
+    with open(cache_path, 'w') as f:
+        json.dump(loudness, f)
+    return loudness
+
+def request_source_loudness(reciter_key, surah):
+    """
+    بدء قياس الـ loudness للسورة في الخلفية (لو مش متقاسة) - يرجع Future أو None
+    متاح بس لقراء mp3quran (عندنا ملف السورة كامل)
+    """
+    if reciter_key not in NEW_RECITERS_CONFIG:
+        return None
+    reciter_id = NEW_RECITERS_CONFIG[reciter_key][0]
+    source_path = mp3quran_cache_path(reciter_id, surah, "mp3")
+    cache_path = mp3quran_cache_path(reciter_id, surah, "loudness.json")
+    if not os.path.exists(source_path):
+        return None
+
+    with LOUDNESS_LOCK:
+        future = LOUDNESS_PENDING.get(cache_path)
+        if future is None:
+            future = LOUDNESS_EXECUTOR.submit(measure_loudness, source_path, cache_path)
+            LOUDNESS_PENDING[cache_path] = future
+            future.add_done_callback(lambda _f: LOUDNESS_PENDING.pop(cache_path, None))
+            # ✅ بعد ما القياس يتكتب - نفس عمر الـ mp3 (قبل كده الملف مكانش موجود أصلاً)
+            future.add_done_callback(lambda _f: touch_surah_cache(reciter_id, surah))
+        return future
+
+def build_mastering_filter(loudness=None):
+    """سلسلة الـ mastering - linear loudnorm بالقيم المحفوظة لو متاحة، وإلا loudnorm العادي"""
+    if not loudness:
+        return STUDIO_DRY_FILTER
+    measured = ':'.join(f"{k}={loudness[k]}" for k in ('measured_I', 'measured_TP', 'measured_LRA', 'measured_thresh', 'offset'))
+    return f"{STUDIO_PRE_FILTER}, loudnorm={LOUDNORM_TARGET}:{measured}:linear=true"
+
+def master_audio(input_path, output_path, audio_filter=STUDIO_DRY_FILTER):
+    """
+    تطبيق فلتر الـ mastering على الصوت المجمّع (WAV) قبل دمجه مع الفيديو
+    يرجع مسار الصوت اللي هيتستخدم - الأصلي لو الفلتر فشل
+    """
+    cmd = [
+        FFMPEG_EXE, '-y', '-loglevel', 'error',
+        '-i', input_path,
+        '-af', audio_filter,
+        '-ar', '44100',  # loudnorm بيرفع الـ sample rate لـ 192k
+        '-c:a', 'pcm_s16le',
+        output_path
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        # في حال فشل الفلتر لأي سبب، نستخدم الصوت الأصلي
+        print(f"[WARNING] Audio mastering failed, using unmastered audio: {result.stderr.decode(errors='ignore').strip()}")
+        return input_path
+    return output_path
+
+# ==========================================
+# 👁️ Preview Proxy - معاينة سريعة قبل الرندر الكامل
+# ==========================================
+PREVIEW_SCALE = 0.5          # نص أبعاد الـ 720p (مثلاً 360x640 للريلز)
+PREVIEW_MAX_SECONDS = 8.0    # أول آية بس، وبحد أقصى 8 ثواني
+PREVIEW_FPS = 15
+PREVIEW_PRESET = 'ultrafast'
+PREVIEW_CRF = 30
+PREVIEW_BG_SUBDIR = 'backgrounds'  # خلفيات المعاينة جوه الـ workspace بتاعها
+
+def get_target_size(aspect_ratio, quality, preview=False):
+    """
+    تحديد الأبعاد ومعامل تكبير النص بناءً على aspect_ratio و quality
+    9:16 = ريلز/تيك توك (portrait), 1:1 = سوير (square), 16:9 = يوتيوب (landscape)
+    """
+    if aspect_ratio == '1:1':
+        # مربع (سوير/انستجرام)
+        target_w, target_h = (1080, 1080) if quality == '1080' else (720, 720)
+    elif aspect_ratio == '16:9':
+        # أفقي (يوتيوب)
+        target_w, target_h = (1920, 1080) if quality == '1080' else (1280, 720)
+    else:
+        # 9:16 - الافتراضي (ريلز/تيك توك)
+        target_w, target_h = (1080, 1920) if quality == '1080' else (720, 1280)
+
+    scale = 1.0 if quality == '1080' else 0.67
+    if preview:
+        # المعاينة دايماً على أساس 720p متصغرة (الأبعاد لازم تكون زوجية لـ yuv420p)
+        base_w, base_h = get_target_size(aspect_ratio, '720')[:2]
+        target_w = int(base_w * PREVIEW_SCALE) // 2 * 2
+        target_h = int(base_h * PREVIEW_SCALE) // 2 * 2
+        scale = 0.67 * PREVIEW_SCALE
+    return target_w, target_h, scale
+
+def get_preview_bg_pool(preview_job_id, session_id, aspect_ratio='9:16', quality='720'):
+    """
+    خلفيات المعاينة (لو لسه موجودة) عشان الرندر الكامل يستخدمها بدل ما يحمّل من جديد
+    بس لو المعاينة من نفس الـ session، والخلفية مغطية أبعاد الرندر الكامل (وإلا هتتكبر وتبقى مش واضحة)
+    """
+    if not preview_job_id or not session_id:
+        return None
+    # ✅ من SQLite مش الـ RAM - المعاينة ممكن تكون اترندرت في worker تاني
+    db_job = db_get_job(preview_job_id)
+    if not db_job or db_job['session_id'] != session_id:
+        return None
+    covers = rendition_covers(aspect_ratio, get_target_size(aspect_ratio, quality)[:2])
+    pool = []
+    for p in json.loads(db_job['bg_pool_json'] or '[]'):
+        if not os.path.exists(p):
+            continue
         try:
-            local_files =[os.path.join(LOCAL_BGS_DIR, f) for f in os.listdir(LOCAL_BGS_DIR) if f.lower().endswith(('.mp4', '.mov', '.mkv'))]
-            if local_files: pool = random.choices(local_files, k=count)
-        except: pass
-            
-    return pool
+            if covers(probe_video(p)):
+                pool.append(p)
+        except Exception as e:
+            print(f"⚠️ Preview background skipped ({os.path.basename(p)}): {e}")
+    return pool or None
 
 # ==========================================
 # ⚡ Optimized Video Builder (Segmented / Chunked)
 # ==========================================
-def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, quality, bg_query, fps, dynamic_bg, use_glow, use_vignette, aspect_ratio, style, font_name='Arabic', font_name_en='English'):
+def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, quality, bg_query, fps, dynamic_bg, use_glow, use_vignette, aspect_ratio, style, font_name='Arabic', font_name_en='English', preview=False, bg_pool=None):
     job = get_job(job_id)
     if not job:
         raise Exception(f"Job {job_id} not found - cannot process video")
+    # ✅ تسجيل الـ token - check_stop بعد كده مش بيلمس JOBS ولا SQLite
+    token = cancel_token(job_id, stopped=job.get('should_stop', False))
+    # مين بيرندر الـ job - لو الـ process دي ماتت الـ leader الجديد يلاقيه (recover_orphaned_jobs)
+    db_update_job(job_id, runner=runner_id())
 
     workspace = job['workspace']
     if not workspace:
         raise Exception(f"Job {job_id} has no workspace")
+    # 👁️ خلفيات المعاينة في الـ workspace بتاعها (VISION_DIR بيتمسح بعد كل رندر كامل)
+    # وبتفضل لحد ما db_cleanup_old_jobs يمسح الـ workspace عشان الرندر الكامل يستخدمها
+    bg_dir = os.path.join(workspace, PREVIEW_BG_SUBDIR) if preview else VISION_DIR
+    if preview:
+        os.makedirs(bg_dir, exist_ok=True)
 
     # ✅ تحديد مسار الخط
     font_path = get_font_path(font_name)
     font_path_en = get_font_path_en(font_name_en)
 
     # تحديد الأبعاد بناءً على aspect_ratio و quality
-    # 9:16 = ريلز/تيك توك (portrait), 1:1 = سوير (square), 16:9 = يوتيوب (landscape)
-    if aspect_ratio == '1:1':
-        # مربع (سوير/انستجرام)
-        target_w, target_h = (1080, 1080) if quality == '1080' else (720, 720)
-    elif aspect_ratio == '16:9':
-        # أفقي (يوتيوب)
-        target_w, target_h = (1920, 1080) if quality == '1080' else (1280, 720)
-    else:
-        # 9:16 - الافتراضي (ريلز/تيك توك)
-        target_w, target_h = (1080, 1920) if quality == '1080' else (720, 1280)
-    
-    scale = 1.0 if quality == '1080' else 0.67
+    target_w, target_h, scale = get_target_size(aspect_ratio, quality, preview)
     last = min(end if end else start+9, VERSE_COUNTS.get(surah, 286))
+    if preview:
+        # 👁️ المعاينة: أول آية بس وبـ fps أقل
+        last = start
+        fps = min(fps, PREVIEW_FPS)
     total_ayahs = (last - start) + 1
+    rendered_duration = 0.0
+    loudness_future = None
     
     # مصفوفات لتخزين الملفات المفتوحة لإغلاقها في الـ finally لعدم تسريب الذاكرة
-    audio_clips_to_close =[]
     video_clips_to_close = []
-    final_segments =[]
+    segment_compositors = []
+    audio_track = AudioTrack()
+    vpool = VideoPool()
+    progress = ProgressReporter(job_id)
+
+    # 👁️ خلفيات المعاينة بتتنزل بأبعاد الرندر الكامل (مش الـ proxy) عشان الرندر الكامل يستخدمها زي ما هي
+    bg_min_size = get_target_size(aspect_ratio, quality)[:2] if preview else (target_w, target_h)
 
     try:
-        # 1. Fetch Backgrounds
-        vpool = fetch_video_pool(user_pexels_key, bg_query, count=total_ayahs if dynamic_bg else 1, job_id=job_id, aspect_ratio=aspect_ratio)
+        # 1. Fetch Backgrounds (✅ نعيد استخدام خلفيات المعاينة لو موجودة)
+        bg_needed = total_ayahs if dynamic_bg else 1
+        vpool = VideoPool(list(bg_pool or [])[:bg_needed])
+        if len(vpool) < bg_needed:
+            vpool.extend(fetch_video_pool(user_pexels_key, bg_query, count=bg_needed - len(vpool), job_id=job_id, aspect_ratio=aspect_ratio, min_size=bg_min_size, dest_dir=bg_dir))
         
-        # 2. Prepare Base Background
-        if not vpool:
+        # 2. Prepare Base Background (بنستنى الخلفية الأولى بس - الباقي بيكمل تنزيل في الخلفية)
+        base_bg_path = vpool[0] if vpool else None
+        if not base_bg_path:
             base_bg_clip = ColorClip((target_w, target_h), color=(15, 20, 35))
         else:
-            bg_clip = VideoFileClip(vpool[0])
-            # ✅ نعمل resize حسب الأبعاد المناسبة
-            if aspect_ratio == '16:9':
-                # أفقي: نعمل resize للعرض
-                bg_clip = bg_clip.resize(width=target_w)
-            else:
-                # عمودي أو مربع: نعمل resize للارتفاع
-                bg_clip = bg_clip.resize(height=target_h)
-            # crop للوسط
-            base_bg_clip = bg_clip.crop(width=target_w, height=target_h, x_center=bg_clip.w/2, y_center=bg_clip.h/2)
+            # ✅ resize + crop حسب الأبعاد (مفيش scaling لو الفيديو مظبوط)
+            base_bg_clip = fit_background(VideoFileClip(base_bg_path), aspect_ratio, target_w, target_h)
             video_clips_to_close.append(base_bg_clip)
 
-        overlays_static =[ColorClip((target_w, target_h), color=(0,0,0)).set_opacity(0.45)]  # ✅ زودناه عشان الخلفيات الفاتحة
-        if use_vignette:
-            overlays_static.append(create_vignette_mask(target_w, target_h))
+        # ✅ التعتيم والـ vignette محسوبين مرة واحدة كمصفوفة ضرب
+        static_gain = build_static_gain(target_w, target_h, use_vignette)
 
         current_bg_time = 0.0
         
         # 4. معالجة الآيات 
         for i, ayah in enumerate(range(start, last+1)):
             check_stop(job_id)
-            update_job_status(job_id, int((i / total_ayahs) * 80), f'Processing Ayah {ayah}...')
+            progress.update(i, total_ayahs, f'Processing Ayah {ayah}...')
 
             # تحميل الصوت مع التحقق
             try:
-                ap = download_audio(reciter_id, surah, ayah, i, workspace, job_id)
-                if not os.path.exists(ap):
-                    raise Exception(f"Audio file not found: {ap}")
-                full_audioclip = AudioFileClip(ap)
-                if full_audioclip.duration <= 0:
-                    raise Exception(f"Invalid audio duration: {full_audioclip.duration}")
-                audio_clips_to_close.append(full_audioclip)
+                ayah_pcm = download_audio(reciter_id, surah, ayah, i, workspace, job_id)
+                if len(ayah_pcm) == 0:
+                    raise Exception(f"Invalid audio duration for ayah {ayah}")
+                # 🔊 قياس الـ loudness للسورة في الخلفية (مرة واحدة - بعد كده من الكاش)
+                if loudness_future is None and not preview:
+                    loudness_future = request_source_loudness(reciter_id, surah)
             except Exception as audio_err:
                 print(f"[ERROR] Audio download/processing failed for ayah {ayah}: {audio_err}")
                 continue  # Skip this ayah and continue with the next
@@ -1249,17 +3404,15 @@ def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, qua
             en_words = full_en_text.split()
             avg_en_per_ar = len(en_words) / len(ar_chunks) if len(ar_chunks) > 0 else 0
             
+            # ✅ حدود القطع = sample indices جوه PCM الآية
+            ayah_duration = len(ayah_pcm) / AUDIO_SAMPLE_RATE
             current_audio_time = 0.0
+            current_sample = 0
             
             # فتح فيديو الخلفية مرة واحدة للآية (إذا كان متغيراً) لتقليل استهلاك الرام
-            if dynamic_bg and i < len(vpool):
-                ayah_raw = VideoFileClip(vpool[i % len(vpool)])
-                # ✅ resize حسب الأبعاد
-                if aspect_ratio == '16:9':
-                    ayah_raw = ayah_raw.resize(width=target_w)
-                else:
-                    ayah_raw = ayah_raw.resize(height=target_h)
-                ayah_bg_clip = ayah_raw.crop(width=target_w, height=target_h, x_center=ayah_raw.w/2, y_center=ayah_raw.h/2)
+            ayah_bg_path = vpool[i] if dynamic_bg and i < len(vpool) else None
+            if ayah_bg_path:
+                ayah_bg_clip = fit_background(VideoFileClip(ayah_bg_path), aspect_ratio, target_w, target_h)
                 video_clips_to_close.append(ayah_bg_clip)
                 ayah_bg_time = 0.0
 
@@ -1269,21 +3422,21 @@ def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, qua
                 
                 # 1. تحديد وقت النهاية بدقة شديدة
                 if chunk_idx == len(ar_chunks) - 1:
-                    t_end = full_audioclip.duration # القطعة الأخيرة تاخد كل الباقي
+                    t_end = ayah_duration # القطعة الأخيرة تاخد كل الباقي
                 else:
                     ratio = len(ar_chunk.replace(" ", "")) / max(1, len(full_ar_text.replace(" ", "")))
-                    t_end = min(current_audio_time + (ratio * full_audioclip.duration), full_audioclip.duration)
+                    t_end = min(current_audio_time + (ratio * ayah_duration), ayah_duration)
 
                 # حماية من الأوقات الصفرية
                 if t_end - current_audio_time <= 0.05: 
-                    t_end = min(current_audio_time + 0.1, full_audioclip.duration)
+                    t_end = min(current_audio_time + 0.1, ayah_duration)
 
-                # 2. قص الصوت
-                chunk_audio = full_audioclip.subclip(current_audio_time, t_end)
+                # 2. حدود الصوت كـ sample indices (دقيقة على مستوى الـ sample)
+                end_sample = min(seconds_to_samples(t_end), len(ayah_pcm))
                 # بدون أي fade - الصوت الأصلي أنظف
                 
                 # 🚀 3. الحل الجذري: نعتمد وقت الصوت الفعلي كأساس لوقت الفيديو!
-                actual_duration = chunk_audio.duration
+                actual_duration = (end_sample - current_sample) / AUDIO_SAMPLE_RATE
                 if actual_duration <= 0: continue
                 
                 # ج. اقتطاع الترجمة الإنجليزية
@@ -1300,11 +3453,6 @@ def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, qua
                 ac = create_text_clip(display_ar, actual_duration, target_w, scale, use_glow, style=style, font_path=font_path)
                 ec = create_english_clip(en_chunk, actual_duration, target_w, scale, use_glow, style=style, font_path=font_path_en)
                 
-                # ✅ Crossfade للنص
-                TEXT_FADE = 0.35  # مدة crossfade النص
-                ac = ac.crossfadein(TEXT_FADE).crossfadeout(TEXT_FADE)
-                ec = ec.crossfadein(TEXT_FADE).crossfadeout(TEXT_FADE)
-                
                 is_first_chunk = (chunk_idx == 0)
                 is_last_chunk = (chunk_idx == len(ar_chunks) - 1)
 
@@ -1313,60 +3461,56 @@ def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, qua
                 base_y = 0.35 if ar_size_mult <= 1.2 else 0.30
                 ar_y_pos = target_h * base_y
                 
-                ac = ac.set_position(('center', ar_y_pos))
-                ec = ec.set_position(('center', ar_y_pos + ac.h + (2 * scale)))
+                # ✅ Crossfade للنص بيتعمل جوه SegmentCompositor بجدول alpha محسوب مسبقاً
+                text_overlays = [
+                    TextOverlay(ac, ar_y_pos, target_w, target_h),
+                    TextOverlay(ec, ar_y_pos + ac.h + (2 * scale), target_w, target_h),
+                ]
 
                 # و. معالجة الخلفية للقطعة (نستخدم actual_duration)
                 # ✅ الخلفية تتغير فقط بين الآيات (مش كل سطر)
-                if dynamic_bg and i < len(vpool):
+                if ayah_bg_path:
                     bg_slice = ayah_bg_clip.loop().subclip(ayah_bg_time, ayah_bg_time + actual_duration)
                     # ✅ Fade للخلفية فقط بين الآيات (أول وآخر chunk في الآية كلها)
-                    if is_first_chunk: 
-                        bg_slice = bg_slice.fadein(0.5)
-                    if is_last_chunk: 
-                        bg_slice = bg_slice.fadeout(0.5)
+                    bg_curve = build_fade_curve(
+                        actual_duration, fps,
+                        fade_in=BG_FADE if is_first_chunk else 0.0,
+                        fade_out=BG_FADE if is_last_chunk else 0.0
+                    ) if (is_first_chunk or is_last_chunk) else None
                     ayah_bg_time += actual_duration
                 else:
                     bg_slice = base_bg_clip.loop().subclip(current_bg_time, current_bg_time + actual_duration)
+                    bg_curve = None
                     current_bg_time += actual_duration
                 
                 # ز. تجميع القطعة
-                segment_overlays =[o.set_duration(actual_duration) for o in overlays_static]
-                full_segment = CompositeVideoClip([bg_slice] + segment_overlays + [ac, ec]).set_audio(chunk_audio)
-                final_segments.append(full_segment)
+                compositor = SegmentCompositor(bg_slice, static_gain, text_overlays, actual_duration, fps, bg_curve=bg_curve, static_bg=not base_bg_path)
+                segment_compositors.append(compositor)
+                # الصوت: view على PCM الآية (بدون نسخ) - الـ track = اللي اترندر بالظبط
+                audio_track.append(ayah_pcm[current_sample:end_sample])
 
                 # تحديث الوقت للقطعة القادمة
                 current_audio_time = t_end
+                current_sample = end_sample
+
+                rendered_duration += actual_duration
+                if preview and rendered_duration >= PREVIEW_MAX_SECONDS:
+                    break
 
         # 5. الدمج والرندر النهائي
         # التحقق من وجود مقاطع للدمج
-        if not final_segments or len(final_segments) == 0:
+        if not segment_compositors:
             raise Exception("لم يتم إنشاء أي مقاطع فيديو - قد يكون هناك مشكلة في تحميل الصوت أو النصوص")
 
-        update_job_status(job_id, 85, "Merging All Chunks...")
-        
-        # 🧪 تجربة: فصل الصوت والفيديو ودمجهم بشكل منفصل
-        # نجمع audio clips لوحدها
-        audio_clips = [seg.audio for seg in final_segments]
-        
-        # ندمج الصوت بـ concatenate_audioclips (أدق في التعامل مع الصوت)
-        merged_audio = concatenate_audioclips(audio_clips)
-        
-        # نشيل الصوت من الفيديو clips وندمج الفيديو لوحده
-        # استخدام method="chain" بدل "compose" لتجنب overlap تلقائي
-        video_clips_no_audio = [seg.set_audio(None) for seg in final_segments]
-        final_video = concatenate_videoclips(video_clips_no_audio, method="chain")
+        progress.stage('merge', "Merging All Chunks...")
         
-        # نربط الصوت المدمج الجديد بالفيديو
-        final_video = final_video.set_audio(merged_audio)
-        
-        # ✅ Fade للصوت معطل مؤقتاً - يمكن يسبب مشاكل في الدمج
-        # AUDIO_FADE = 0.5
-        # final_video = final_video.audio_fadein(AUDIO_FADE).audio_fadeout(AUDIO_FADE)
+        # الفيديو: القطع متسلسلة (زي method="chain") في timeline واحدة للـ FramePipeline
+        timeline = FrameTimeline(segment_compositors, fps)
         
         # حفظ الفيديو النهائي في مجلد outputs
         final_output_path = os.path.join(OUTPUTS_DIR, f"{job_id}.mp4")
         temp_mix_path = os.path.join(workspace, f"temp_mix_{job_id}.mp4")
+        temp_audio_path = os.path.join(workspace, f"temp_audio_{job_id}.wav")
         
         # 🎬 إعدادات الضغط (قيم ثابتة للحصول على أفضل توازن)
         # CRF 24 = جودة عالية مع ضغط ممتاز (مثالي للقرآن - نص ثابت + خلفية)
@@ -1374,48 +3518,50 @@ def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, qua
         # Audio 128k = نفس جودة السماع مع توفير 33%
         crf_value = 24
         preset_value = 'medium'
+        if preview:
+            # 👁️ المعاينة: أسرع preset والجودة مش مهمة
+            crf_value = PREVIEW_CRF
+            preset_value = PREVIEW_PRESET
         
-        update_job_status(job_id, 90, "Rendering Video (Mixing)...")
-        final_video.write_videofile(
-            temp_mix_path, 
-            fps=fps, 
-            codec='libx264', 
-            audio_codec='aac', 
-            audio_bitrate='128k',
+        audio_track.write_wav(temp_audio_path)
+
+        # 6. معالجة الصوت (Mastering) على الصوت المجمّع قبل الدمج - المعاينة مش محتاجاها
+        # ✅ الفيديو بيتعمله encode مرة واحدة بس بدل pass تاني يقرا الـ MP4 كله
+        if not preview:
+            progress.stage('mastering', "Mastering Audio...")
+            mastered_audio_path = os.path.join(workspace, f"temp_audio_mastered_{job_id}.wav")
+            loudness = None
+            if loudness_future is not None:
+                try:
+                    loudness = loudness_future.result(timeout=LOUDNESS_WAIT_TIMEOUT)
+                except Exception as loud_err:
+                    print(f"[WARNING] Loudness analysis unavailable, using single-pass loudnorm: {loud_err}")
+            temp_audio_path = master_audio(temp_audio_path, mastered_audio_path, build_mastering_filter(loudness))
+
+        progress.stage('render', "Rendering Video (Mixing)...")
+        # ⚡ تركيب الفريمات بالتوازي مع الـ encoding بدل write_videofile
+        encode_timeline(
+            timeline,
+            (target_w, target_h),
+            temp_mix_path,
+            audio_path=temp_audio_path,
+            crf=crf_value,
             preset=preset_value,
-            threads=os.cpu_count() or 4,
-            ffmpeg_params=['-crf', str(crf_value)],
-            logger=ScopedQuranLogger(job_id)
-        )
-
-        # 6. معالجة الصوت النهائية (Mastering)
-        update_job_status(job_id, 98, "Mastering Audio...")
-        cmd = (
-            f'ffmpeg -y -i "{temp_mix_path}" '
-            f'-af "{STUDIO_DRY_FILTER}" '
-            f'-c:v copy '
-            f'-c:a aac -b:a 128k '
-            f'"{final_output_path}"'
+            logger=ScopedQuranLogger(job_id, progress),
+            # ✅ من غير فيديو خلفية: الفريمات ثابتة، stillimage بيوفر bits ووقت في الـ encoder
+            tune='stillimage' if not base_bg_path else None
         )
-        
-        if os.system(cmd) != 0: 
-            # في حال فشل الفلتر لأي سبب، نستخدم النسخة الأصلية
-            shutil.move(temp_mix_path, final_output_path)
-        else:
-            if os.path.exists(temp_mix_path): os.remove(temp_mix_path)
+        shutil.move(temp_mix_path, final_output_path)
 
-        with JOBS_LOCK: 
-            if job_id in JOBS:
-                JOBS[job_id].update({'output_path': final_output_path, 'is_complete': True, 'is_running': False, 'percent': 100, 'status': "complete"})
-            else:
-                # أضف للـ RAM لو مش موجودة
-                JOBS[job_id] = {'id': job_id, 'output_path': final_output_path, 'is_complete': True, 'is_running': False, 'percent': 100, 'status': "complete"}
+        # أضف للـ RAM لو مش موجودة (بيتشال بعد JOB_REGISTRY_TTL)
+        JOBS.update(job_id, create=True, output_path=final_output_path, is_complete=True, is_running=False, percent=100, status="complete", bg_pool=vpool.ready_paths())
         
         # Update in SQLite and add to history
-        db_update_job(job_id, output_path=final_output_path, status='complete', percent=100, completed_at=time.time())
+        db_update_job(job_id, output_path=final_output_path, status='complete', percent=100, completed_at=time.time(),
+                      **({'bg_pool_json': json.dumps(vpool.ready_paths())} if preview else {}))
         
-        # Get config from DB to add to history
-        db_job = db_get_job(job_id)
+        # Get config from DB to add to history (المعاينة مش بتتسجل في السجل)
+        db_job = db_get_job(job_id) if not preview else None
         if db_job and db_job.get('config_json'):
             try:
                 config = json.loads(db_job['config_json'])
@@ -1442,13 +3588,10 @@ def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, qua
     except Exception as e:
         msg = str(e)
         traceback.print_exc()
-        status = "cancelled" if msg == "Stopped" else "error"
-        with JOBS_LOCK: 
-            if job_id in JOBS:
-                JOBS[job_id].update({'error': msg, 'status': status, 'is_running': False})
-            else:
-                # أضف للـ RAM لو مش موجودة
-                JOBS[job_id] = {'id': job_id, 'error': msg, 'status': status, 'is_running': False, 'percent': 0}
+        # ✅ الإلغاء = JobStopped من check_stop (أو token اتعمله set وفي الآخر ظهر كـ exception تانية)
+        status = "cancelled" if isinstance(e, JobStopped) or token.is_set() else "error"
+        job = JOBS.update(job_id, create=True, error=msg, status=status, is_running=False)
+        job.setdefault('percent', 0)
         # Update in SQLite
         db_update_job(job_id, status=status, error=msg)
     
@@ -1458,18 +3601,18 @@ def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, qua
         # ═══════════════════════════════════════
         
         # 1. إغلاق جميع الـ clips المفتوحة
-        for ac in audio_clips_to_close:
-            try: ac.close()
-            except: pass
-            
         for vc in video_clips_to_close:
             try: vc.close()
             except: pass
-            
-        try:
-            if 'final_video' in locals(): final_video.close()
-            for s in final_segments: s.close()
-        except: pass
+        
+        # الـ PCM في الذاكرة + تنزيلات الخلفيات اللي لسه مبدأتش
+        audio_track.parts.clear()
+        vpool.cancel()
+        # ✅ التنزيلات اللي بدأت فعلاً ماسكة الـ token - بتقف وبتمسح الجزء اللي نزل
+        token.set()
+        release_cancel_token(job_id)
+        # الـ status النهائي اتكتب خلاص - مفيش progress تاني للـ job ده
+        PROGRESS_WRITER.forget(job_id)
         
         # 2. تنظيف الـ numpy arrays المؤقتة
         try:
@@ -1485,21 +3628,27 @@ def build_video_task(job_id, user_pexels_key, reciter_id, surah, start, end, qua
         
         # 4. حذف جميع الملفات المؤقتة
         try:
-            # حذف مجلد العمل المؤقت بالكامل
+            # حذف مجلد العمل المؤقت بالكامل (المعاينة بتسيب خلفياتها بس)
             if workspace and os.path.exists(workspace):
-                shutil.rmtree(workspace, ignore_errors=True)
+                if preview:
+                    for f in os.listdir(workspace):
+                        if f == PREVIEW_BG_SUBDIR: continue
+                        fpath = os.path.join(workspace, f)
+                        if os.path.isdir(fpath): shutil.rmtree(fpath, ignore_errors=True)
+                        else:
+                            try: os.remove(fpath)
+                            except OSError: pass
+                else:
+                    shutil.rmtree(workspace, ignore_errors=True)
                 print(f"🧹 Cleaned workspace: {job_id}")
             
             # حذف ملفات الـ cache بعد كل عملية
-            # cache_mp3quran - ملفات الصوت المحملة
-            cache_mp3_dir = os.path.join(EXEC_DIR, "cache_mp3quran")
-            if os.path.exists(cache_mp3_dir):
-                shutil.rmtree(cache_mp3_dir, ignore_errors=True)
-                os.makedirs(cache_mp3_dir, exist_ok=True)
-                print(f"🧹 Cleaned cache_mp3quran")
+            # cache_mp3quran - ملفات الصوت المحملة + قياسات الـ loudness
+            # ✅ بنحذف بس اللي ماتستخدمش من فترة (القياس بيتعمل مرة واحدة لكل سورة)
+            prune_cache_dir(MP3QURAN_CACHE_DIR, MP3QURAN_CACHE_MAX_AGE)
             
             # vision - فيديوهات الخلفية المحملة من Pexels
-            if os.path.exists(VISION_DIR):
+            if not preview and os.path.exists(VISION_DIR):
                 for f in os.listdir(VISION_DIR):
                     fpath = os.path.join(VISION_DIR, f)
                     try:
@@ -1561,9 +3710,7 @@ def estimate_duration():
         
         if reciter_id:
             # ✅ عندنا ID - نستخدم mp3quran timing API
-            cache_dir = os.path.join(EXEC_DIR, "cache_mp3quran", str(reciter_id))
-            os.makedirs(cache_dir, exist_ok=True)
-            timings_path = os.path.join(cache_dir, f"{surah:03d}.json")
+            timings_path = mp3quran_cache_path(reciter_id, surah, "json")
             
             # تحميل الـ timings لو مش موجودة
             if not os.path.exists(timings_path):
@@ -1660,23 +3807,20 @@ def health_check():
     يُستخدم من أدوات المراقبة للتأكد من أن الخدمة تعمل
     """
     try:
-        # عدد العمليات النشطة
-        active_jobs = len([j for j in JOBS.values() if j.get('is_running')])
+        # عدد العمليات النشطة (counter - مش scan)
+        active_jobs = JOBS.active
         
         # عدد العمليات المكتملة اليوم
-        today = datetime.date.today().isoformat()
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM history WHERE date(created_at) = ?", (today,))
-        today_count = c.fetchone()[0]
-        conn.close()
+        # created_at epoch - range على الـ index بدل date() على كل صف
+        today_start = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+        today_count = db_query("SELECT COUNT(*) AS n FROM history WHERE created_at >= ?", (today_start,), one=True)['n']
         
         # الذاكرة المستخدمة (تقريبية)
         import psutil
         memory_percent = psutil.virtual_memory().percent
         memory_used = round(psutil.virtual_memory().used / (1024**3), 2)  # GB
     except:
-        active_jobs = len([j for j in JOBS.values() if j.get('is_running')])
+        active_jobs = JOBS.active
         today_count = 0
         memory_percent = 0
         memory_used = 0
@@ -1690,11 +3834,13 @@ def health_check():
         'uptime': f"{uptime_hours}س {uptime_mins}د",
         'uptime_seconds': uptime_seconds,
         'active_jobs': active_jobs,
+        'cached_jobs': len(JOBS),
         'videos_today': today_count,
         'memory': {
             'percent': memory_percent,
             'used_gb': memory_used
         },
+        'pexels_keys': PEXELS_KEYS.stats(),
         'timestamp': datetime.datetime.now().isoformat()
     })
 
@@ -1745,9 +3891,21 @@ def gen():
         'fontEn': d.get('fontEn', 'English'),
         'pexelsKey': d.get('pexelsKey', ''),
         'style': d.get('style', {}),
-        'session_id': session_id
+        'session_id': session_id,
+        'aspectRatio': d.get('aspectRatio', '9:16'),
+        'previewJobId': d.get('previewJobId'),
+        'preview': bool(d.get('preview', False))
     }
 
+    if RENDER_MODE == 'queue':
+        # 🏭 الرندر في render worker منفصل - الـ API بيسجل الـ job بس
+        job_id = create_job(config, session_id, track=False)
+        db_queue_job(job_id)
+        return jsonify({'ok': True, 'jobId': job_id, 'preview': config['preview']})
+
+    # 👁️ الرندر الكامل بعد معاينة: نستخدم نفس خلفياتها (محملة بالفعل)
+    bg_pool = None if config['preview'] else get_preview_bg_pool(d.get('previewJobId'), session_id, config['aspectRatio'], config['quality'])
+
     job_id = create_job(config, session_id)
     style_settings = d.get('style', {})
 
@@ -1774,23 +3932,67 @@ def gen():
             d.get('font', 'Arabic'),
             d.get('fontEn', 'English')
         ),
+        kwargs={'preview': config['preview'], 'bg_pool': bg_pool},
         daemon=True
     ).start()
     
-    return jsonify({'ok': True, 'jobId': job_id})
+    return jsonify({'ok': True, 'jobId': job_id, 'preview': config['preview']})
 
 @app.route('/api/progress')
 def prog(): 
     job = get_job(request.args.get('jobId'))
-    if job:
-        # Add download URL if complete
-        if job.get('status') == 'complete' and job.get('output_path'):
-            job['download_url'] = f"/api/download?jobId={job['id']}"
-    return jsonify(job)
-
-@app.route('/api/download')
-def download_result():
-    job = get_job(request.args.get('jobId'))
+    # Add download URL if complete
+    return jsonify(job_payload(job) if job else None)
+
+@app.route('/api/progress/stream')
+def progress_stream():
+    """SSE - progress الـ job بيتبعت أول ما يتغير (الـ polling على /api/progress لسه شغال)"""
+    job_id = request.args.get('jobId')
+    if not job_id or not get_job(job_id):
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def events():
+        # الاشتراك قبل الـ snapshot الأول عشان مانفوتش تغيير بينهم
+        sub = EVENT_BUS.subscribe(f"job:{job_id}")
+        try:
+            yield "retry: 3000\n\n"
+            job = get_job(job_id)
+            if not job:
+                return
+            yield sse_message('progress', job_payload(job))
+            if job.get('status') in JOB_FINAL_STATUSES:
+                return
+            last = (job.get('percent'), job.get('status'), job.get('eta'))
+            idle = 0.0
+            while True:
+                # الـ job شغال في worker تاني = مفيش events هنا - نقرا SQLite (بيتحدث من الـ ProgressWriter هناك)
+                local = JOBS.get(job_id) is not None
+                timeout = SSE_KEEPALIVE if local else SSE_REMOTE_POLL
+                events = sub.get(timeout)
+                if not events and not local:
+                    job = get_job(job_id)
+                    if job and (job.get('percent'), job.get('status'), job.get('eta')) != last:
+                        events = [(None, 'progress', job_payload(job))]
+                if not events:
+                    idle += timeout
+                    if idle >= SSE_KEEPALIVE:
+                        idle = 0.0
+                        yield ": keepalive\n\n"
+                    continue
+                idle = 0.0
+                for _, event, data in events:
+                    last = (data.get('percent'), data.get('status'), data.get('eta'))
+                    yield sse_message(event, data)
+                    if data.get('status') in JOB_FINAL_STATUSES:
+                        return
+        finally:
+            sub.close()
+    
+    return sse_response(events)
+
+def send_job_output(job_id, **send_kwargs):
+    """ملف الفيديو النهائي للـ job (أو 404) - مشترك بين المعاينة والتحميل"""
+    job = get_job(job_id)
     if not job:
         return jsonify({'error': 'Job not found'}), 404
     
@@ -1798,21 +4000,26 @@ def download_result():
     if not output_path or not os.path.exists(output_path):
         return jsonify({'error': 'File not found'}), 404
     
+    return send_file(output_path, **send_kwargs)
+
+@app.route('/api/preview')
+def preview_result():
+    """عرض الفيديو inline (للمشغل في الواجهة) بدل التحميل كملف"""
+    return send_job_output(request.args.get('jobId'), mimetype='video/mp4', conditional=True)
+
+@app.route('/api/download')
+def download_result():
+    job_id = request.args.get('jobId') or ''
     # Get filename from history or use default
-    filename = f"Quran_video_{request.args.get('jobId')[:8]}.mp4"
-    return send_file(output_path, as_attachment=True, download_name=filename)
+    filename = f"Quran_video_{job_id[:8]}.mp4"
+    return send_job_output(job_id, as_attachment=True, download_name=filename)
 
 @app.route('/api/cancel', methods=['POST'])
 def cancel_process():
     d = request.json
     job_id = d.get('jobId')
     if job_id:
-        with JOBS_LOCK:
-            if job_id in JOBS:
-                JOBS[job_id]['should_stop'] = True
-                JOBS[job_id]['status'] = 'cancelling'
-        # Update in SQLite
-        db_update_job(job_id, should_stop=1, status='cancelling')
+        cancel_job(job_id)
     return jsonify({'ok': True})
 
 @app.route('/api/history')
@@ -1852,35 +4059,43 @@ def get_history():
     
     return jsonify({'ok': True, 'history': result})
 
+def remove_job_files(paths):
+    """حذف workspaces / ملفات فيديو - بيتنادى بعد الـ COMMIT (مفيش I/O وإحنا ماسكين الـ write lock)"""
+    for path in paths:
+        if not path or not os.path.exists(path):
+            continue
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
 @app.route('/api/history/<int:history_id>', methods=['DELETE'])
 def delete_history_item(history_id):
     """Delete a single history item"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Get the history item first to clean up files
-    c.execute("SELECT job_id FROM history WHERE id = ?", (history_id,))
-    row = c.fetchone()
-    
-    if row:
-        job_id = row[0]
-        # Delete from history
-        c.execute("DELETE FROM history WHERE id = ?", (history_id,))
-        # Also delete the job if exists
-        c.execute("SELECT workspace FROM jobs WHERE id = ?", (job_id,))
-        job_row = c.fetchone()
-        if job_row and job_row[0]:
-            workspace = job_row[0]
-            if os.path.exists(workspace):
-                try:
-                    shutil.rmtree(workspace, ignore_errors=True)
-                except:
-                    pass
-        c.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
-    
-    conn.commit()
-    conn.close()
+    paths = []
+    with db_transaction() as conn:
+        c = conn.cursor()
+        
+        # Get the history item first to clean up files
+        c.execute("SELECT job_id FROM history WHERE id = ?", (history_id,))
+        row = c.fetchone()
+        
+        if row:
+            job_id = row[0]
+            # Delete from history
+            c.execute("DELETE FROM history WHERE id = ?", (history_id,))
+            # Also delete the job if exists
+            c.execute("SELECT workspace FROM jobs WHERE id = ?", (job_id,))
+            job_row = c.fetchone()
+            if job_row and job_row[0]:
+                paths.append(job_row[0])
+            c.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
     
+    # ✅ الملفات بعد الـ COMMIT
+    remove_job_files(paths)
     return jsonify({'ok': True})
 
 @app.route('/api/history/clear', methods=['POST'])
@@ -1888,60 +4103,44 @@ def clear_all_history():
     """Clear history for current session only"""
     data = request.json or {}
     session_id = data.get('sessionId')
+    paths = []
+    job_ids = []
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    if session_id:
-        # حذف history للجلسة الحالية فقط
-        c.execute("SELECT job_id FROM history WHERE session_id = ?", (session_id,))
-        job_ids = [row[0] for row in c.fetchall()]
-        
-        # حذف ملفات الفيديو والـ workspaces
-        for job_id in job_ids:
-            c.execute("SELECT workspace, output_path FROM jobs WHERE id = ?", (job_id,))
-            job_row = c.fetchone()
-            if job_row:
-                workspace, output_path = job_row
-                if workspace and os.path.exists(workspace):
-                    try:
-                        shutil.rmtree(workspace, ignore_errors=True)
-                    except:
-                        pass
-                if output_path and os.path.exists(output_path):
-                    try:
-                        os.remove(output_path)
-                    except:
-                        pass
-        
-        # حذف من history و jobs للجلسة فقط
-        c.execute("DELETE FROM history WHERE session_id = ?", (session_id,))
-        c.execute("DELETE FROM jobs WHERE session_id = ?", (session_id,))
-    else:
-        # حذف الكل (للتوافق مع الإصدارات القديمة)
-        c.execute("SELECT workspace FROM jobs WHERE workspace IS NOT NULL")
-        workspaces = c.fetchall()
-        
-        for ws in workspaces:
-            if ws[0] and os.path.exists(ws[0]):
-                try:
-                    shutil.rmtree(ws[0], ignore_errors=True)
-                except:
-                    pass
+    with db_transaction() as conn:
+        c = conn.cursor()
         
-        c.execute("DELETE FROM history")
-        c.execute("DELETE FROM jobs")
+        if session_id:
+            # حذف history للجلسة الحالية فقط
+            c.execute("SELECT job_id FROM history WHERE session_id = ?", (session_id,))
+            job_ids = [row[0] for row in c.fetchall()]
+            
+            # ملفات الفيديو والـ workspaces (بتتحذف بعد الـ COMMIT)
+            for job_id in job_ids:
+                c.execute("SELECT workspace, output_path FROM jobs WHERE id = ?", (job_id,))
+                job_row = c.fetchone()
+                if job_row:
+                    paths.extend(job_row)
+            
+            # حذف من history و jobs للجلسة فقط
+            c.execute("DELETE FROM history WHERE session_id = ?", (session_id,))
+            c.execute("DELETE FROM jobs WHERE session_id = ?", (session_id,))
+        else:
+            # حذف الكل (للتوافق مع الإصدارات القديمة)
+            c.execute("SELECT workspace FROM jobs WHERE workspace IS NOT NULL")
+            paths = [ws[0] for ws in c.fetchall()]
+            
+            c.execute("DELETE FROM history")
+            c.execute("DELETE FROM jobs")
     
-    conn.commit()
-    conn.close()
+    remove_job_files(paths)
     
     # Also clear RAM for this session
-    with JOBS_LOCK:
-        if session_id:
-            # حذف jobs الخاصة بالجلسة فقط
-            JOBS.pop(job_id, None)
-        else:
-            JOBS.clear()
+    if session_id:
+        # حذف jobs الخاصة بالجلسة فقط
+        for job_id in job_ids:
+            JOBS.pop(job_id)
+    else:
+        JOBS.clear()
     
     return jsonify({'ok': True})
 
@@ -1951,23 +4150,13 @@ def get_my_jobs():
     status = request.args.get('status')  # pending, processing, complete, error
     session_id = request.args.get('sessionId')
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
     if session_id:
         if status:
-            c.execute("SELECT * FROM jobs WHERE session_id = ? AND status = ? ORDER BY created_at DESC LIMIT 50", (session_id, status))
+            rows = db_query("SELECT * FROM jobs WHERE session_id = ? AND status = ? ORDER BY created_at DESC LIMIT 50", (session_id, status))
         else:
-            c.execute("SELECT * FROM jobs WHERE session_id = ? ORDER BY created_at DESC LIMIT 50", (session_id,))
+            rows = db_query("SELECT * FROM jobs WHERE session_id = ? ORDER BY created_at DESC LIMIT 50", (session_id,))
     else:
-        if status:
-            c.execute("SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT 50", (status,))
-        else:
-            c.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT 50")
-    
-    rows = c.fetchall()
-    conn.close()
+        rows = db_get_all_jobs(status=status, limit=50)
     
     result = []
     for j in rows:
@@ -2007,19 +4196,32 @@ def conf(): return jsonify({'surahs': SURAH_NAMES, 'verseCounts': VERSE_COUNTS,
 # 🔧 Utility Functions
 # ==========================================
 
+ORPHAN_SWEEP_INTERVAL = 60  # ثواني - الـ jobs اللي الـ worker بتاعها مات
+CLEANUP_INTERVAL = 600
+
 def background_cleanup():
-    """Cleanup old jobs and files every 10 minutes"""
+    """Cleanup old jobs and files every 10 minutes (+ sweep للـ jobs اليتيمة كل دقيقة)"""
+    last_cleanup = time.time()
     while True:
-        time.sleep(600)  # Every 10 minutes
+        time.sleep(ORPHAN_SWEEP_INTERVAL)
+        try:
+            sweep_dead_runners()
+        except Exception as e:
+            print(f"Orphan sweep error: {e}")
+        if time.time() - last_cleanup < CLEANUP_INTERVAL:
+            continue
+        last_cleanup = time.time()
         try:
             db_cleanup_old_jobs(hours=12)  # Clean jobs older than 12 hours
+            JOBS.evict()  # الـ jobs المنتهية اللي عدى عليها JOB_REGISTRY_TTL
             print("🧹 Background cleanup completed (12 hour expiry)")
         except Exception as e:
             print(f"Cleanup error: {e}")
 
-def recover_pending_jobs():
-    """Resume pending/processing jobs on server restart"""
-    pending = db_get_pending_jobs()
+def recover_pending_jobs(pending=None):
+    """Resume pending/processing jobs on server restart (أو jobs معينة لو pending اتبعتت)"""
+    if pending is None:
+        pending = db_get_pending_jobs()
     
     if not pending:
         return
@@ -2046,24 +4248,29 @@ def recover_pending_jobs():
         try:
             config = json.loads(config_json)
             
+            if RENDER_MODE == 'queue':
+                # الـ render workers هياخدوه (jobs الباتش بيحطها الـ batch processor في الـ queue بالترتيب)
+                if not db_query("SELECT 1 FROM batch_items WHERE job_id = ?", (job_id,), one=True):
+                    db_queue_job(job_id, percent=0)
+                continue
+            
             # Reset job status
             db_update_job(job_id, status='pending', percent=0)
             
             # Re-add to RAM
-            with JOBS_LOCK:
-                JOBS[job_id] = {
-                    'id': job_id,
-                    'percent': 0,
-                    'status': 'pending',
-                    'eta': '--:--',
-                    'is_running': True,
-                    'is_complete': False,
-                    'output_path': None,
-                    'error': None,
-                    'should_stop': False,
-                    'created_at': job.get('created_at', time.time()),
-                    'workspace': workspace
-                }
+            JOBS.add(job_id, {
+                'id': job_id,
+                'percent': 0,
+                'status': 'pending',
+                'eta': '--:--',
+                'is_running': True,
+                'is_complete': False,
+                'output_path': None,
+                'error': None,
+                'should_stop': False,
+                'created_at': job.get('created_at', time.time()),
+                'workspace': workspace
+            })
             
             # Start processing in background
             style_settings = config.get('style', {})
@@ -2087,6 +4294,7 @@ def recover_pending_jobs():
                         cfg.get('aspectRatio', '9:16'),
                         style
                     ),
+                    kwargs={'preview': cfg.get('preview', False)},
                     daemon=True
                 ).start()
             
@@ -2105,16 +4313,43 @@ def recover_pending_jobs():
 # 📦 Batch Export System - Multiple Batches in Parallel
 # ==========================================
 
-BATCH_QUEUE = []  # قائمة الانتظار
+# قائمة الانتظار = الباتشات الـ pending في SQLite (أي worker بيضيف، والـ leader بس بيشغل)
 BATCH_QUEUE_LOCK = threading.Lock()
-ACTIVE_BATCHES = {}  # الباتشات النشطة
+ACTIVE_BATCHES = {}  # الباتشات النشطة في الـ process دي (الـ leader)
 MAX_PARALLEL_BATCHES = 3  # عدد الدفعات المتوازية (كل مستخدم دفعته)
 
+def wait_for_job(job_id, interval=1.0, queue_timeout=JOB_QUEUE_TIMEOUT):
+    """
+    استنى job في الـ render queue لحد ما يخلص (الإلغاء بيوصل للـ worker عن طريق should_stop)
+    لو مفيش worker أخده في queue_timeout، أو الـ lease منتهي ومحدش رجّعه (مفيش workers عايشة)
+    الـ job بيبقى error وبنرفع exception - الباتش مايفضلش مستني على طول
+    """
+    queued_since = None
+    while True:
+        job = db_get_job(job_id)
+        if not job or job['status'] in JOB_FINAL_STATUSES:
+            return job
+        now = time.time()
+        queued_since = (queued_since or now) if job['status'] == 'queued' else None
+        if queued_since and now - queued_since > queue_timeout:
+            error = f"No render worker picked up the job in {queue_timeout}s (is 'python main.py worker' running?)"
+        elif job['lease_expires'] and now - job['lease_expires'] > JOB_LEASE_SECONDS:
+            error = "Render worker lost and no live worker reclaimed the job"
+        else:
+            time.sleep(interval)
+            continue
+        # atomic مع db_claim_job: لو worker أخده في اللحظة دي بنكمل نستنى
+        if db_execute("UPDATE jobs SET status = 'error', error = ?, lease_owner = NULL, lease_expires = NULL "
+                      "WHERE id = ? AND status = ? AND COALESCE(lease_expires, 0) = ?",
+                      (error, job_id, job['status'], job['lease_expires'] or 0)):
+            publish_job(job_id)
+            raise Exception(error)
+        queued_since = None
+
 def process_single_batch(batch_id):
     """معالجة دفعة واحدة - فيديو ورا فيديو (تسلسلي)"""
     try:
         print(f"🎬 Starting batch: {batch_id[:8]}...")
-        db_update_batch(batch_id, status='running', started_at=time.time())
         
         # معالجة الـ items
         items = db_get_batch_items(batch_id)
@@ -2157,6 +4392,7 @@ def process_single_batch(batch_id):
                 if not config:
                     print(f"  ❌ Job {job_id[:8]}... has no config")
                     db_update_batch_item(batch_id, job_id, status='error', error='Config missing')
+                    JOBS.update(job_id, status='error', error='Config missing', is_running=False)
                     batch = db_get_batch(batch_id)
                     db_update_batch(batch_id, failed_jobs=(batch['failed_jobs'] or 0) + 1)
                     continue
@@ -2166,6 +4402,10 @@ def process_single_batch(batch_id):
                 # ✅ توليد Query عشوائي لكل فيديو
                 random_bg_query = random.choice(SAFE_TOPICS)
                 
+                if RENDER_MODE != 'queue':
+                    # الـ job بيشتغل هنا: RAM عشان الـ progress / SSE / الإلغاء المحلي
+                    JOBS.add(job_id, dict(job_from_row(job), status='processing', is_running=True))
+                
                 # تحديث حالة الـ item مع وقت البداية
                 video_start_time = time.time()
                 db_update_batch_item(batch_id, job_id, status='processing', video_started_at=video_start_time)
@@ -2180,24 +4420,32 @@ def process_single_batch(batch_id):
                 if job and not job.get('config_json'):
                     db_update_job(job_id, config_json=json.dumps(config))
 
-                build_video_task(
-                    job_id,
-                    config.get('pexelsKey', ''),
-                    config.get('reciter', ''),
-                    item['surah'],
-                    item['start_ayah'],
-                    item['end_ayah'],
-                    config.get('quality', '720'),
-                    random_bg_query,
-                    int(config.get('fps', 20)),
-                    config.get('dynamicBg', False),
-                    config.get('useGlow', False),
-                    config.get('useVignette', False),
-                    config.get('aspectRatio', '9:16'),
-                    style_settings,
-                    config.get('font', 'Arabic'),
-                    config.get('fontEn', 'English')
-                )
+                if RENDER_MODE == 'queue':
+                    # 🏭 render worker بيعمله - الباتش بيفضل تسلسلي (بنستنى الـ job يخلص)
+                    config.update(surah=item['surah'], startAyah=item['start_ayah'], endAyah=item['end_ayah'], bgQuery=random_bg_query)
+                    db_queue_job(job_id, config_json=json.dumps(config))
+                    done = wait_for_job(job_id)
+                    if not done or done['status'] != 'complete':
+                        raise Exception((done or {}).get('error') or f"Render {(done or {}).get('status', 'failed')}")
+                else:
+                    build_video_task(
+                        job_id,
+                        config.get('pexelsKey', ''),
+                        config.get('reciter', ''),
+                        item['surah'],
+                        item['start_ayah'],
+                        item['end_ayah'],
+                        config.get('quality', '720'),
+                        random_bg_query,
+                        int(config.get('fps', 20)),
+                        config.get('dynamicBg', False),
+                        config.get('useGlow', False),
+                        config.get('useVignette', False),
+                        config.get('aspectRatio', '9:16'),
+                        style_settings,
+                        config.get('font', 'Arabic'),
+                        config.get('fontEn', 'English')
+                    )
                 
                 # حساب وقت الفيديو
                 video_time = time.time() - video_start_time
@@ -2251,41 +4499,35 @@ def process_batch_queue():
     while True:
         try:
             # عدد الدفعات النشطة
-            active_count = len(ACTIVE_BATCHES)
+            with BATCH_QUEUE_LOCK:
+                active_count = len(ACTIVE_BATCHES)
             
             # لو فيه مكان لدفعات جديدة
             if active_count < MAX_PARALLEL_BATCHES:
-                # البحث عن دفعة pending في الـ queue
-                with BATCH_QUEUE_LOCK:
-                    for batch_id in BATCH_QUEUE[:]:  # نسخة من القائمة
+                # البحث عن دفعة pending في الـ queue (SQLite)
+                for row in db_get_queued_batches(MAX_PARALLEL_BATCHES):
+                    batch_id = row['id']
+                    with BATCH_QUEUE_LOCK:
                         # تجاهل لو الدفعة دي شغالة
                         if batch_id in ACTIVE_BATCHES:
                             continue
-                        
-                        # التحقق من الحالة
-                        batch = db_get_batch(batch_id)
-                        if not batch:
-                            BATCH_QUEUE.remove(batch_id)
-                            continue
-                        
-                        # لو الدفعة مكتملة أو ملغاة
-                        if batch['status'] in ['complete', 'cancelled']:
-                            BATCH_QUEUE.remove(batch_id)
-                            continue
-                        
-                        # لو الدفعة pending - نبدأها
-                        if batch['status'] == 'pending':
-                            ACTIVE_BATCHES[batch_id] = True
-                            print(f"🚀 Starting batch {batch_id[:8]}... (active: {active_count + 1}/{MAX_PARALLEL_BATCHES})")
-                            
-                            # تشغيل في thread منفصل
-                            t = threading.Thread(
-                                target=process_single_batch,
-                                args=(batch_id,),
-                                daemon=True
-                            )
-                            t.start()
-                            break  # نبدأ دفعة واحدة كل مرة
+                    
+                    # pending -> running (atomic) - لو اتلغت في النص مش هتتاخد
+                    if not db_claim_batch(batch_id):
+                        continue
+                    
+                    with BATCH_QUEUE_LOCK:
+                        ACTIVE_BATCHES[batch_id] = True
+                    print(f"🚀 Starting batch {batch_id[:8]}... (active: {active_count + 1}/{MAX_PARALLEL_BATCHES})")
+                    
+                    # تشغيل في thread منفصل
+                    t = threading.Thread(
+                        target=process_single_batch,
+                        args=(batch_id,),
+                        daemon=True
+                    )
+                    t.start()
+                    break  # نبدأ دفعة واحدة كل مرة
             
             # استراحة قصيرة
             time.sleep(1)
@@ -2312,10 +4554,7 @@ def recover_pending_batches():
             print(f"  🔄 Resetting stuck batch {batch_id[:8]}... from 'running' to 'pending'")
             db_update_batch(batch_id, status='pending')
         
-        with BATCH_QUEUE_LOCK:
-            if batch_id not in BATCH_QUEUE:
-                BATCH_QUEUE.append(batch_id)
-        
+        # الـ pending في SQLite هو الـ queue - الـ batch processor هياخده
         print(f"  ✅ Batch {batch_id[:8]}... queued for processing")
 
 @app.route('/api/batch/create', methods=['POST'])
@@ -2352,7 +4591,8 @@ def create_batch():
 
     # إنشاء الباتش
     batch_id = str(uuid.uuid4())
-    db_create_batch(batch_id, len(items), global_config)
+    # 'creating' لحد ما كل الـ items تتضاف - الـ leader مايشوفهوش في الـ queue قبل كده
+    db_create_batch(batch_id, len(items), global_config, status='creating')
     print(f"📦 Created batch: {batch_id}")
 
     # إنشاء الـ jobs والـ items
@@ -2385,14 +4625,14 @@ def create_batch():
         if item.get('bgQuery'):
             job_config['bgQuery'] = item['bgQuery']
 
-        job_id = create_job(job_config, session_id)
+        # الباتش بيشتغل عند الـ leader (ممكن يكون worker تاني) - مش في الـ RAM هنا
+        job_id = create_job(job_config, session_id, track=False)
         db_add_batch_item(batch_id, job_id, i, item['surah'], item['startAyah'], item['endAyah'])
         print(f"  ✅ Created job {i+1}/{len(items)}: {job_id[:8]}...")
     
-    # إضافة للقائمة
-    with BATCH_QUEUE_LOCK:
-        BATCH_QUEUE.append(batch_id)
-        print(f"📋 Added batch {batch_id} to queue. Queue length: {len(BATCH_QUEUE)}")
+    # إضافة للقائمة (الباتش pending في SQLite - الـ leader هياخده)
+    db_update_batch(batch_id, status='pending')
+    print(f"📋 Added batch {batch_id} to queue")
     
     print(f"✅ Batch {batch_id} ready with {len(items)} videos")
     
@@ -2403,27 +4643,23 @@ def create_batch():
         'items': items
     })
 
-@app.route('/api/batch/status')
-def get_batch_status():
-    """الحصول على حالة الباتش"""
-    batch_id = request.args.get('batchId')
-    
-    if not batch_id:
-        return jsonify({'ok': False, 'error': 'batchId required'}), 400
-    
-    batch = db_get_batch(batch_id)
-    if not batch:
-        return jsonify({'ok': False, 'error': 'Batch not found'}), 404
-    
-    items = db_get_batch_items(batch_id)
+def live_percent(job_id, db_percent):
+    """الـ percent من الـ RAM لو الـ job شغال هنا (SQLite بيتأخر لحد flush الـ ProgressWriter)"""
+    job = JOBS.get(job_id)
+    if job and job.get('percent') is not None:
+        return job['percent']
+    return db_percent or 0
+
+def build_batch_status(batch, since=None):
+    """حالة الباتش للـ API (polling و SSE بنفس الشكل)"""
+    # items + percent الـ jobs في query واحدة (بدل query لكل item)
+    items = db_get_batch_items_with_jobs(batch['id'], since=since)
     
     # إضافة معلومات كل فيديو
     items_info = []
-    current_video = None
-    current_item_started_at = None
+    current_item = None
     
     for item in items:
-        job = db_get_job(item['job_id'])
         item_info = {
             'position': item['position'],
             'surah': item['surah'],
@@ -2431,15 +4667,20 @@ def get_batch_status():
             'endAyah': item['end_ayah'],
             'status': item['status'],
             'jobId': item['job_id'],
-            'percent': job.get('percent', 0) if job else 0,
-            'downloadUrl': f"/api/download?jobId={item['job_id']}" if item['status'] == 'complete' and job and job.get('output_path') else None
+            'percent': live_percent(item['job_id'], item['job_percent']),
+            'version': item.get('version') or 0,
+            'downloadUrl': f"/api/download?jobId={item['job_id']}" if item['status'] == 'complete' and item['job_output_path'] else None
         }
         items_info.append(item_info)
         
         # تحديد الفيديو الحالي
-        if item['status'] == 'processing':
-            current_video = item_info
-            current_item_started_at = item.get('video_started_at')
+        if item['status'] == 'processing' and current_item is None:
+            current_item = item
+    
+    # ✅ مع since الـ items متفلترة - الفيديو الحالي ممكن ميكونش اتغير فبنجيبه لوحده
+    if since is not None:
+        current_item = db_get_processing_batch_item(batch['id'])
+    current_item_started_at = current_item.get('video_started_at') if current_item else None
     
     # حساب الوقت المتبقي
     remaining_time = None
@@ -2456,47 +4697,119 @@ def get_batch_status():
     
     # الحصول على اسم السورة للفيديو الحالي
     surah_name = None
-    if current_video:
-        surah_idx = current_video['surah'] - 1  # السور مرقمة من 1، الـ list من 0
-        surah_name = SURAH_NAMES[surah_idx] if 0 <= surah_idx < len(SURAH_NAMES) else f"سورة {current_video['surah']}"
+    if current_item:
+        surah_idx = current_item['surah'] - 1  # السور مرقمة من 1، الـ list من 0
+        surah_name = SURAH_NAMES[surah_idx] if 0 <= surah_idx < len(SURAH_NAMES) else f"سورة {current_item['surah']}"
+    
+    return {
+        'id': batch['id'],
+        'status': batch['status'],
+        'totalJobs': batch['total_jobs'],
+        'completedJobs': batch['completed_jobs'],
+        'failedJobs': batch['failed_jobs'],
+        'currentJobIndex': batch['current_job_index'],
+        'createdAt': batch['created_at'],
+        'startedAt': batch.get('started_at'),
+        'completedAt': batch.get('completed_at'),
+        'avgVideoTime': batch.get('avg_video_time'),
+        'remainingTime': remaining_time,
+        'remainingVideos': remaining_videos,
+        'currentVideo': {
+            'surahName': surah_name,
+            'surah': current_item['surah'],
+            'ayah': current_item['start_ayah'],
+            'position': current_item['position']
+        } if current_item else None,
+        'version': batch.get('version') or 0,
+        'partial': since is not None,
+        'items': items_info
+    }
+
+@app.route('/api/batch/status')
+def get_batch_status():
+    """الحصول على حالة الباتش"""
+    batch_id = request.args.get('batchId')
     
-    return jsonify({
-        'ok': True,
-        'batch': {
-            'id': batch['id'],
-            'status': batch['status'],
-            'totalJobs': batch['total_jobs'],
-            'completedJobs': batch['completed_jobs'],
-            'failedJobs': batch['failed_jobs'],
-            'currentJobIndex': batch['current_job_index'],
-            'createdAt': batch['created_at'],
-            'startedAt': batch.get('started_at'),
-            'completedAt': batch.get('completed_at'),
-            'avgVideoTime': batch.get('avg_video_time'),
-            'remainingTime': remaining_time,
-            'remainingVideos': remaining_videos,
-            'currentVideo': {
-                'surahName': surah_name,
-                'surah': current_video['surah'] if current_video else None,
-                'ayah': current_video['startAyah'] if current_video else None,
-                'position': current_video['position'] if current_video else None
-            } if current_video else None,
-            'items': items_info
-        }
-    })
+    if not batch_id:
+        return jsonify({'ok': False, 'error': 'batchId required'}), 400
+    
+    since = request.args.get('since', type=int)
+    
+    batch = db_get_batch(batch_id)
+    if not batch:
+        return jsonify({'ok': False, 'error': 'Batch not found'}), 404
+    
+    # ✅ ETag = version الباتش - لو مفيش تغيير من آخر poll يرجع 304 من غير ما نقرا الـ items
+    version = batch.get('version') or 0
+    etag = f"{batch_id}-{version}-{since if since is not None else 'all'}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({'ok': True, 'batch': build_batch_status(batch, since)})
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/batch/stream')
+def batch_stream():
+    """SSE - snapshot الباتش مع كل تغيير فيه، ومع progress الـ jobs بتاعته (بحد أقصى كل SSE_BATCH_INTERVAL)"""
+    batch_id = request.args.get('batchId')
+    if not batch_id:
+        return jsonify({'ok': False, 'error': 'batchId required'}), 400
+    
+    batch = db_get_batch(batch_id)
+    if not batch:
+        return jsonify({'ok': False, 'error': 'Batch not found'}), 404
+    
+    job_topics = [f"job:{item['job_id']}" for item in db_get_batch_items(batch_id)]
+    
+    def events():
+        sub = EVENT_BUS.subscribe(f"batch:{batch_id}", *job_topics)
+        try:
+            yield "retry: 3000\n\n"
+            last_sent = last_ping = 0
+            version = None
+            dirty, urgent = True, True
+            while True:
+                now = time.time()
+                if dirty and (urgent or now - last_sent >= SSE_BATCH_INTERVAL):
+                    batch = db_get_batch(batch_id)
+                    if not batch:
+                        return
+                    yield sse_message('batch', build_batch_status(batch))
+                    version = batch.get('version') or 0
+                    last_sent, dirty, urgent = now, False, False
+                    if batch['status'] in BATCH_FINAL_STATUSES:
+                        return
+                
+                # الباتش بيشتغل عند الـ leader - لو إحنا مش الـ leader نتابع الـ version في SQLite
+                remote = not LEADER.is_leader
+                wait = max(0.0, last_sent + SSE_BATCH_INTERVAL - now) if dirty else (SSE_REMOTE_POLL if remote else SSE_KEEPALIVE)
+                events = sub.get(wait)
+                if events:
+                    dirty = True
+                    # تغيير في الباتش نفسه (status/counters) بيتبعت فوراً، progress الـ jobs بالـ throttle
+                    urgent = urgent or any(topic.startswith('batch:') for topic, _, _ in events)
+                elif not dirty:
+                    current = db_get_batch(batch_id) if remote else None
+                    if current and (current.get('version') or 0) != version:
+                        dirty = True
+                    elif not remote or time.time() - last_ping >= SSE_KEEPALIVE:
+                        last_ping = time.time()
+                        yield ": keepalive\n\n"
+        finally:
+            sub.close()
+    
+    return sse_response(events)
 
 @app.route('/api/batch/list')
 def list_batches():
     """الحصول على قائمة الباتشات للجلسة"""
     session_id = request.args.get('sessionId')
     
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
     if session_id:
         # الحصول على jobs الخاصة بالجلسة ثم الباتشات
-        c.execute('''
+        rows = db_query('''
             SELECT DISTINCT b.* FROM batch_jobs b
             JOIN batch_items bi ON b.id = bi.batch_id
             JOIN jobs j ON bi.job_id = j.id
@@ -2504,10 +4817,7 @@ def list_batches():
             ORDER BY b.created_at DESC LIMIT 20
         ''', (session_id,))
     else:
-        c.execute("SELECT * FROM batch_jobs ORDER BY created_at DESC LIMIT 20")
-    
-    rows = c.fetchall()
-    conn.close()
+        rows = db_query("SELECT * FROM batch_jobs ORDER BY created_at DESC LIMIT 20")
     
     batches = []
     for row in rows:
@@ -2544,14 +4854,14 @@ def cancel_batch():
     
     # إيقاف الـ job الحالي
     if batch.get('current_job_id'):
-        with JOBS_LOCK:
-            if batch['current_job_id'] in JOBS:
-                JOBS[batch['current_job_id']]['should_stop'] = True
+        cancel_job(batch['current_job_id'])
     
-    # إزالة من القائمة
-    with BATCH_QUEUE_LOCK:
-        if batch_id in BATCH_QUEUE:
-            BATCH_QUEUE.remove(batch_id)
+    # الـ items اللي لسه ماشتغلتش مش هتشتغل - تخرج من عداد الـ jobs النشطة
+    for item in db_get_batch_items(batch_id):
+        if item['status'] == 'pending':
+            JOBS.update(item['job_id'], status='cancelled', is_running=False)
+    
+    # مفيش قائمة تانية نشيله منها - status = cancelled كفاية (db_claim_batch مش هياخده)
     
     return jsonify({'ok': True})
 
@@ -2570,8 +4880,26 @@ YOUTUBE_REDIRECT_URI = os.environ.get('YOUTUBE_REDIRECT_URI', '')
 # Scopes المطلوبة
 YOUTUBE_SCOPES = ['https://www.googleapis.com/auth/youtube.upload']
 
-# تخزين الـ tokens في الذاكرة (يمكن نقله لقاعدة البيانات لاحقاً)
-YOUTUBE_TOKENS = {}  # session_id -> credentials
+class YoutubeTokenStore:
+    """session_id -> credentials في SQLite (نفس واجهة الـ dict) - كل الـ workers شايفين نفس الـ tokens"""
+
+    def __contains__(self, session_id):
+        return bool(session_id) and db_get_youtube_token(session_id) is not None
+
+    def __getitem__(self, session_id):
+        data = db_get_youtube_token(session_id)
+        if data is None:
+            raise KeyError(session_id)
+        return data
+
+    def __setitem__(self, session_id, data):
+        db_save_youtube_token(session_id, data)
+
+    def __delitem__(self, session_id):
+        db_delete_youtube_token(session_id)
+
+# تخزين الـ tokens في SQLite (كانت في الذاكرة - كل worker ليه نسخة)
+YOUTUBE_TOKENS = YoutubeTokenStore()  # session_id -> credentials
 
 def get_base_url():
     """الحصول على الـ base URL ديناميكياً من الطلب"""
@@ -3048,6 +5376,129 @@ def youtube_disconnect():
     
     return jsonify({'ok': True})
 
+# ==========================================
+# 🏭 Render Worker - python main.py worker (الرندر بس، من غير Flask)
+# ==========================================
+WORKER_POLL_INTERVAL = 2  # ثواني بين محاولات الـ claim لو الـ queue فاضي
+
+def run_job_config(job_id, config, bg_pool=None):
+    """build_video_task من الـ config المتخزن في SQLite"""
+    build_video_task(
+        job_id,
+        config.get('pexelsKey', ''),
+        config.get('reciter', ''),
+        int(config.get('surah', 1)),
+        int(config.get('startAyah', 1)),
+        int(config.get('endAyah', 0)),
+        config.get('quality', '720'),
+        config.get('bgQuery', ''),
+        int(config.get('fps', 20)),
+        config.get('dynamicBg', False),
+        config.get('useGlow', False),
+        config.get('useVignette', False),
+        config.get('aspectRatio', '9:16'),
+        config.get('style', {}),
+        config.get('font', 'Arabic'),
+        config.get('fontEn', 'English'),
+        preview=config.get('preview', False),
+        bg_pool=bg_pool
+    )
+
+class RenderWorker:
+    """
+    بياخد jobs من الـ queue (status = queued) بـ lease، ويجدده كل JOB_HEARTBEAT_INTERVAL
+    ولو worker مات الـ lease بينتهي والـ job يرجع للـ queue (db_release_expired_leases)
+    الـ workspace والـ outputs لازم يكونوا على نفس الـ volume المشترك مع الـ API
+    """
+
+    def __init__(self, concurrency=1):
+        self.concurrency = concurrency
+        self.owner = runner_id()
+        self.running = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def run_one(self, job):
+        job_id = job['id']
+        with self.lock:
+            self.running.add(job_id)
+        # كل db_update_job للـ job ده (هنا وجوه build_video_task) بقى مشروط بـ lease_owner = self.owner
+        JOB_LEASES[job_id] = self.owner
+        try:
+            if not job.get('config_json'):
+                db_update_job(job_id, status='error', error='Config missing')
+                return
+            config = json.loads(job['config_json'])
+            os.makedirs(job['workspace'], exist_ok=True)
+            JOBS.add(job_id, dict(job_from_row(job), status='processing', is_running=True))
+            print(f"🏭 [{self.owner}] Rendering job {job_id[:8]}... (attempt {(job.get('attempts') or 0) + 1})")
+            bg_pool = None if config.get('preview') else get_preview_bg_pool(
+                config.get('previewJobId'), config.get('session_id'), config.get('aspectRatio', '9:16'), config.get('quality', '720'))
+            run_job_config(job_id, config, bg_pool=bg_pool)
+        except Exception as e:
+            traceback.print_exc()
+            # مشروط بالـ lease (JOB_LEASES) - لو worker تاني أخد الـ job مانعلّمهوش error
+            db_update_job(job_id, status='error', error=str(e))
+        finally:
+            PROGRESS_WRITER.flush()
+            db_release_lease(job_id, self.owner)
+            JOB_LEASES.pop(job_id, None)
+            with self.lock:
+                self.running.discard(job_id)
+
+    def slot(self):
+        while not self.stopping.is_set():
+            try:
+                job = db_claim_job(self.owner)
+            except sqlite3.Error as e:
+                print(f"[WARNING] Claim failed: {e}")
+                job = None
+            if job is None:
+                self.stopping.wait(WORKER_POLL_INTERVAL)
+                continue
+            self.run_one(job)
+
+    def heartbeat(self):
+        """تجديد الـ leases + إرجاع leases الـ workers الميتة للـ queue"""
+        with self.lock:
+            running = list(self.running)
+        for job_id in running:
+            if not db_renew_lease(job_id, self.owner):
+                # الـ lease راح (الـ worker ده وقف أكتر من JOB_LEASE_SECONDS) - worker تاني ممكن يكون أخده
+                print(f"⚠️ Lost lease on job {job_id[:8]}... - stopping")
+                cancel_token(job_id, stopped=True)
+        requeued, failed = db_release_expired_leases()
+        if requeued or failed:
+            print(f"🏭 Expired leases: {requeued} requeued, {failed} failed")
+
+    def run(self):
+        print(f"🏭 Render worker {self.owner} started ({self.concurrency} slot(s))")
+        for i in range(self.concurrency):
+            threading.Thread(target=self.slot, daemon=True, name=f"RenderSlot-{i}").start()
+        try:
+            while True:
+                try:
+                    self.heartbeat()
+                except sqlite3.Error as e:
+                    print(f"[WARNING] Heartbeat failed: {e}")
+                time.sleep(JOB_HEARTBEAT_INTERVAL)
+        except (KeyboardInterrupt, SystemExit):
+            # الـ jobs الشغالة ترجع للـ queue فوراً بدل ما تستنى الـ lease ينتهي
+            self.stopping.set()
+            PROGRESS_WRITER.flush()
+            db_expire_leases(self.owner)
+            db_release_expired_leases()
+            print(f"🏭 Render worker {self.owner} stopped")
+
+def run_render_worker(argv):
+    parser = argparse.ArgumentParser(prog="main.py worker", description="Render jobs from the shared SQLite queue")
+    parser.add_argument('--concurrency', type=int, default=int(os.environ.get('RENDER_CONCURRENCY', 1)),
+                        help="jobs rendered in parallel by this worker")
+    args = parser.parse_args(argv)
+    # SIGTERM (docker stop) = نفس Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    RenderWorker(max(1, args.concurrency)).run()
+
 # ==========================================
 # 🚀 Application Startup (Correct Order!)
 # ==========================================
@@ -3059,69 +5510,198 @@ IS_HUGGINGFACE = bool(os.environ.get('SPACE_ID')) or bool(os.environ.get('SPACE_
 print("📦 Initializing database...")
 init_db()
 
-# 2. Handle pending jobs from previous session
-if IS_HUGGINGFACE:
-    # ✅ على HuggingFace: تنظيف بس المشlugل - مستني الباتشات تاني
-    print("🔄 HuggingFace detected - cleaning stale single jobs...")
-    try:
-        stale_jobs = db_get_pending_jobs()
-        for job in stale_jobs:
-            # شيك لو الـ job ده مش جزء من batch
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("SELECT batch_id FROM batch_items WHERE job_id = ?", (job['id'],))
-            batch_check = c.fetchone()
-            conn.close()
+# ==========================================
+# 👑 Leader Election - الـ background threads في worker واحد بس
+# ==========================================
+LEADER_LOCK_PATH = DB_PATH + ".leader"
+LEADER_RETRY_INTERVAL = 5  # ثواني - الـ workers التانية بتحاول تاخد القيادة لو الـ leader مات
+
+class LeaderElection:
+    """
+    lockfile بـ flock: أول worker ياخده هو الـ leader (batch processor + cleanup + recovery)
+    الـ kernel بيفك الـ lock لوحده لو الـ process ماتت، وworker تاني بياخده
+    """
+
+    def __init__(self, path, on_elected):
+        self.path = path
+        self.on_elected = on_elected
+        self.fd = None
+        self.is_leader = False
+
+    def try_acquire(self):
+        """بيرجع (نجح؟، محتوى الـ lockfile من الـ leader اللي قبله)"""
+        try:
+            import fcntl
+        except ImportError:
+            # مفيش flock (Windows) = process واحدة
+            self.is_leader = True
+            return True, ''
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False, ''
+        previous = os.read(fd, 256).decode(errors='ignore').strip()
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()} {os.getppid()}\n".encode())
+        self.fd = fd
+        self.is_leader = True
+        return True, previous
+
+    def start(self):
+        acquired, previous = self.try_acquire()
+        if acquired:
+            self.on_elected(previous)
+            return
+        print(f"👥 Worker {os.getpid()} is a follower - background threads run in the leader")
+        threading.Thread(target=self._wait, daemon=True, name="LeaderElection").start()
+
+    def _wait(self):
+        while True:
+            time.sleep(LEADER_RETRY_INTERVAL)
+            acquired, previous = self.try_acquire()
+            if acquired:
+                self.on_elected(previous)
+                return
+
+def is_takeover(previous):
+    """
+    الـ leader اللي قبلنا كان worker تحت نفس الـ gunicorn master (مات والباقي لسه شغال)؟
+    ساعتها الـ jobs الفردية شغالة في workers تانية ومينفعش نعيد تشغيلها
+    """
+    if 'gunicorn' not in os.path.basename(sys.argv[0] or ''):
+        return False
+    parts = previous.split()
+    return len(parts) == 2 and parts[1] == str(os.getppid()) and parts[0] != str(os.getpid())
+
+def recover_on_startup():
+    """Handle pending jobs from previous session"""
+    if IS_HUGGINGFACE:
+        # ✅ على HuggingFace: تنظيف بس المشlugل - مستني الباتشات تاني
+        print("🔄 HuggingFace detected - cleaning stale single jobs...")
+        try:
+            stale_jobs = db_get_pending_jobs()
+            for job in stale_jobs:
+                # شيك لو الـ job ده مش جزء من batch
+                batch_check = db_query("SELECT batch_id FROM batch_items WHERE job_id = ?", (job['id'],), one=True)
+                
+                if batch_check is None:
+                    # ده job فردي (مش جزء من batch) - نلغيه
+                    db_update_job(job['id'], status='error', error='Server restarted (HuggingFace sleep)')
+                else:
+                    # ده جزء من batch - نسيبه_pending عشان batch processor يعالجه
+                    pass
             
-            if batch_check is None:
-                # ده job فردي (مش جزء من batch) - نلغيه
-                db_update_job(job['id'], status='error', error='Server restarted (HuggingFace sleep)')
-            else:
-                # ده جزء من batch - نسيبه_pending عشان batch processor يعالجه
-                pass
-        
-        if stale_jobs:
-            print(f"🧹 Checked {len(stale_jobs)} stale jobs (batch jobs preserved)")
-        
-        # إعادة الباتشات اللي كانت running لـ pending
-        stale_batches = db_get_pending_batches()
-        for batch in stale_batches:
-            if batch['status'] == 'running':
-                db_update_batch(batch['id'], status='pending')
-                print(f"  🔄 Reset batch {batch['id'][:8]}... to 'pending'")
-    except Exception as e:
-        print(f"⚠️ Failed to clean stale jobs: {e}")
-else:
-    # على السيرفر المحلي: استئناف الـ jobs كالعادي
-    print("🔄 Recovering pending jobs...")
-    try:
-        recover_pending_jobs()
-    except Exception as e:
-        print(f"⚠️ Failed to recover pending jobs: {e}")
+            if stale_jobs:
+                print(f"🧹 Checked {len(stale_jobs)} stale jobs (batch jobs preserved)")
+            
+            # إعادة الباتشات اللي كانت running لـ pending
+            stale_batches = db_get_pending_batches()
+            for batch in stale_batches:
+                if batch['status'] == 'running':
+                    db_update_batch(batch['id'], status='pending')
+                    print(f"  🔄 Reset batch {batch['id'][:8]}... to 'pending'")
+        except Exception as e:
+            print(f"⚠️ Failed to clean stale jobs: {e}")
+    else:
+        # على السيرفر المحلي: استئناف الـ jobs كالعادي
+        print("🔄 Recovering pending jobs...")
+        try:
+            recover_pending_jobs()
+        except Exception as e:
+            print(f"⚠️ Failed to recover pending jobs: {e}")
 
-    print("📦 Recovering pending batches...")
-    try:
-        recover_pending_batches()
-    except Exception as e:
-        print(f"⚠️ Failed to recover pending batches: {e}")
+        print("📦 Recovering pending batches...")
+        try:
+            recover_pending_batches()
+        except Exception as e:
+            print(f"⚠️ Failed to recover pending batches: {e}")
+
+def recover_orphaned_jobs(orphans, reason):
+    """jobs فردية الـ process بتاعتها ماتت: اللي كان بيتلغى = cancelled، والباقي يتعاد (هنا أو في الـ queue)"""
+    if not orphans:
+        return
+    print(f"🔄 {len(orphans)} single jobs orphaned ({reason})")
+    resume = []
+    for job in orphans:
+        if job['status'] == 'cancelling' or job['should_stop']:
+            db_update_job(job['id'], status='cancelled', error='Stopped by user')
+        else:
+            # الـ runner الجديد على طول - الـ sweep الجاي مايعيدهوش تاني قبل ما يبدأ
+            db_update_job(job['id'], runner=runner_id())
+            resume.append(job)
+    recover_pending_jobs(resume)
+
+def recover_previous_leader_jobs(previous):
+    """الـ leader القديم مات وسط الشغل (الـ pid من الـ lockfile، والـ runner من عمود jobs.runner)"""
+    parts = previous.split()
+    if parts:
+        runner = runner_id(parts[0])
+        recover_orphaned_jobs([j for j in db_get_orphaned_jobs(runner) if j['runner'] == runner], "previous leader died")
+
+def sweep_dead_runners():
+    """
+    أي worker (مش الـ leader بس) ممكن يموت وسط الرندر (OOM مثلاً والـ gunicorn بيعمل respawn)
+    الـ leader بيدور على jobs الـ runner بتاعها process على نفس الجهاز مابقتش عايشة
+    """
+    prefix = f"{socket.gethostname()}:"
+    dead = []
+    for job in db_get_orphaned_jobs(prefix + '%'):
+        if not job['runner'].startswith(prefix):
+            continue  # الـ LIKE ممكن يطابق host تاني فيه _
+        try: pid = int(job['runner'][len(prefix):])
+        except (TypeError, ValueError): continue
+        if pid != os.getpid() and not pid_alive(pid):
+            dead.append(job)
+    recover_orphaned_jobs(dead, "render process died")
+
+def start_leader_services(previous):
+    """الـ worker ده بقى الـ leader: recovery + الـ background threads"""
+    print(f"👑 Worker {os.getpid()} elected leader")
+    if is_takeover(previous):
+        # الباتشات اللي كانت شغالة عند الـ leader القديم ماتت معاه - ترجع للـ queue
+        print("📦 Leader takeover - requeueing batches of the previous leader...")
+        try:
+            recover_pending_batches()
+        except Exception as e:
+            print(f"⚠️ Failed to recover pending batches: {e}")
+        # والـ jobs الفردية اللي كانت بتترندر فيه (من غير كده بتفضل processing على طول)
+        try:
+            recover_previous_leader_jobs(previous)
+        except Exception as e:
+            print(f"⚠️ Failed to recover orphaned jobs: {e}")
+    else:
+        recover_on_startup()
 
-# 3. Start background threads AFTER database is ready
-print("🧵 Starting background threads...")
+    # 3. Start background threads AFTER database is ready
+    print("🧵 Starting background threads...")
 
-# Start batch processor thread
-batch_thread = threading.Thread(target=process_batch_queue, daemon=True, name="BatchProcessor")
-batch_thread.start()
-print("✅ Batch processor thread started")
+    # Start batch processor thread
+    batch_thread = threading.Thread(target=process_batch_queue, daemon=True, name="BatchProcessor")
+    batch_thread.start()
+    print("✅ Batch processor thread started")
 
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=background_cleanup, daemon=True, name="CleanupThread")
-cleanup_thread.start()
-print("✅ Cleanup thread started")
+    # Start cleanup thread
+    cleanup_thread = threading.Thread(target=background_cleanup, daemon=True, name="CleanupThread")
+    cleanup_thread.start()
+    print("✅ Cleanup thread started")
+
+# 2. Leader election (recovery + background threads في worker واحد)
+# ✅ الـ render worker مش بيشغل حاجة من دول - الرندر بس
+IS_RENDER_WORKER = __name__ == "__main__" and sys.argv[1:2] == ['worker']
+LEADER = LeaderElection(LEADER_LOCK_PATH, start_leader_services)
+if not IS_RENDER_WORKER:
+    LEADER.start()
 
 print("🚀 Quran Reels Generator ready!")
 
 if __name__ == "__main__":
-    print("🚀 Starting Flask development server...")
-    app.run(host='0.0.0.0', port=7860, threaded=True)
+    if IS_RENDER_WORKER:
+        run_render_worker(sys.argv[2:])
+    else:
+        print("🚀 Starting Flask development server...")
+        app.run(host='0.0.0.0', port=7860, threaded=True)
 
 
@@ -14,10 +14,25 @@ echo "[INFO] HF Space detected: ${SPACE_ID:+yes}${SPACE_ID:-no}"
 # Use PORT env var if set (HuggingFace might override)
 PORT="${PORT:-7860}"
 
-echo "[INFO] Starting gunicorn on 0.0.0.0:${PORT}..."
+# Shared state lives in SQLite and background threads run in one elected leader (lockfile),
+# so more than one worker is safe - except the rate limiter: with the default memory:// storage
+# every worker counts on its own, so default to 1 worker unless RATELIMIT_STORAGE_URI is shared
+if [ -n "${RATELIMIT_STORAGE_URI}" ]; then
+    WORKERS="${WEB_CONCURRENCY:-2}"
+else
+    WORKERS="${WEB_CONCURRENCY:-1}"
+fi
+# main.py warns at startup if more than one worker runs with memory://
+export WEB_CONCURRENCY="${WORKERS}"
+# Each open SSE stream (/api/progress/stream, /api/batch/stream) holds a thread
+THREADS="${GUNICORN_THREADS:-16}"
+# ...so cap the streams per worker at half the threads; extra clients get 503 and fall back to polling
+export SSE_MAX_STREAMS="${SSE_MAX_STREAMS:-$((THREADS / 2))}"
+
+echo "[INFO] Starting gunicorn on 0.0.0.0:${PORT} (${WORKERS} workers x ${THREADS} threads, ${SSE_MAX_STREAMS} SSE streams each)..."
 exec gunicorn \
-    -w 1 \
-    --threads 4 \
+    -w "${WORKERS}" \
+    --threads "${THREADS}" \
     -b "0.0.0.0:${PORT}" \
     --timeout 300 \
     --access-logfile - \